@@ -0,0 +1,438 @@
+"""Convert many subjects, sessions and runs to BIDS in parallel.
+
+The conversion steps, which ``convert_somato_data.py`` runs one after the
+other for the MNE-somato-data, are split into tasks:
+
+- per run: reading the raw file, finding the events and writing it with
+  ``write_raw_bids``, and rewriting the forward solution with the BIDS
+  subject label;
+- per subject: writing the T1 with ``write_anat``, then ``recon-all``,
+  ``make_scalp_surfaces``, ``watershed_bem`` and the BEM solution;
+- for the dataset: updating ``dataset_description.json`` once all the
+  runs are written.
+
+Tasks that mostly read and write files run in a thread pool, while
+FreeSurfer and the BEM computation run in a process pool, so that the
+anatomy of one subject is processed while the runs of the others are
+written. Finished tasks are recorded in a manifest, and running the
+conversion again only executes the tasks that did not finish::
+
+    python batch_convert.py sessions.json --n-jobs 8
+
+The sessions file is a JSON object with the BIDS root, optional fields of
+the dataset description and the list of sessions::
+
+    {"bids_root": "/data/study-bids",
+     "dataset_description": {"Name": "Study"},
+     "sessions": [{"subject": "01", "session": "01", "task": "rest",
+                   "run": "01", "raw": "/data/s01/rest_raw.fif",
+                   "t1w": "/data/s01/T1.mgz",
+                   "trans": "/data/s01/rest_raw-trans.fif",
+                   "forward": "/data/s01/s01-meg-oct-6-fwd.fif"}]}
+
+``t1w``, ``trans`` and ``forward`` are optional. The MRI of a subject is
+taken from its first session that has one. ``--somato`` converts the
+MNE-somato-data (without the READMEs of ``convert_somato_data.py``).
+"""
+# License: BSD (3-clause)
+import argparse
+import glob
+import json
+import os
+import os.path as op
+import threading
+import time
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                FIRST_COMPLETED, wait)
+
+import numpy as np
+
+import mne
+from mne.utils import run_subprocess
+
+from mne_bids import write_raw_bids, make_bids_basename, write_anat
+
+from freesurfer import recon_all_command
+from placement import place_file, set_forward_subject
+
+# write_raw_bids updates the participants and scans files of the dataset,
+# so the runs are written one at a time while their raw files are read
+# and their events found concurrently
+_bids_lock = threading.Lock()
+
+
+###############################################################################
+# Tasks
+
+def _session_dir(bids_root, subject, session):
+    session_dir = op.join(bids_root, 'sub-' + subject)
+    if session is not None:
+        session_dir = op.join(session_dir, 'ses-' + session)
+    return session_dir
+
+
+def convert_raw(bids_root, subject, session, task, run, raw, sex=None,
+                link=False):
+    """Write a run with ``write_raw_bids``, reflinking the original if asked.
+
+    With ``link``, ``write_raw_bids`` still writes a full copy of the data,
+    which is then replaced by a reflink (or hard link) of the original file.
+    This saves the space of the copy, not the time spent writing it.
+    """
+    raw_fname = raw
+    raw = mne.io.read_raw_fif(raw_fname)
+    # the original file can only be placed in the dataset if it already has
+    # the subject info that is written
+    link = link and len(raw.filenames) == 1
+    if sex is not None:
+        link = link and 'sex' in raw.info['subject_info']
+        raw.info['subject_info']['sex'] = raw.info['subject_info'].get(
+            'sex', sex)
+    events = mne.find_events(raw)
+    event_id = dict(('%s_event%d' % (task, val), val)
+                    for val in np.unique(events[:, -1]))
+    bids_basename = make_bids_basename(subject=subject, session=session,
+                                       task=task, run=run)
+    with _bids_lock:
+        write_raw_bids(raw, bids_basename, bids_root, events, event_id,
+                       overwrite=True)
+    if link:
+        # write_raw_bids saves a copy of the data, it is replaced by a
+        # reflink of the original file
+        place_file(raw_fname, op.join(_session_dir(bids_root, subject,
+                                                   session), 'meg',
+                                      bids_basename + '_meg.fif'))
+
+
+def convert_anat(bids_root, subject, session, t1w, trans, raw):
+    raw = mne.io.read_raw_fif(raw) if trans is not None else None
+    write_anat(bids_root, subject=subject, t1w=t1w, session=session,
+               trans=trans, raw=raw, overwrite=True)
+
+
+def _t1w_nii(bids_root, subject, session):
+    return glob.glob(op.join(_session_dir(bids_root, subject, session),
+                             'anat', '*_T1w.nii.gz'))[0]
+
+
+def _freesurfer_env(subjects_dir):
+    env = dict(os.environ)
+    env['SUBJECTS_DIR'] = subjects_dir
+    return env
+
+
+def recon_all(bids_root, subjects_dir, subject, session):
+    command = recon_all_command(subjects_dir, subject,
+                                _t1w_nii(bids_root, subject, session))
+    run_subprocess(command, env=_freesurfer_env(subjects_dir))
+
+
+def make_scalp_surfaces(subjects_dir, subject):
+    # use --force to prevent an error from topology defects
+    run_subprocess(['mne', 'make_scalp_surfaces', '-s', subject,
+                    '--overwrite', '--force'],
+                   env=_freesurfer_env(subjects_dir))
+
+
+def watershed_bem(subjects_dir, subject):
+    run_subprocess(['mne', 'watershed_bem', '-s', subject, '--overwrite'],
+                   env=_freesurfer_env(subjects_dir))
+
+
+def make_bem(subjects_dir, subject):
+    bem_dir = op.join(subjects_dir, subject, 'bem')
+    model = mne.make_bem_model(subject, conductivity=(0.3,),
+                               subjects_dir=subjects_dir)
+    mne.write_bem_surfaces(op.join(bem_dir, '%s-5120-bem.fif' % subject),
+                           model)
+    mne.write_bem_solution(op.join(bem_dir, '%s-5120-bem-sol.fif' % subject),
+                           mne.make_bem_solution(model))
+
+
+def convert_forward(forward, fname, subject, link=False):
+    if not op.isdir(op.dirname(fname)):
+        os.makedirs(op.dirname(fname))
+    if link:
+        try:
+            set_forward_subject(forward, fname, subject)
+            return
+        except ValueError as exp:  # e.g. no subject in the source spaces
+            print('Could not patch %s (%s), rewriting it' % (forward, exp))
+    fwd = mne.read_forward_solution(forward)
+    for ss in fwd['src']:
+        ss['subject_his_id'] = subject
+    mne.write_forward_solution(fname, fwd, overwrite=True)
+
+
+def update_description(bids_root, fields):
+    fname = op.join(bids_root, 'dataset_description.json')
+    with open(fname) as fid:
+        description = json.load(fid)
+    description.update(fields)
+    with open(fname, 'w') as fid:
+        json.dump(description, fid, indent=2, sort_keys=True)
+
+
+###############################################################################
+# Scheduling
+
+class Task(object):
+    """A conversion step.
+
+    Parameters
+    ----------
+    name : str
+        Unique name, used in the manifest.
+    func : callable
+        Module level function called as ``func(**kwargs)``.
+    kind : 'io' | 'cpu'
+        Whether the task runs in the thread or in the process pool.
+    deps : list of str
+        Names of the tasks that must finish first.
+    **kwargs
+        Keyword arguments passed to ``func``.
+    """
+
+    def __init__(self, name, func, kind='io', deps=(), **kwargs):
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.deps = list(deps)
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return '<Task | %s>' % self.name
+
+
+def _call(func, kwargs):
+    func(**kwargs)
+
+
+class Manifest(object):
+    """The tasks finished in previous runs, saved after each task."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.tasks = dict()
+        if op.isfile(fname):
+            with open(fname) as fid:
+                self.tasks = json.load(fid)['tasks']
+
+    def done(self, name):
+        return name in self.tasks
+
+    def add(self, name, wall_time):
+        self.tasks[name] = dict(wall_time=wall_time,
+                                date=time.strftime('%Y-%m-%d %H:%M:%S'))
+        if not op.isdir(op.dirname(self.fname)):
+            os.makedirs(op.dirname(self.fname))
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as fid:
+            json.dump(dict(tasks=self.tasks), fid, indent=2, sort_keys=True)
+        os.rename(tmp, self.fname)
+
+
+def make_tasks(bids_root, sessions, description=None, link=False):
+    """Declare the conversion tasks of a list of sessions.
+
+    Parameters
+    ----------
+    bids_root : str
+        The root of the BIDS dataset.
+    sessions : list of dict
+        The sessions, see the module docstring for the keys.
+    description : dict | None
+        Fields of ``dataset_description.json`` to set.
+    link : bool
+        Place the raw files and the forward solutions in the dataset by
+        reflinks when possible, and change the subject of
+        the forward solutions without loading them, see ``placement.py``.
+        The raw files are still written in full before being replaced.
+
+    Returns
+    -------
+    tasks : list of Task
+        The tasks.
+    """
+    subjects_dir = op.join(bids_root, 'derivatives', 'freesurfer',
+                           'subjects')
+    tasks, raw_tasks, anats = list(), list(), dict()
+    for spec in sessions:
+        subject, session = spec['subject'], spec.get('session')
+        run = spec.get('run')
+        bids_basename = make_bids_basename(subject=subject, session=session,
+                                           task=spec['task'], run=run)
+        raw_tasks.append('raw:' + bids_basename)
+        tasks.append(Task(raw_tasks[-1], convert_raw, bids_root=bids_root,
+                          subject=subject, session=session,
+                          task=spec['task'], run=run, raw=spec['raw'],
+                          sex=spec.get('sex'), link=link))
+        if spec.get('forward') is not None:
+            deriv_dir = _session_dir(op.join(bids_root, 'derivatives'),
+                                     subject, session)
+            tasks.append(Task('forward:' + bids_basename, convert_forward,
+                              forward=spec['forward'],
+                              fname=op.join(deriv_dir,
+                                            bids_basename + '-fwd.fif'),
+                              subject=subject, link=link))
+        if spec.get('t1w') is not None and subject not in anats:
+            anats[subject] = spec
+
+    for subject, spec in sorted(anats.items()):
+        session = spec.get('session')
+        name = 'sub-' + subject
+        tasks += [
+            Task('anat:' + name, convert_anat, bids_root=bids_root,
+                 subject=subject, session=session, t1w=spec['t1w'],
+                 trans=spec.get('trans'), raw=spec['raw']),
+            Task('recon-all:' + name, recon_all, kind='cpu',
+                 deps=['anat:' + name], bids_root=bids_root,
+                 subjects_dir=subjects_dir, subject=subject,
+                 session=session),
+            Task('scalp:' + name, make_scalp_surfaces, kind='cpu',
+                 deps=['recon-all:' + name], subjects_dir=subjects_dir,
+                 subject=subject),
+            # both write the head surface of the subject
+            Task('watershed:' + name, watershed_bem, kind='cpu',
+                 deps=['scalp:' + name], subjects_dir=subjects_dir,
+                 subject=subject),
+            Task('bem:' + name, make_bem, kind='cpu',
+                 deps=['watershed:' + name], subjects_dir=subjects_dir,
+                 subject=subject),
+        ]
+    if description:
+        tasks.append(Task('description', update_description,
+                          deps=raw_tasks, bids_root=bids_root,
+                          fields=description))
+    return tasks
+
+
+def run_tasks(tasks, manifest, n_jobs=1, n_io=4):
+    """Run the tasks that are not in the manifest.
+
+    A task whose dependency failed is not run, the others go on.
+
+    Parameters
+    ----------
+    tasks : list of Task
+        The tasks.
+    manifest : Manifest
+        The finished tasks, updated as tasks finish.
+    n_jobs : int
+        Number of processes for the CPU heavy tasks.
+    n_io : int
+        Number of threads for the I/O tasks.
+
+    Returns
+    -------
+    failed : dict
+        The error of each task that failed.
+    """
+    pending = [task for task in tasks if not manifest.done(task.name)]
+    print('%d tasks to run, %d finished before'
+          % (len(pending), len(tasks) - len(pending)))
+    finished = set(name for name in manifest.tasks)
+    failed = dict()
+    running = dict()
+    with ThreadPoolExecutor(max_workers=n_io) as threads, \
+            ProcessPoolExecutor(max_workers=n_jobs) as processes:
+        while pending or running:
+            for task in list(pending):
+                if any(dep in failed for dep in task.deps):
+                    failed[task.name] = 'a dependency failed'
+                    pending.remove(task)
+                elif all(dep in finished for dep in task.deps):
+                    pool = processes if task.kind == 'cpu' else threads
+                    print('Starting %s' % task.name)
+                    future = pool.submit(_call, task.func, task.kwargs)
+                    running[future] = (task, time.time())
+                    pending.remove(task)
+            if not running:
+                if pending:  # dependencies that are neither run nor done
+                    for task in pending:
+                        failed[task.name] = 'missing dependency'
+                    pending = list()
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task, start = running.pop(future)
+                try:
+                    future.result()
+                except Exception as exp:
+                    print('Failed %s: %s' % (task.name, exp))
+                    failed[task.name] = repr(exp)
+                    continue
+                manifest.add(task.name, time.time() - start)
+                finished.add(task.name)
+                print('Finished %s in %.0f s'
+                      % (task.name, time.time() - start))
+    return failed
+
+
+def somato_sessions():
+    """The MNE-somato-data session, also run by convert_somato_data.py."""
+    import mne.datasets.somato as somato
+    somato_path = somato.data_path()
+    somato_parent, somato_name = op.split(somato_path)
+    fif_path = op.join(somato_path, 'MEG', 'somato')
+    session = dict(
+        subject='01', task='somato', sex=1,
+        raw=op.join(fif_path, 'sef_raw_sss.fif'),
+        t1w=op.join(somato_path, 'subjects', 'somato', 'mri', 'T1.mgz'),
+        trans=op.join(fif_path, 'sef_raw_sss-trans.fif'),
+        forward=op.join(fif_path, 'somato-meg-oct-6-fwd.fif'))
+    description = dict(
+        Name='MNE-somato-data-bids', Authors=['Lauri Parkkonen'],
+        License='PDDL, see: https://opendatacommons.org/licenses/pddl/',
+        ReferencesAndLinks=['https://mne.tools/stable/overview/datasets_index.html#somatosensory'],  # noqa: E501
+        Acknowledgements="Stefan Appelhoff, Alexandre Gramfort, and Mainak Jas formatted these data to BIDS.")  # noqa: E501
+    return dict(bids_root=op.join(somato_parent, somato_name + '-bids'),
+                sessions=[session], dataset_description=description)
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Convert many sessions to BIDS in parallel.')
+    parser.add_argument('sessions', nargs='?', default=None,
+                        help='JSON file describing the sessions')
+    parser.add_argument('--somato', action='store_true',
+                        help='convert the MNE-somato-data')
+    parser.add_argument('--n-jobs', type=int, default=os.cpu_count(),
+                        help='processes for FreeSurfer and the BEM')
+    parser.add_argument('--n-io', type=int, default=4,
+                        help='threads for reading and writing files')
+    parser.add_argument('--link', action='store_true',
+                        help='hard link or reflink the raw files and the '
+                             'forward solutions instead of copying them')
+    parser.add_argument('--manifest', default=None,
+                        help='manifest of the finished tasks, defaults to '
+                             'code/conversion_manifest.json in the BIDS '
+                             'root')
+    args = parser.parse_args()
+    if args.somato:
+        config = somato_sessions()
+    elif args.sessions is not None:
+        with open(args.sessions) as fid:
+            config = json.load(fid)
+    else:
+        parser.error('Give a sessions file or --somato')
+    if os.getenv('FREESURFER_HOME') is None:
+        raise RuntimeError('You need to define a FREESURFER_HOME environment '
+                           'variable pointing to your installation of '
+                           'FreeSurfer.')
+
+    bids_root = config['bids_root']
+    manifest = Manifest(args.manifest or op.join(
+        bids_root, 'code', 'conversion_manifest.json'))
+    tasks = make_tasks(bids_root, config['sessions'],
+                       config.get('dataset_description'), link=args.link)
+    failed = run_tasks(tasks, manifest, args.n_jobs, args.n_io)
+    if failed:
+        for name, error in sorted(failed.items()):
+            print('%s: %s' % (name, error))
+        raise SystemExit('%d tasks failed, run again to resume'
+                         % len(failed))
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
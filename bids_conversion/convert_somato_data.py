@@ -35,17 +35,54 @@ Helpful links
 import os
 import os.path as op
 import shutil as sh
-import json
+import sys
 
-import numpy as np
-
-import mne
-from mne.utils import check_version, run_subprocess
+from mne.utils import check_version
 import mne.datasets.somato as somato
 
-from mne_bids import write_raw_bids, make_bids_basename, write_anat
 from mne_bids.utils import print_dir_tree
 
+# The conversion steps are shared with the batch converter, which is copied
+# into the BIDS dataset along with this script
+sys.path.insert(0, op.dirname(op.realpath(__file__)))
+from batch_convert import (somato_sessions, convert_raw, convert_anat,  # noqa
+                           recon_all, make_scalp_surfaces, watershed_bem,
+                           make_bem, convert_forward, update_description)
+
+# The profiling module of the sample-data scripts is only available next to
+# them, not in the copy of this script stored in the BIDS dataset
+try:
+    sys.path.insert(0, op.join(op.dirname(op.realpath(__file__)), '..',
+                               'sample-data'))
+    from profiling import StageProfiler, write_report, print_summary
+except ImportError:
+    StageProfiler = None
+
+# If the MNE_SCRIPTS_LINK environment variable is set, the raw file and the
+# forward are reflinked into the BIDS dataset when the file system allows it
+# instead of being rewritten, see placement.py
+link = bool(os.getenv('MNE_SCRIPTS_LINK'))
+
+# Measure the resources used by each step, the report is written to
+# the file given by the MNE_SCRIPTS_PROFILE environment variable if it is set
+profilers = list()
+
+
+class _NoProfiler(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def profile(name):
+    if StageProfiler is None:
+        return _NoProfiler()
+    profilers.append(StageProfiler(name))
+    return profilers[-1]
+
+
 # Create READMEs for the BIDS dataset
 # Prepare the text for the central README
 main_readme = """MNE-somato-data-bids
@@ -92,7 +129,8 @@ label.
 # Prepare the text for the README in the /code directory
 code_readme = """`convert_somato_data.py` is a Python script that converts the
 MNE-somato-data into BIDS format. See https://bids.neuroimaging.io for more
-information.
+information. It runs the conversion steps of `batch_convert.py`, which uses
+`freesurfer.py` and `placement.py`, all stored next to it.
 
 For installation, we recommend the Anaconda distribution. find the installation
 guide here: https://docs.anaconda.com/anaconda/install/
@@ -136,67 +174,30 @@ print('\nSomato data before conversion: {}\n'.format(somato_path))
 print_dir_tree(somato_path, max_depth=3)
 print('\n\n')
 
-# Convert to BIDS
-# Path to the raw data of somato dataset
-fif_path = op.join(somato_path, 'MEG', 'somato')
-
-# Load the raw data file
-raw = mne.io.read_raw_fif(op.join(fif_path, 'sef_raw_sss.fif'))
-
-# Set the sex of the participant to male
-# Subject sex (0=unknown, 1=male, 2=female).
-raw.info['subject_info']['sex'] = raw.info['subject_info'].get('sex', 1)
-
-# Get the events, and assign an ID
-events = mne.find_events(raw)
-event_id = dict()
-for val in np.unique(events[:, -1]):
-    event_id['somato_event{}'.format(val)] = val
-
-print('\n\n')
-print('event_id: "{}"'.format(event_id))
-
-# Make a bids name for the raw file
-bids_basename = make_bids_basename(subject='01', task='somato')
+# The paths of the somato data, the location of the BIDS dataset and the
+# fields of its dataset_description.json
+config = somato_sessions()
+session = config['sessions'][0]
+somato_path_bids = config['bids_root']
 
-# Make a location for the BIDS formatted data
-somato_parent, somato_name = op.split(somato_path)
-somato_path_bids = op.join(somato_parent, somato_name + '-bids')
-
-# Write the data
-write_raw_bids(raw, bids_basename, somato_path_bids, events, event_id,
-               overwrite=True)
+# Convert to BIDS
+# Read the raw data, set the sex of the participant to male, get the events
+# and write the data. The event IDs are named somato_event<ID>
+with profile('write_raw_bids'):
+    convert_raw(somato_path_bids, session['subject'], None, session['task'],
+                None, session['raw'], sex=session['sex'], link=link)
 
 # Edit dataset_description.json to include link to dataset
-dataset_description_json = op.join(somato_path_bids,
-                                   'dataset_description.json')
-with open(dataset_description_json, 'r') as fin:
-    jsondict = json.load(fin)
-
-# Edit some fields we know of
-jsondict['Name'] = 'MNE-somato-data-bids'
-jsondict['Authors'] = ['Lauri Parkkonen']
-jsondict['License'] = 'PDDL, see: https://opendatacommons.org/licenses/pddl/'
-jsondict['ReferencesAndLinks'] = ['https://mne.tools/stable/overview/datasets_index.html#somatosensory']  # noqa: E501
-jsondict['Acknowledgements'] = "Stefan Appelhoff, Alexandre Gramfort, and Mainak Jas formatted these data to BIDS."   # noqa: E501
-
-# overwrite the json, updating it
-with open(dataset_description_json, 'w') as fout:
-    json.dump(jsondict, fout, indent=2, sort_keys=True)
+update_description(somato_path_bids, config['dataset_description'])
 
 # Write anatomical data to BIDS
-# we take the original T1 from the FreeSurfer directory
-t1w = op.join(somato_path, 'subjects', 'somato', 'mri', 'T1.mgz')
-
-# we also take the trans file, and use it to write the coordinates of
-# anatomical landmarks to a T1w.json file
-trans = op.join(somato_path, 'MEG', 'somato', 'sef_raw_sss-trans.fif')
-
-# Copy over the MRI, convert it to NIfTI format, and write the anatomical
-# landmarks in voxel coordinates
-anat_dir = write_anat(somato_path_bids, subject='01', t1w=t1w, trans=trans,
-                      raw=raw, overwrite=True, verbose=True)
-t1w_nii = op.join(anat_dir, 'sub-01_T1w.nii.gz')
+# we take the original T1 from the FreeSurfer directory, and the trans file
+# to write the coordinates of anatomical landmarks to a T1w.json file. The
+# MRI is converted to NIfTI format, and the landmarks written in voxel
+# coordinates
+with profile('write_anat'):
+    convert_anat(somato_path_bids, session['subject'], None, session['t1w'],
+                 session['trans'], session['raw'])
 
 # Add derivatives
 # not all of this is defined in BIDS as of yet
@@ -204,45 +205,29 @@ t1w_nii = op.join(anat_dir, 'sub-01_T1w.nii.gz')
 derivatives_dir = op.join(somato_path_bids, 'derivatives')
 subjects_dir_bids = op.join(derivatives_dir, 'freesurfer', 'subjects')
 
-# Export the FreeSurfer SUBJECTS_DIR as environment variable, available to
-# this process and all subprocesses
-os.environ['SUBJECTS_DIR'] = subjects_dir_bids
-
 # Run recon-all from FreeSurfer
-run_subprocess(['recon-all', '-i', t1w_nii, '-s', '01', '-all'])
+with profile('recon-all'):
+    recon_all(somato_path_bids, subjects_dir_bids, '01', None)
 
-# Run make_scalp_surfaces ... use --force to prevent an error from
+# Run make_scalp_surfaces ... with --force to prevent an error from
 # topology defects
-run_subprocess(['mne', 'make_scalp_surfaces', '-s', '01', '--overwrite',
-                '--force'])
+with profile('make_scalp_surfaces'):
+    make_scalp_surfaces(subjects_dir_bids, '01')
 
 # Run watershed_bem
-run_subprocess(['mne', 'watershed_bem', '-s', '01', '--overwrite'])
+with profile('watershed_bem'):
+    watershed_bem(subjects_dir_bids, '01')
 
 # Make BEM
-model = mne.make_bem_model('01', conductivity=(0.3,), verbose=True)
-mne.write_bem_surfaces(
-    op.join(subjects_dir_bids, '01', 'bem', '01-5120-bem.fif'), model)
-bem = mne.make_bem_solution(model, verbose=True)
-mne.write_bem_solution(
-    op.join(subjects_dir_bids, '01', 'bem', '01-5120-bem-sol.fif'), bem)
-
-# Make a directory for our subject and move the forward model there
-# NOTE: We need to adjust the subject id
-sub_deri_dir = op.join(derivatives_dir, 'sub-01')
-if not op.exists(sub_deri_dir):
-    os.makedirs(sub_deri_dir)
-
-old_forward = op.join(somato_path, 'MEG', 'somato',
-                      'somato-meg-oct-6-fwd.fif')
+with profile('bem'):
+    make_bem(subjects_dir_bids, '01')
 
-fwd = mne.read_forward_solution(old_forward)
-for ss in fwd['src']:
-    ss['subject_his_id'] = '01'
-
-# Save the fwd object with adjusted subject id, overwriting existing files
-bids_forward = op.join(sub_deri_dir, 'sub-01_task-somato-fwd.fif')
-mne.write_forward_solution(bids_forward, fwd, overwrite=True)
+# Put the forward model in a directory for our subject
+# NOTE: We need to adjust the subject id
+with profile('forward'):
+    convert_forward(session['forward'],
+                    op.join(derivatives_dir, 'sub-01',
+                            'sub-01_task-somato-fwd.fif'), '01', link=link)
 
 # Prepare a /code directory to put a README there
 code_dir = op.join(somato_path_bids, 'code')
@@ -258,12 +243,20 @@ for fname, txt in zip((changes_fname, main_fname, code_fname),
     with open(fname, 'w') as fout:
         print(txt, file=fout)  # noqa: E999
 
-# Finally, copy over THIS Python script as well
-basename = op.basename(__file__)
-fpath = op.realpath(__file__)
-sh.copyfile(fpath, op.join(code_dir, basename))
+# Finally, copy over THIS Python script as well, with the modules it uses
+for basename in (op.basename(__file__), 'batch_convert.py', 'freesurfer.py',
+                 'placement.py'):
+    sh.copyfile(op.join(op.dirname(op.realpath(__file__)), basename),
+                op.join(code_dir, basename))
 
 # And show what the converted data look like
 print('\nSomato BIDS data: {}\n'.format(somato_path_bids))
 print_dir_tree(somato_path_bids, max_depth=5)
 print('\n\n')
+
+# Report the resources used by each step
+if profilers:
+    records = [profiler.record for profiler in profilers]
+    print_summary(records)
+    if os.getenv('MNE_SCRIPTS_PROFILE'):
+        write_report(os.getenv('MNE_SCRIPTS_PROFILE'), records)
@@ -0,0 +1,51 @@
+"""Start or resume FreeSurfer reconstructions.
+
+:func:`recon_all_command` is shared by the BIDS conversion and by
+``sample-data/recon.py``, so that both start ``recon-all`` over again or
+resume it in the same situations.
+"""
+# License: BSD (3-clause)
+import glob
+import os
+import os.path as op
+import shutil
+
+
+def recon_all_command(subjects_dir, subject, image):
+    """The recon-all command reconstructing a subject, resuming if possible.
+
+    A reconstruction is resumed with ``-make all`` once its input is
+    imported (``mri/orig/001.mgz``), after removing the lock files that
+    would stop ``recon-all``. Otherwise the subject directory, which
+    ``recon-all -i`` refuses to start over and which a run interrupted
+    before importing its input leaves behind, is removed and the
+    reconstruction starts from ``image``.
+
+    Parameters
+    ----------
+    subjects_dir : str
+        The FreeSurfer subjects directory, made if it does not exist.
+    subject : str
+        The subject name.
+    image : str
+        The T1 image given to ``recon-all -i``.
+
+    Returns
+    -------
+    command : list of str
+        The ``recon-all`` command.
+    """
+    if not op.isdir(subjects_dir):
+        os.makedirs(subjects_dir)
+    subject_dir = op.join(subjects_dir, subject)
+    command = ['recon-all', '-s', subject]
+    if op.isfile(op.join(subject_dir, 'mri', 'orig', '001.mgz')):
+        for fname in glob.glob(op.join(subject_dir, 'scripts',
+                                       'IsRunning.*')):
+            os.remove(fname)
+        command += ['-make', 'all']
+    else:
+        if op.isdir(subject_dir):
+            shutil.rmtree(subject_dir)
+        command += ['-all', '-i', image]
+    return command
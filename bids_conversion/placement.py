@@ -0,0 +1,218 @@
+"""Place large files in a BIDS tree without duplicating their content.
+
+:func:`place_file` gives a destination the content of a source file by a
+reflink (a copy-on-write clone, on Btrfs, XFS and similar file systems),
+and by a streaming copy if the file system does not support reflinks.
+Hard links, which make the destination share the source, are only made
+when they are asked for.
+
+:func:`patch_fif_strings` changes string tags of a FIF file, such as the
+``subject_his_id`` of the source spaces of a forward solution, at the tag
+level: the other tags are copied as raw bytes, so that the gain matrix is
+never read into memory. If the new strings have the same length as the old
+ones, the destination is a reflink or a copy of the source that is patched
+in place.
+"""
+# License: BSD (3-clause)
+import errno
+import os
+import os.path as op
+import shutil
+import struct
+
+from mne.io.constants import FIFF
+
+_FICLONE = 0x40049409  # ioctl request of Linux reflinks
+_FIFF_DIR = 102  # the tag directory, not in the constants of mne
+_COPY_BUFSIZE = 16 * 1024 * 1024
+
+
+def _reflink(src, dst):
+    """Clone a file, raise OSError if the file system does not support it."""
+    import fcntl
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+        except (IOError, OSError):
+            fout.close()
+            os.remove(dst)
+            raise
+
+
+def _stream_copy(src, dst):
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, _COPY_BUFSIZE)
+    shutil.copystat(src, dst)
+
+
+def place_file(src, dst, methods=('reflink', 'copy')):
+    """Give a file the content of another one, avoiding copies.
+
+    Parameters
+    ----------
+    src : str
+        The source file.
+    dst : str
+        The destination, replaced if it exists.
+    methods : list of str
+        The methods tried in turn among ``'reflink'`` (copy-on-write clone),
+        ``'copy'`` and ``'link'`` (hard link, only used if given: the
+        destination then shares the source, so modifying one in place
+        modifies the other).
+
+    Returns
+    -------
+    method : str
+        The method that was used.
+    """
+    dirname = op.dirname(dst)
+    if dirname and not op.isdir(dirname):
+        os.makedirs(dirname)
+    if op.realpath(src) == op.realpath(dst):
+        raise ValueError('%s cannot be placed onto itself' % src)
+    if op.lexists(dst):
+        if 'link' in methods and op.exists(dst) and op.samefile(src, dst):
+            return 'link'
+        # a hard link of the source is replaced by a reflink or a copy
+        os.remove(dst)
+    for method in methods:
+        try:
+            if method == 'link':
+                os.link(src, dst)
+            elif method == 'reflink':
+                _reflink(src, dst)
+            elif method == 'copy':
+                _stream_copy(src, dst)
+            else:
+                raise ValueError('Unknown placement method %s' % method)
+            return method
+        except (IOError, OSError) as exp:
+            if method == 'copy' or exp.errno not in (
+                    errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY,
+                    errno.EINVAL, errno.EMLINK, errno.ENOSYS):
+                raise
+    raise RuntimeError('Could not place %s with %s' % (src, methods))
+
+
+def _iter_tags(fid):
+    """Yield (position, kind, type, size, next) of the tags of a FIF file."""
+    fid.seek(0, 2)
+    file_size = fid.tell()
+    pos = 0
+    while pos < file_size:
+        fid.seek(pos)
+        header = fid.read(16)
+        if len(header) < 16:
+            break
+        kind, type_, size, next_ = struct.unpack('>iIii', header)
+        if next_ > 0:
+            raise ValueError('Tags with explicit positions are not supported, '
+                             'the file needs to be rewritten with mne')
+        yield pos, kind, type_, size, next_
+        if next_ == FIFF.FIFFV_NEXT_NONE:
+            break
+        pos += 16 + size
+
+
+def _find_patches(fid, kind, value, blocks):
+    """Positions and sizes of the string tags to patch."""
+    value = value.encode('utf-8')
+    stack, patches = list(), list()
+    for pos, this_kind, type_, size, _ in _iter_tags(fid):
+        if this_kind == FIFF.FIFF_BLOCK_START:
+            fid.seek(pos + 16)
+            stack.append(struct.unpack('>i', fid.read(4))[0])
+        elif this_kind == FIFF.FIFF_BLOCK_END:
+            stack.pop()
+        elif this_kind == kind and (blocks is None or
+                                    set(stack) & set(blocks)):
+            if type_ != FIFF.FIFFT_STRING:
+                raise ValueError('Tag %d at %d is not a string' % (kind, pos))
+            patches.append((pos, size, value))
+    if not patches:
+        raise ValueError('No tag of kind %d found' % kind)
+    return patches
+
+
+def _copy_range(fin, fout, start, stop):
+    fin.seek(start)
+    while start < stop:
+        buf = fin.read(min(_COPY_BUFSIZE, stop - start))
+        if not buf:
+            raise IOError('Unexpected end of file')
+        fout.write(buf)
+        start += len(buf)
+
+
+def _rewrite(src, dst, patches):
+    """Copy a FIF file tag by tag, replacing the patched tags."""
+    patches = dict((pos, value) for pos, _, value in patches)
+    tmp = dst + '.tmp'
+    with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+        for pos, kind, type_, size, next_ in _iter_tags(fin):
+            if kind == _FIFF_DIR:
+                # The positions changed, mne scans the tags instead
+                continue
+            elif kind == FIFF.FIFF_DIR_POINTER:
+                fout.write(struct.pack('>iIiii', kind, type_, 4, next_, -1))
+            elif pos in patches:
+                fout.write(struct.pack('>iIii', kind, type_,
+                                       len(patches[pos]), next_))
+                fout.write(patches[pos])
+            else:
+                _copy_range(fin, fout, pos, pos + 16 + size)
+    shutil.copystat(src, tmp)
+    os.rename(tmp, dst)
+
+
+def patch_fif_strings(src, dst, kind, value, blocks=None):
+    """Write a FIF file with the value of string tags changed.
+
+    Parameters
+    ----------
+    src : str
+        The FIF file to read. It is only modified if it is ``dst``.
+    dst : str
+        The FIF file to write.
+    kind : int
+        The kind of the tags to change, e.g. ``FIFF.FIFF_SUBJ_HIS_ID``.
+    value : str
+        The new value of all the tags of this kind (within ``blocks``).
+        Tags cannot be added, a ValueError is raised if there are none.
+    blocks : list of int | None
+        Only change the tags inside these blocks, e.g.
+        ``[FIFF.FIFFB_MNE_SOURCE_SPACE]``.
+
+    Returns
+    -------
+    method : str
+        ``'in-place'`` if the strings kept their length, and the tags were
+        overwritten in a reflink or copy of the source (or in the source
+        itself, and thus in its hard links, if it is ``dst``), ``'rewrite'``
+        if the file was rewritten tag by tag.
+    """
+    if src.endswith('.gz'):
+        raise ValueError('Compressed FIF files cannot be patched')
+    with open(src, 'rb') as fid:
+        patches = _find_patches(fid, kind, value, blocks)
+    if all(size == len(value) for _, size, value in patches):
+        if not (op.exists(dst) and op.samefile(src, dst)):
+            place_file(src, dst, methods=('reflink', 'copy'))
+        with open(dst, 'r+b') as fid:
+            for pos, _, value in patches:
+                fid.seek(pos + 16)
+                fid.write(value)
+        return 'in-place'
+    _rewrite(src, dst, patches)
+    return 'rewrite'
+
+
+def set_forward_subject(src, dst, subject):
+    """Write a forward solution whose source spaces belong to ``subject``.
+
+    This is equivalent to reading the forward, setting ``subject_his_id``
+    of its source spaces and writing it, without loading it. A ValueError
+    is raised if the source spaces have no subject to change.
+    """
+    return patch_fif_strings(src, dst, FIFF.FIFF_SUBJ_HIS_ID, subject,
+                             blocks=[FIFF.FIFFB_MNE_SOURCE_SPACE])
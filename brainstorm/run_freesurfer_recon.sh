@@ -16,6 +16,13 @@ then
     mkdir -p ${BRAINSTORM_DATA}
 fi
 CUR_DIR=$(pwd)
+SCRIPTS_DIR=$(cd $(dirname $0) && pwd)
+# options of recon.py, e.g. RECON_ARGS="--n-jobs 3 --mem 12"
+RECON_ARGS=${RECON_ARGS:-}
+# options of fetch.py, e.g. FETCH_ARGS="--n-jobs 4"
+FETCH_ARGS=${FETCH_ARGS:-}
+# options of package.py pack, e.g. PACK_ARGS="--n-jobs 8"
+PACK_ARGS=${PACK_ARGS:-}
 
 # directory for downloading the data
 TMPDIR=$1/TMP
@@ -25,19 +32,14 @@ then
 fi
 cd ${TMPDIR}
 
-# Download the data
-for FNAME in sample_auditory sample_raw sample_resting
-do
-    if [ ! -f ${FNAME}.zip ];
-    then
-        wget -O ${FNAME}.zip http://neuroimage.usc.edu/bst/getupdate.php?u=mne\&s=${FNAME}
-    fi
-
-    if [ ! -d ${FNAME} ];
-    then
-        unzip ${FNAME}.zip
-    fi
-done
+# Download and extract the data, converting each CTF recording to FIF as
+# soon as it is extracted. Set BST_SOURCE to a directory holding the zip
+# files to use it instead of the network
+BST_SOURCE=${BST_SOURCE:-"http://neuroimage.usc.edu/bst/getupdate.php?u=mne&s={stem}"}
+python ${SCRIPTS_DIR}/../sample-data/fetch.py ${TMPDIR} \
+    sample_auditory.zip sample_raw.zip sample_resting.zip \
+    --source "${BST_SOURCE}" --rename Data=data --rename Anatomy=anatomy \
+    --remove-ds ${FETCH_ARGS} || exit 1
 
 # Create subject directory
 export SUBJECTS_DIR=${BRAINSTORM_DATA}/subjects
@@ -48,72 +50,23 @@ then
     mkdir -p ${SUBJECTS_DIR}
 fi
 
+# run recon-all, the watershed BEM and the head surface of the subjects
+# concurrently, running the script again resumes the unfinished subjects
+python ${SCRIPTS_DIR}/../sample-data/recon.py ${SUBJECTS_DIR} \
+    bst_auditory=${TMPDIR}/sample_auditory/anatomy/mri/T1.mgz \
+    bst_raw=${TMPDIR}/sample_raw/anatomy/mri/T1.mgz \
+    bst_resting=${TMPDIR}/sample_resting/anatomy/mri/T1.mgz \
+    --log-dir ${BRAINSTORM_DATA}/logs ${RECON_ARGS} || exit 1
+
+# archive the recordings and the subject of each dataset straight from
+# where they are, compressing with several threads, identical files being
+# stored once and each archive indexed in a manifest of its files
+BUNDLES=""
 for ARCHIVE in auditory raw resting
 do
-
-    # make the name of the Data/data directory always lower case
-    if [ -d ${TMPDIR}/sample_${ARCHIVE}/Data ];
-    then
-        mv ${TMPDIR}/sample_${ARCHIVE}/Data ${TMPDIR}/sample_${ARCHIVE}/data
-    fi
-
-    # Make the MEG directory
-    # Convert CTF to FIF
-    cd ${TMPDIR}/sample_${ARCHIVE}/data
-
-    # convert to ctf
-    for FNAME in `ls -d *.ds`
-    do
-        echo ${FNAME%.*}
-        FIF_FNAME=${FNAME%.*}_raw.fif
-        if [ ! -f $FIF_FNAME ];
-        then
-            ORIG_FNAME=${TMPDIR}/sample_${ARCHIVE}/data/${FNAME}
-            mne_ctf2fiff --ds ${ORIG_FNAME} --fif ${FIF_FNAME}
-            rm -rf ${ORIG_FNAME}
-        fi
-    done
-
-    # make the name of the Anatomy/anatomy directory always lower case
-    if [ -d ${TMPDIR}/sample_${ARCHIVE}/Anatomy ];
-    then
-        mv ${TMPDIR}/sample_${ARCHIVE}/Anatomy ${TMPDIR}/sample_${ARCHIVE}/anatomy
-    fi
-
-    # run recon-all
-    export SUBJECT=bst_${ARCHIVE}
-    recon-all -all -i ${TMPDIR}/sample_${ARCHIVE}/anatomy/mri/T1.mgz -s ${SUBJECT}
-
-    # remove fsaverage symlinks
-    find ${SUBJECTS_DIR}/${SUBJECT} -type l -exec rm -rf {} \;
-
-    # use watershed algorithm to make BEM surfaces
-    if [ ! -f ${SUBJECTS_DIR}/${SUBJECT}/bem/${SUBJECT}-inner-skull.surf ];
-    then
-        cd ${SUBJECTS_DIR}/${SUBJECT}/bem
-        mne_watershed_bem
-        ln -s watershed/${SUBJECT}_inner_skull_surface ${SUBJECT}-inner_skull.surf
-        ln -s watershed/${SUBJECT}_outer_skin_surface ${SUBJECT}-outer_skin.surf
-        ln -s watershed/${SUBJECT}_outer_skull_surface ${SUBJECT}-outer_skull.surf
-    fi
-
-    # Make high resolution head surface
-    HEAD_FNAME=${SUBJECTS_DIR}/${SUBJECT}/bem/${SUBJECT}-head.fif
-    if [ ! -f ${HEAD_FNAME} ];
-    then
-        mkheadsurf -s ${SUBJECT}
-        mne_surf2bem --surf ${SUBJECTS_DIR}/${SUBJECT}/surf/lh.seghead --id 4 --check --fif ${HEAD_FNAME}
-    fi
-
-    # cleanup and archive
-    if [ ! -d ${BRAINSTORM_DATA}/bst_${ARCHIVE} ];
-    then
-        mkdir -p ${BRAINSTORM_DATA}/bst_${ARCHIVE}/MEG
-        mkdir -p ${BRAINSTORM_DATA}/bst_${ARCHIVE}/subjects
-    fi
-    cp -a ${TMPDIR}/sample_${ARCHIVE}/data/ ${BRAINSTORM_DATA}/bst_${ARCHIVE}/MEG
-    cp -a ${BRAINSTORM_DATA}/subjects/bst_${ARCHIVE} ${BRAINSTORM_DATA}/bst_${ARCHIVE}/subjects
-    mv ${BRAINSTORM_DATA}/bst_${ARCHIVE}/MEG/data ${BRAINSTORM_DATA}/bst_${ARCHIVE}/MEG/bst_${ARCHIVE}
-    cd ${BRAINSTORM_DATA}
-    tar -cjvf bst_${ARCHIVE}.tar.bz2 bst_${ARCHIVE}
+    BUNDLES="${BUNDLES} --bundle bst_${ARCHIVE}"
+    BUNDLES="${BUNDLES} bst_${ARCHIVE}/MEG/bst_${ARCHIVE}=${TMPDIR}/sample_${ARCHIVE}/data"
+    BUNDLES="${BUNDLES} bst_${ARCHIVE}/subjects/bst_${ARCHIVE}=${SUBJECTS_DIR}/bst_${ARCHIVE}"
 done
+python ${SCRIPTS_DIR}/../sample-data/package.py pack ${BRAINSTORM_DATA} \
+    ${BUNDLES} ${PACK_ARGS} || exit 1
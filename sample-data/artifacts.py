@@ -0,0 +1,190 @@
+"""Detect events and compute ECG/EOG projectors with few passes on the data.
+
+``compute_proj_ecg``, ``compute_proj_eog`` and ``find_events`` each load
+and filter the whole recording. Here the raw file is read sequentially a
+single time, keeping only the few channels needed for detection: the ECG
+channel, the EOG channels and the stim channel. QRS complexes, blinks and
+stim transitions are detected on these traces, and the projectors are
+then computed from the epochs around the detected events, each epoch
+being read and band-pass filtered on its own with enough padding to match
+the filtering of the continuous data. Only the sum of the covariances of
+the epochs is kept, so a single epoch is in memory at a time.
+"""
+# License: BSD (3-clause)
+import numpy as np
+from scipy.signal import fftconvolve
+
+import mne
+from mne.event import _find_events, _find_unique_events
+from mne.io.pick import channel_indices_by_type
+from mne.io.proj import make_projector
+from mne.proj import _compute_proj
+from mne.preprocessing import peak_finder
+from mne.preprocessing.ecg import qrs_detector
+from mne.utils import _get_stim_channel
+
+from stream import _fir, _read_padded
+
+
+def _read_traces(raw, picks, chunk_duration):
+    """Read the given channels for the whole recording, chunk by chunk."""
+    n_times = raw.last_samp - raw.first_samp + 1
+    chunk = int(round(chunk_duration * raw.info['sfreq']))
+    traces = np.empty((len(picks), n_times))
+    for start in range(0, n_times, chunk):
+        stop = min(start + chunk, n_times)
+        traces[:, start:stop] = raw[picks, start:stop][0]
+    return traces
+
+
+def _stim_events(stims, first_samp, shortest_event):
+    """Find the events of stim channel traces as mne.find_events does."""
+    events = list()
+    for stim in stims:
+        stim_events = _find_events(stim[np.newaxis], first_samp)
+        n_short_events = np.sum(np.diff(stim_events[:, 0]) < shortest_event)
+        if n_short_events > 0:
+            raise ValueError('You have %i events shorter than the '
+                             'shortest_event.' % n_short_events)
+        events.append(stim_events)
+    events = _find_unique_events(np.concatenate(events, axis=0))
+    return events[np.argsort(events[:, 0])]
+
+
+def _eog_events(eog, sfreq, l_freq=1., h_freq=10.):
+    """Find blink peaks on the EOG channel with the largest activity."""
+    filt = _fir(sfreq, l_freq, h_freq)
+    eog = fftconvolve(np.pad(eog, ((0, 0), (len(filt) // 2,) * 2),
+                             mode='reflect', reflect_type='odd'),
+                      filt[np.newaxis], mode='valid')
+    eog = eog[np.argmax(np.sqrt(np.sum(eog ** 2, axis=1)))]
+    extrema = 1 if np.abs(np.max(eog)) > np.abs(np.min(eog)) else -1
+    return np.asarray(peak_finder(eog, extrema=extrema)[0], int)
+
+
+def find_artifacts_and_events(raw_fname, ecg_ch, chunk_duration=60.,
+                              shortest_event=2):
+    """Find stim, ECG and EOG events in a single pass over a raw file.
+
+    Parameters
+    ----------
+    raw_fname : str
+        The raw FIF file.
+    ecg_ch : str
+        The channel used to detect the heart beats.
+    chunk_duration : float
+        Duration of the chunks read from the file, in seconds.
+    shortest_event : int
+        Minimum number of samples between stim events, as in
+        :func:`mne.find_events`.
+
+    Returns
+    -------
+    events : array, shape (n_events, 3)
+        The stim channel events, as given by :func:`mne.find_events`.
+    ecg_events : array, shape (n_beats, 3)
+        The heart beats, with id 999.
+    eog_events : array, shape (n_blinks, 3)
+        The blinks, with id 998.
+    """
+    raw = mne.io.Raw(raw_fname, preload=False)
+    sfreq, first_samp = raw.info['sfreq'], raw.first_samp
+    ecg_pick = [raw.ch_names.index(ecg_ch)]
+    eog_picks = list(mne.pick_types(raw.info, meg=False, eog=True,
+                                    exclude=[]))
+    # the stim channels find_events uses: MNE_STIM_CHANNEL, STI 014 or the
+    # first stim channel
+    stim_picks = list(mne.pick_channels(
+        raw.ch_names, include=_get_stim_channel(None, raw.info)))
+    if len(stim_picks) == 0:
+        raise ValueError('No stim channel found to extract event triggers.')
+    traces = _read_traces(raw, ecg_pick + eog_picks + stim_picks,
+                          chunk_duration)
+
+    events = _stim_events(traces[1 + len(eog_picks):], first_samp,
+                          shortest_event)
+    ecg = qrs_detector(sfreq, traces[0], l_freq=5, h_freq=35)
+    ecg_events = np.c_[np.asarray(ecg, int) + first_samp,
+                       np.zeros(len(ecg), int), 999 * np.ones(len(ecg), int)]
+    eog = _eog_events(traces[1:1 + len(eog_picks)], sfreq)
+    eog_events = np.c_[eog + first_samp, np.zeros(len(eog), int),
+                       998 * np.ones(len(eog), int)]
+    return events, ecg_events, eog_events
+
+
+def _epochs_cov(raw, picks, info, events, tmin, tmax, l_freq, h_freq,
+                proj, reject):
+    """Sum the covariances of the band-pass filtered epochs around events.
+
+    Like :class:`mne.Epochs`, the epochs whose peak-to-peak amplitude
+    exceeds ``reject`` for a channel type are left out.
+    """
+    sfreq = raw.info['sfreq']
+    filt = _fir(sfreq, l_freq, h_freq)
+    half = len(filt) // 2
+    first, last = int(round(tmin * sfreq)), int(round(tmax * sfreq)) + 1
+    type_idx = channel_indices_by_type(info)
+    reject = [(type_idx[key], thresh) for key, thresh in
+              (reject or dict()).items() if len(type_idx.get(key, []))]
+    data, n_epochs = np.zeros((len(picks), len(picks))), 0
+    for sample in events[:, 0] - raw.first_samp:
+        epoch = _read_padded(raw, sample + first, sample + last, half)[picks]
+        epoch = fftconvolve(epoch, filt[np.newaxis], mode='valid')
+        if proj is not None:
+            epoch = np.dot(proj, epoch)
+        if any(np.ptp(epoch[idx], axis=1).max() > thresh
+               for idx, thresh in reject):
+            continue
+        data += np.dot(epoch, epoch.T)
+        n_epochs += 1
+    if n_epochs == 0:
+        raise RuntimeError('No good epochs found')
+    return data
+
+
+def _compute_projs(raw, events, tmin, tmax, l_freq, h_freq, reject, bads,
+                   no_proj, desc_prefix, n_grad=2, n_mag=2, n_eeg=2):
+    info = raw.info.copy()
+    info['bads'] = list(bads)
+    if no_proj:
+        info['projs'] = list()
+    picks = mne.pick_types(info, meg=True, eeg=True, exclude='bads')
+    info = mne.pick_info(info, picks)
+    proj = None
+    if info['projs']:
+        proj = make_projector(info['projs'], info['ch_names'])[0]
+    n_times = raw.last_samp - raw.first_samp + 1
+    keep = ((events[:, 0] - raw.first_samp + tmin * info['sfreq'] >= 0) &
+            (events[:, 0] - raw.first_samp + tmax * info['sfreq'] < n_times))
+    data = _epochs_cov(raw, picks, info, events[keep], tmin, tmax, l_freq,
+                       h_freq, proj, reject)
+    # what compute_proj_epochs does with the covariance of the epochs
+    projs = _compute_proj(data, info, n_grad, n_mag, n_eeg, desc_prefix)
+    return list(info['projs']) + projs
+
+
+def compute_artifact_projs(raw_fname, ecg_events, eog_events, bads,
+                           reject=None, ecg_no_proj=False, eog_no_proj=True):
+    """Compute the ECG and EOG projectors from detected events.
+
+    The defaults match those of :func:`mne.preprocessing.compute_proj_ecg`
+    (1-100 Hz, -0.2 to 0.4 s) and
+    :func:`mne.preprocessing.compute_proj_eog` (1-35 Hz, -0.2 to 0.2 s).
+
+    Returns
+    -------
+    ecg_projs : list of Projection
+        The ECG projectors, preceded by those of the raw file unless
+        ``ecg_no_proj`` is True.
+    eog_projs : list of Projection
+        The EOG projectors, preceded by those of the raw file unless
+        ``eog_no_proj`` is True.
+    """
+    raw = mne.io.Raw(raw_fname, preload=False)
+    ecg_projs = _compute_projs(raw, ecg_events, -0.2, 0.4, 1., 100., reject,
+                               bads, ecg_no_proj, 'ECG-%-5.3f-%-5.3f'
+                               % (-0.2, 0.4))
+    eog_projs = _compute_projs(raw, eog_events, -0.2, 0.2, 1., 35., reject,
+                               bads, eog_no_proj, 'EOG-%-5.3f-%-5.3f'
+                               % (-0.2, 0.2))
+    return ecg_projs, eog_projs
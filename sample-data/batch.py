@@ -0,0 +1,303 @@
+"""Run the tutorial pipeline on many subjects sharing the CPUs of a node.
+
+Each subject is a directory laid out like the sample data, optionally
+followed by the subject name (``path/to/dir:subject``, the default subject
+being ``sample``). A subjects file can instead give them as a JSON list of
+objects with the keys ``dir``, ``subject``, ``bads`` and ``ecg_ch``, the
+bad channels and the channel of the heart beats defaulting to those of
+the sample data::
+
+    [{"dir": "/data/sub-01", "bads": ["MEG 0111"], "ecg_ch": "ECG 063"}]
+
+Subjects run as separate ``run_meg_tutorial.py`` processes, each with its
+own work directory, and a global CPU budget is divided between the
+subjects that run concurrently: while there are more subjects waiting
+than CPUs, each one gets ``--min-jobs`` CPUs, and the last subjects of the
+batch get more CPUs as the others finish. The CPUs of a subject are shared
+by its concurrent stages, each using ``--stage-jobs`` of them (by default
+half, so that two stages of a subject overlap). The BLAS and OpenMP
+libraries are limited to one thread per process, as the parallelism comes
+from ``n_jobs``, to avoid oversubscribing the node.
+
+The batch state is written to ``batch.json`` in the output directory, and
+each subject records its finished stages in a checkpoint file, so that
+running the same command after a crash only processes what is left::
+
+    python batch.py ~/batch ~/data/sub-01 ~/data/sub-02:subj02 --n-jobs 32
+"""
+# License: BSD (3-clause)
+import argparse
+import hashlib
+import json
+import os
+import os.path as op
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+_thread_vars = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+_script = op.join(op.dirname(op.abspath(__file__)), 'run_meg_tutorial.py')
+
+
+def cpu_count():
+    """Number of CPUs this process is allowed to run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _available_memory():
+    """Available memory in bytes, None if unknown."""
+    if op.isfile('/proc/meminfo'):
+        with open('/proc/meminfo') as fid:
+            for line in fid:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    return None
+
+
+def allocate_jobs(n_waiting, n_free, min_jobs=2, max_jobs=8):
+    """CPUs given to the next subject.
+
+    The free CPUs are spread evenly over the waiting subjects, within
+    ``[min_jobs, max_jobs]``. Returns 0 if fewer than ``min_jobs`` CPUs
+    are free.
+    """
+    if n_free < min_jobs or n_waiting == 0:
+        return 0
+    return max(min_jobs, min(max_jobs, n_free // n_waiting))
+
+
+def parse_subject(spec):
+    """The name and the options of a subject of the batch.
+
+    ``spec`` is ``directory[:subject]`` or a dict with the keys ``dir``,
+    ``subject``, ``bads`` and ``ecg_ch``, all but ``dir`` being optional.
+    The name identifies the subject in the batch: the directory name,
+    followed by the subject if it is not ``sample`` and by a hash of the
+    directory and subject, so that directories of the same name do not
+    share their state, logs and work directory. The options are the
+    ``sample_dir``, ``subject``, ``bads`` and ``ecg_ch`` of the subject,
+    the last two being None for the defaults of the tutorial.
+    """
+    if not isinstance(spec, dict):
+        sample_dir, subject = spec, 'sample'
+        if ':' in op.basename(spec):
+            sample_dir, subject = spec.rsplit(':', 1)
+        spec = dict(dir=sample_dir, subject=subject)
+    unknown = sorted(set(spec) - set(['dir', 'subject', 'bads', 'ecg_ch']))
+    if unknown:
+        raise ValueError('Unknown keys %s of subject %s' % (unknown, spec))
+    options = dict(sample_dir=op.abspath(spec['dir']),
+                   subject=spec.get('subject', 'sample'),
+                   bads=spec.get('bads'), ecg_ch=spec.get('ecg_ch'))
+    name = op.basename(options['sample_dir'].rstrip(os.sep))
+    if options['subject'] != 'sample':
+        name += '-' + options['subject']
+    key = '%s:%s' % (options['sample_dir'], options['subject'])
+    name += '-' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]
+    return name, options
+
+
+class BatchState(object):
+    """The status of the subjects of a batch, saved after each change."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._lock = threading.Lock()
+        self.subjects = dict()
+        if op.isfile(fname):
+            with open(fname) as fid:
+                self.subjects = json.load(fid)['subjects']
+
+    def done(self, name):
+        return self.subjects.get(name, dict()).get('status') == 'done'
+
+    def update(self, name, **status):
+        with self._lock:
+            self.subjects.setdefault(name, dict()).update(status)
+            tmp = self.fname + '.tmp'
+            with open(tmp, 'w') as fid:
+                json.dump(dict(subjects=self.subjects), fid, indent=2,
+                          sort_keys=True)
+            os.rename(tmp, self.fname)
+
+
+def run_subject(out_dir, name, sample_dir, subject, n_jobs, stage_jobs,
+                stream=False, cache_dir=None, bads=None, ecg_ch=None):
+    """Run the pipeline of a subject in a process, return its exit code."""
+    command = [sys.executable, _script, sample_dir, '--subject', subject,
+               '--n-jobs', str(n_jobs), '--stage-jobs', str(stage_jobs),
+               '--work-dir', op.join(out_dir, name + '-work'),
+               '--report', op.join(out_dir, name + '-report.json'),
+               '--checkpoint', op.join(out_dir, name + '-checkpoint.json')]
+    if bads is not None:
+        command += ['--bads'] + list(bads)
+    if ecg_ch is not None:
+        command += ['--ecg-ch', ecg_ch]
+    if stream:
+        command.append('--stream')
+    if cache_dir is not None:
+        command += ['--cache-dir', cache_dir]
+    env = dict(os.environ)
+    for var in _thread_vars:
+        env[var] = '1'
+    with open(op.join(out_dir, name + '.log'), 'a') as log:
+        return subprocess.call(command, env=env, stdout=log,
+                               stderr=subprocess.STDOUT)
+
+
+def run_batch(out_dir, subjects, n_jobs=None, min_jobs=2, max_jobs=8,
+              stage_jobs=None, mem_per_subject=None, stream=False,
+              cache_dir=None, retry_failed=True):
+    """Process subjects concurrently within a CPU budget.
+
+    Parameters
+    ----------
+    out_dir : str
+        Directory of the batch state, and of the logs, reports,
+        checkpoints and work directories of the subjects.
+    subjects : list of str | dict
+        The subjects, see :func:`parse_subject`.
+    n_jobs : int | None
+        Total number of CPUs. None uses all the CPUs available.
+    min_jobs : int
+        Minimum number of CPUs given to a subject.
+    max_jobs : int
+        Maximum number of CPUs given to a subject, beyond which the stages
+        of a single subject do not scale well.
+    stage_jobs : int | None
+        Number of CPUs used within each stage. None uses half of the CPUs
+        of the subject, so that two of its stages run concurrently.
+    mem_per_subject : float | None
+        Peak memory of a subject in GB. If given, fewer subjects run
+        concurrently when the available memory would be exceeded.
+    stream : bool
+        Use the bounded memory preprocessing of the tutorial.
+    cache_dir : str | None
+        Artifact cache shared by the subjects.
+    retry_failed : bool
+        Whether to run again the subjects that failed in a previous run.
+
+    Returns
+    -------
+    failed : list of str
+        The names of the subjects that failed.
+    """
+    out_dir = op.abspath(out_dir)
+    if not op.isdir(out_dir):
+        os.makedirs(out_dir)
+    n_jobs = cpu_count() if n_jobs is None else n_jobs
+    min_jobs = min(min_jobs, n_jobs)
+    max_concurrent = n_jobs
+    if mem_per_subject is not None and _available_memory() is not None:
+        max_concurrent = max(int(_available_memory() //
+                                 (mem_per_subject * 1e9)), 1)
+
+    state = BatchState(op.join(out_dir, 'batch.json'))
+    waiting, names = list(), set()
+    for spec in subjects:
+        name, options = parse_subject(spec)
+        if name in names:
+            raise ValueError('Subject %s is given twice' % name)
+        names.add(name)
+        if state.done(name):
+            print('Skipping %s, done before' % name)
+        elif (not retry_failed and
+              state.subjects.get(name, dict()).get('status') == 'failed'):
+            print('Skipping %s, failed before' % name)
+        else:
+            waiting.append((name, options))
+
+    running = dict()
+    used = 0
+    failed = list()
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        while waiting or running:
+            while waiting and len(running) < max_concurrent:
+                cost = allocate_jobs(min(len(waiting),
+                                         max_concurrent - len(running)),
+                                     n_jobs - used, min_jobs, max_jobs)
+                if not cost:
+                    break
+                name, options = waiting.pop(0)
+                this_stage_jobs = (max(cost // 2, 1) if stage_jobs is None
+                                   else min(stage_jobs, cost))
+                print('Starting %s (n_jobs=%d, stage_jobs=%d)'
+                      % (name, cost, this_stage_jobs))
+                state.update(name, status='running', n_jobs=cost,
+                             stage_jobs=this_stage_jobs,
+                             start=time.strftime('%Y-%m-%d %H:%M:%S'),
+                             **options)
+                future = executor.submit(
+                    run_subject, out_dir, name, options['sample_dir'],
+                    options['subject'], cost, this_stage_jobs, stream,
+                    cache_dir, options['bads'], options['ecg_ch'])
+                running[future] = (name, cost, time.time())
+                used += cost
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, cost, start = running.pop(future)
+                used -= cost
+                code = future.result()
+                status = 'done' if code == 0 else 'failed'
+                state.update(name, status=status, returncode=code,
+                             wall_time=time.time() - start)
+                if code:
+                    failed.append(name)
+                print('%s %s in %.0f s' % ('Finished' if not code else
+                                           'Failed', name,
+                                           time.time() - start))
+    return failed
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Run the tutorial pipeline on many subjects.')
+    parser.add_argument('out_dir', help='directory of the batch state, logs '
+                                        'and reports')
+    parser.add_argument('subjects', nargs='*',
+                        help='subject directories, as directory[:subject]')
+    parser.add_argument('--subjects-file', default=None,
+                        help='file with one subject directory per line, '
+                             'or a .json list of subjects with their bad '
+                             'channels and ECG channel')
+    parser.add_argument('--n-jobs', type=int, default=None,
+                        help='total number of CPUs, defaults to all')
+    parser.add_argument('--min-jobs', type=int, default=2,
+                        help='minimum number of CPUs per subject')
+    parser.add_argument('--max-jobs', type=int, default=8,
+                        help='maximum number of CPUs per subject')
+    parser.add_argument('--stage-jobs', type=int, default=None,
+                        help='CPUs used within each stage, defaults to '
+                             'half of those of the subject')
+    parser.add_argument('--mem-per-subject', type=float, default=None,
+                        help='peak memory of a subject in GB')
+    parser.add_argument('--stream', action='store_true',
+                        help='bounded memory preprocessing')
+    parser.add_argument('--cache-dir', default=None,
+                        help='artifact cache shared by the subjects')
+    parser.add_argument('--no-retry', action='store_true',
+                        help='do not run again the subjects that failed')
+    args = parser.parse_args()
+    subjects = list(args.subjects)
+    if args.subjects_file is not None:
+        with open(args.subjects_file) as fid:
+            if args.subjects_file.endswith('.json'):
+                subjects += json.load(fid)
+            else:
+                subjects += [line.strip() for line in fid if line.strip()]
+    failed = run_batch(args.out_dir, subjects, args.n_jobs, args.min_jobs,
+                       args.max_jobs, args.stage_jobs, args.mem_per_subject,
+                       args.stream, args.cache_dir,
+                       retry_failed=not args.no_retry)
+    if failed:
+        raise SystemExit('%d subjects failed: %s' % (len(failed),
+                                                     ', '.join(failed)))
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
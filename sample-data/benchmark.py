@@ -0,0 +1,206 @@
+"""Benchmark the forward and inverse stages on synthetic data of varying size.
+
+For each combination of source spacing, number of channels and recording
+duration, a synthetic dataset is generated (see ``synthetic.py``), the
+source space, covariance, forward, sensitivity map and inverse stages of
+the tutorial are run on it and their performance report is written. The
+wall times are then gathered in a table, and the exponent of each size
+parameter is estimated by a log-log least squares fit, to show how each
+stage scales::
+
+    python benchmark.py ~/benchmark --spacings oct4 oct5 oct6 \\
+        --channels 64 128 256 --durations 60 300
+"""
+# License: BSD (3-clause)
+import argparse
+import itertools
+import json
+import os
+import os.path as op
+
+import numpy as np
+
+import mne
+
+from pipeline import Stage, run_stages
+from profiling import read_report
+from synthetic import make_synthetic_dataset
+from gain import gain_fname
+from run_meg_tutorial import (make_source_space, stream_noise_covariance,
+                              make_forward_meg_eeg, make_forward_meg,
+                              make_sensitivity_maps,
+                              make_inverses, _stc_files)
+
+_size_keys = ('n_sources', 'n_channels', 'n_times')
+
+
+def make_benchmark_stages(root, spacing, n_jobs=1):
+    """The tutorial stages that depend on the data size, for a dataset.
+
+    Unlike the sample data, the synthetic sensors have no gradiometers and
+    no projector files, so the sensitivity maps are only computed for the
+    magnetometers and the EEG.
+    """
+    subjects_dir = op.join(root, 'subjects')
+    meg_dir = op.join(root, 'MEG', 'sample')
+    bem_dir = op.join(subjects_dir, 'sample', 'bem')
+
+    def meg(fname):
+        return op.join(meg_dir, fname)
+
+    raw_fname = meg('sample_audvis_raw.fif')
+    cov_fname = meg('audvis.cov')
+    trans = meg('sample_audvis_raw-trans.fif')
+    bem = op.join(bem_dir, 'sample-5120-bem-sol.fif')
+    bem3 = op.join(bem_dir, 'sample-5120-5120-5120-bem-sol.fif')
+    src_fname = op.join(bem_dir, 'sample-%s-bench-src.fif' % spacing)
+    fwds = dict((kind, meg('sample_audvis-%s-fwd.fif' % kind))
+                for kind in ('meg', 'eeg', 'meg-eeg'))
+
+    # no projector files: only the modes mne.sensitivity_map computes
+    # without projectors (EEG uses its average reference)
+    requests = [dict(ch_type='mag', mode='free', tag='', ftype='w'),
+                dict(ch_type='eeg', mode='free', tag='', ftype='w'),
+                dict(ch_type='mag', mode='ratio', tag='-3', ftype='w'),
+                dict(ch_type='eeg', mode='radiality', tag='-radiality')]
+    fname_template = meg('sample_audvis-{ch_type}-fwd-sensmap{tag}')
+    sensmaps = list()
+    for request in requests:
+        sensmaps += _stc_files(fname_template.format(**request),
+                               request.get('ftype', 'stc'))
+
+    specs = [(fwds[kind], cov_fname, meg('sample_audvis-%s-inv.fif' % kind),
+              dict(loose=0.2, diag=False)) for kind in sorted(fwds)]
+
+    return [
+        Stage('source_space', make_source_space, outputs=[src_fname],
+              subject='sample', fname=src_fname, spacing=spacing,
+              n_jobs=n_jobs, add_dist=False),
+        Stage('covariance', stream_noise_covariance, inputs=[raw_fname],
+              outputs=[cov_fname], raw_fname=raw_fname, fname=cov_fname,
+              bads=[]),
+        Stage('forward_meg-eeg', make_forward_meg_eeg,
+              inputs=[raw_fname, trans, src_fname, bem3],
+              outputs=[fwds['meg-eeg'], fwds['eeg'],
+                       gain_fname(fwds['meg-eeg'])],
+              raw_fname=raw_fname, trans=trans, src_fname=src_fname,
+              bem3=bem3, fname=fwds['meg-eeg'], fname_eeg=fwds['eeg'],
+              n_jobs=n_jobs),
+        Stage('forward_meg', make_forward_meg,
+              inputs=[raw_fname, trans, src_fname, bem],
+              outputs=[fwds['meg']],
+              raw_fname=raw_fname, trans=trans, src_fname=src_fname,
+              bem=bem, fname=fwds['meg'], n_jobs=n_jobs),
+        Stage('sensitivity_maps', make_sensitivity_maps,
+              inputs=[gain_fname(fwds['meg-eeg']), raw_fname],
+              outputs=sensmaps, fname_gain=gain_fname(fwds['meg-eeg']),
+              fname_template=fname_template,
+              requests=requests, proj_fnames=[], raw_fname=raw_fname),
+        Stage('inverse', make_inverses,
+              inputs=[raw_fname, cov_fname] + list(fwds.values()),
+              outputs=[spec[2] for spec in specs], raw_fname=raw_fname,
+              specs=specs, n_jobs=n_jobs),
+    ]
+
+
+def _fit_exponents(rows, stage):
+    """Exponents of the size parameters that vary, for the wall time."""
+    keys = [key for key in _size_keys
+            if len(set(row[key] for row in rows)) > 1]
+    if not keys or len(rows) <= len(keys):
+        return dict()
+    X = np.array([[1.] + [np.log(row[key]) for key in keys] for row in rows])
+    y = np.log([max(row['stages'][stage]['wall_time'], 1e-3)
+                for row in rows])
+    coefs = np.linalg.lstsq(X, y, rcond=None)[0]
+    return dict(zip(keys, coefs[1:]))
+
+
+def print_scaling(rows):
+    """Print the wall times of each configuration and the fitted exponents."""
+    stages = list(rows[0]['stages'])
+    print('%-8s %7s %6s %8s ' % ('Spacing', 'Sources', 'Chans', 'Times') +
+          ' '.join('%10s' % name[:10] for name in stages))
+    for row in rows:
+        print('%-8s %7d %6d %8d ' % (row['spacing'], row['n_sources'],
+                                     row['n_channels'], row['n_times']) +
+              ' '.join('%10.1f' % row['stages'][name]['wall_time']
+                       for name in stages))
+    for name in stages:
+        exponents = _fit_exponents(rows, name)
+        if exponents:
+            print('%-18s ' % name + ', '.join(
+                '%s^%.2f' % (key, value)
+                for key, value in sorted(exponents.items())))
+
+
+def run_benchmark(out_dir, spacings=('oct4', 'oct5'), channels=(64, 256),
+                  durations=(60.,), sfreq=600., n_jobs=1):
+    """Run the benchmark over a grid of data sizes.
+
+    Parameters
+    ----------
+    out_dir : str
+        Directory of the synthetic datasets and of the reports.
+    spacings : list of str
+        Source space spacings.
+    channels : list of int
+        Number of channels, half of them magnetometers and half EEG.
+    durations : list of float
+        Durations of the raw recordings in seconds.
+    sfreq : float
+        Sampling frequency of the raw recordings.
+    n_jobs : int
+        Number of CPUs used by the stages.
+
+    Returns
+    -------
+    rows : list of dict
+        The sizes and the stage records of each configuration, also
+        written to ``scaling.json`` in ``out_dir``.
+    """
+    rows = list()
+    for spacing, n_channels, duration in itertools.product(
+            spacings, channels, durations):
+        tag = '%s-%dch-%ds' % (spacing, n_channels, duration)
+        root = op.join(out_dir, tag)
+        print('Generating %s' % tag)
+        make_synthetic_dataset(root, spacing=spacing,
+                               n_meg=n_channels // 2,
+                               n_eeg=n_channels - n_channels // 2,
+                               duration=duration, sfreq=sfreq)
+        os.environ['SUBJECTS_DIR'] = op.join(root, 'subjects')
+        report = op.join(out_dir, tag + '.json')
+        stages = make_benchmark_stages(root, spacing, n_jobs)
+        run_stages(stages, n_jobs=n_jobs, report=report)
+        src = mne.read_source_spaces(stages[0].outputs[0])
+        rows.append(dict(
+            spacing=spacing, n_sources=sum(s['nuse'] for s in src),
+            n_channels=n_channels, n_times=int(round(duration * sfreq)),
+            stages=dict((rec['name'], rec)
+                        for rec in read_report(report)['stages'])))
+    with open(op.join(out_dir, 'scaling.json'), 'w') as fid:
+        json.dump(rows, fid, indent=2, sort_keys=True)
+    print_scaling(rows)
+    return rows
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the forward and inverse stages on synthetic '
+                    'data of varying size.')
+    parser.add_argument('out_dir', help='directory of the datasets and '
+                                        'reports')
+    parser.add_argument('--spacings', nargs='+', default=['oct4', 'oct5'])
+    parser.add_argument('--channels', nargs='+', type=int,
+                        default=[64, 256])
+    parser.add_argument('--durations', nargs='+', type=float, default=[60.])
+    parser.add_argument('--sfreq', type=float, default=600.)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    args = parser.parse_args()
+    run_benchmark(args.out_dir, args.spacings, args.channels, args.durations,
+                  args.sfreq, args.n_jobs)
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
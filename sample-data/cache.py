@@ -0,0 +1,201 @@
+"""Content-hashed cache of the files written by pipeline stages.
+
+A stage is identified by the hash of its function, its parameters, the
+content of its input files and the version of the packages it depends on.
+When a stage with the same key already ran, its outputs are restored from
+the cache instead of being recomputed. The cache directory is bounded in
+size, least recently used entries being evicted first.
+
+The cache can also wrap shell commands, e.g. from the ``.sh`` scripts,
+the versions of the ``--tools`` being part of the key::
+
+    python cache.py --cache-dir ~/.mne_scripts_cache \\
+        --tools mne_add_patch_info \\
+        --inputs src.fif --outputs src-dist.fif -- \\
+        mne_add_patch_info --src src.fif --srcp src-dist.fif
+"""
+# License: BSD (3-clause)
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import os.path as op
+import shutil
+import subprocess
+import time
+
+_BLOCK_SIZE = 2 ** 20
+
+
+def _hash_file(fname):
+    """Compute the SHA-1 of the content of a file."""
+    h = hashlib.sha1()
+    with open(fname, 'rb') as fid:
+        for block in iter(lambda: fid.read(_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _package_version(name):
+    try:
+        return importlib.import_module(name).__version__
+    except ImportError:
+        return None
+
+
+def _tool_version(name):
+    """The output of ``name --version``, for command line tools."""
+    try:
+        out = subprocess.check_output([name, '--version'],
+                                      stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('utf-8', 'replace').strip()
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, fnames in os.walk(path):
+        for fname in fnames:
+            size += op.getsize(op.join(root, fname))
+    return size
+
+
+class ArtifactCache(object):
+    """Cache of stage outputs keyed on the content of their inputs.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory where the outputs are stored.
+    max_size : float
+        Maximum size of the cache directory in GB. Least recently used
+        entries are removed once it is exceeded.
+    packages : list of str
+        Packages whose version is part of every key.
+    """
+
+    def __init__(self, cache_dir, max_size=50., packages=('mne',)):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size * 1e9)
+        self.versions = dict((name, _package_version(name))
+                             for name in packages)
+        self._hashes = dict()
+        if not op.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _hash_input(self, fname):
+        """Hash an input file, reusing the hash while it is unmodified."""
+        stat = os.stat(fname)
+        stamp = (stat.st_size, stat.st_mtime)
+        if self._hashes.get(fname, (None,))[0] != stamp:
+            self._hashes[fname] = (stamp, _hash_file(fname))
+        return self._hashes[fname][1]
+
+    def key(self, stage):
+        """Compute the key identifying the result of a stage."""
+        desc = dict(func='%s.%s' % (stage.func.__module__,
+                                    stage.func.__name__),
+                    kwargs=sorted((k, repr(v))
+                                  for k, v in stage.kwargs.items()
+                                  if k != 'n_jobs'),
+                    inputs=[(fname, self._hash_input(fname))
+                            for fname in stage.inputs],
+                    outputs=stage.outputs, versions=self.versions)
+        desc = json.dumps(desc, sort_keys=True).encode('utf-8')
+        return hashlib.sha1(desc).hexdigest()
+
+    def _entry(self, key):
+        return op.join(self.cache_dir, key)
+
+    def restore(self, stage):
+        """Copy the cached outputs of a stage in place.
+
+        Returns
+        -------
+        restored : bool
+            Whether the stage was found in the cache.
+        """
+        entry = self._entry(self.key(stage))
+        if not op.isfile(op.join(entry, 'stage.json')):
+            return False
+        for ii, fname in enumerate(stage.outputs):
+            dirname = op.dirname(fname)
+            if dirname and not op.isdir(dirname):
+                os.makedirs(dirname)
+            shutil.copyfile(op.join(entry, str(ii)), fname)
+        os.utime(op.join(entry, 'stage.json'), None)  # mark as recently used
+        return True
+
+    def store(self, stage):
+        """Copy the outputs of a stage that just ran to the cache."""
+        key = self.key(stage)
+        entry = self._entry(key)
+        tmp = entry + '.tmp'
+        if op.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for ii, fname in enumerate(stage.outputs):
+            shutil.copyfile(fname, op.join(tmp, str(ii)))
+        with open(op.join(tmp, 'stage.json'), 'w') as fid:
+            json.dump(dict(name=stage.name, outputs=stage.outputs,
+                           time=time.time()), fid, indent=2)
+        if op.isdir(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the size limit holds."""
+        entries = list()
+        for key in os.listdir(self.cache_dir):
+            stamp = op.join(self.cache_dir, key, 'stage.json')
+            if op.isfile(stamp):
+                entries.append((op.getmtime(stamp), key,
+                                _dir_size(self._entry(key))))
+        entries.sort()
+        size = sum(entry[2] for entry in entries)
+        for _, key, entry_size in entries:
+            if size <= self.max_size:
+                break
+            shutil.rmtree(self._entry(key))
+            size -= entry_size
+
+
+def run_command(command):
+    """Run a shell command, for stages wrapping command line tools."""
+    subprocess.check_call(command)
+
+
+def run():
+    from pipeline import Stage
+    parser = argparse.ArgumentParser(
+        description='Run a command unless its outputs are in the cache.')
+    parser.add_argument('--cache-dir', required=True)
+    parser.add_argument('--max-size', type=float, default=50.,
+                        help='maximum size of the cache in GB')
+    parser.add_argument('--tools', nargs='*', default=[],
+                        help='command line tools whose version is part of '
+                             'the key')
+    parser.add_argument('--inputs', nargs='*', default=[])
+    parser.add_argument('--outputs', nargs='+', required=True)
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+
+    inputs = [op.abspath(fname) for fname in args.inputs]
+    outputs = [op.abspath(fname) for fname in args.outputs]
+    stage = Stage(command[0], run_command, inputs=inputs, outputs=outputs,
+                  command=command)
+    cache = ArtifactCache(args.cache_dir, args.max_size, packages=())
+    cache.versions.update((name, _tool_version(name)) for name in args.tools)
+    if cache.restore(stage):
+        print('Restored %s from the cache' % ', '.join(args.outputs))
+    else:
+        run_command(command)
+        cache.store(stage)
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
@@ -0,0 +1,287 @@
+"""Fit time-resolved dipoles in parallel, with warm starts and cached guesses.
+
+This gives the same fits as :func:`mne.fit_dipole` for dipoles of free
+position, but:
+
+- the BEM field computation matrices of the sensors, the guess grid inside
+  the inner skull and its forward fields only depend on the BEM, the
+  head<->MRI transform and the channels, and are computed once and saved
+  in a cache directory, to be reused by the later fits, e.g. of other
+  conditions. The fields are whitened and decomposed when loaded, for all
+  guesses at once.
+- the time points are split in contiguous segments fitted by a pool of
+  processes, and within a segment each fit starts from the optimum of the
+  previous time point when it fits the data better than the best guess,
+  with a smaller initial step, which saves most of the optimizer
+  iterations on smooth data.
+
+Example::
+
+    fitter = DipoleFitter(evoked.info, cov, bem, trans, cache_dir='guesses')
+    for evoked in evokeds:
+        dip, residual = fitter.fit(evoked, n_jobs=8)
+"""
+# License: BSD (3-clause)
+import hashlib
+import os
+import os.path as op
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+import mne
+from mne.bem import _fit_sphere, _bem_find_surface
+from mne.cov import compute_whitener
+from mne.dipole import (Dipole, _make_guesses, _dipole_forwards, _fit_eval,
+                        _fit_Q, _fit_confidence, _surface_constraint,
+                        _sphere_constraint)
+from mne.forward._make_forward import (_get_trans, _setup_bem,
+                                       _prep_meg_channels, _prep_eeg_channels)
+from mne.forward._compute_forward import _prep_field_computation
+from mne.io.pick import pick_types, channel_type
+from mne.io.proj import make_projector
+from mne.surface import transform_surface_to
+from mne.transforms import apply_trans
+
+# as in mne.fit_dipole
+_GUESS_GRID = 0.02
+_GUESS_EXCLUDE = 0.02
+_RHOBEG = 5e-2
+_WARM_RHOBEG = 1e-2
+_RHOEND = 5e-5
+
+
+def _guess_key(info, bem, trans, min_dist):
+    """Hash of what the guesses depend on, None if it cannot be hashed."""
+    if not isinstance(bem, str) or not (trans is None or
+                                        isinstance(trans, str)):
+        return None
+    h = hashlib.sha1()
+    for fname in (bem, trans):
+        if fname is not None:
+            with open(fname, 'rb') as fid:
+                h.update(fid.read())
+    for ch in info['chs']:
+        if ch['ch_name'] not in info['bads']:
+            h.update(repr((ch['ch_name'], ch['coil_type'], ch['kind'],
+                           ch['loc'].tolist())).encode())
+    h.update(info['dev_head_t']['trans'].tobytes())
+    h.update(repr((min_dist, _GUESS_GRID, _GUESS_EXCLUDE,
+                   mne.__version__)).encode())
+    return h.hexdigest()
+
+
+def _inner_skull(bem, mri_head_t):
+    if bem['is_sphere']:
+        if len(bem.get('layers', [])) == 0:
+            raise ValueError('MEG-only sphere models are not supported, use '
+                             'mne.fit_dipole')
+        return dict(R=bem['layers'][0]['rad'], r0=bem['r0'])
+    inner_skull = _bem_find_surface(bem, 'inner_skull').copy()
+    R, r0 = _fit_sphere(inner_skull['rr'], disp=False)
+    inner_skull['r0'] = apply_trans(mri_head_t['trans'], r0[np.newaxis])[0]
+    return inner_skull
+
+
+def _compute_guesses(info, bem, trans, min_dist, n_jobs):
+    """The field computation data, and the guesses and their fields."""
+    neeg = len(pick_types(info, meg=False, eeg=True, ref_meg=False,
+                          exclude=[]))
+    mri_head_t, _ = _get_trans(trans)
+    bem = _setup_bem(bem, bem if isinstance(bem, str) else repr(bem), neeg,
+                     mri_head_t, verbose=False)
+    inner_skull = _inner_skull(bem, mri_head_t)
+    guess_src = _make_guesses(inner_skull, _GUESS_GRID, _GUESS_EXCLUDE,
+                              max(0.005, min_dist), n_jobs=n_jobs)[0]
+    transform_surface_to(guess_src, 'head', mri_head_t)
+    if 'rr' in inner_skull:
+        transform_surface_to(inner_skull, 'head', mri_head_t)
+
+    ch_types = set(channel_type(info, idx) for idx in range(info['nchan']))
+    megcoils, compcoils, meg_info, eegels = [], [], None, []
+    if ch_types & set(['grad', 'mag']):
+        megcoils, compcoils, _, meg_info = _prep_meg_channels(
+            info, exclude='bads', accurate=False, verbose=False)
+    if 'eeg' in ch_types:
+        eegels, _ = _prep_eeg_channels(info, exclude='bads', verbose=False)
+    if len(megcoils + eegels) == 0:
+        raise RuntimeError('No MEG or EEG channels found.')
+    fwd_data = dict(coils_list=[megcoils, eegels], infos=[meg_info, None],
+                    ccoils_list=[compcoils, None], coil_types=['meg', 'eeg'],
+                    inner_skull=inner_skull)
+    _prep_field_computation(guess_src['rr'], bem, fwd_data, n_jobs,
+                            verbose=False)
+    # the whitener is applied later, the fields are kept as computed
+    _, guess_fwd, _ = _dipole_forwards(fwd_data, np.eye(len(eegels) +
+                                                        len(megcoils)),
+                                       guess_src['rr'], n_jobs=n_jobs)
+    return dict(fwd_data=fwd_data, guess_rr=guess_src['rr'],
+                guess_fwd=guess_fwd)
+
+
+class DipoleFitter(object):
+    """Fit dipoles of free position with shared, cached guesses.
+
+    Parameters
+    ----------
+    info : instance of Info
+        The measurement info of the data to fit.
+    cov : str | instance of Covariance
+        The noise covariance.
+    bem : str | instance of ConductorModel
+        The BEM file name or conductor model.
+    trans : str | None
+        The head<->MRI transform file name.
+    min_dist : float
+        Minimum distance (in millimeters) from the dipoles to the inner
+        skull.
+    cache_dir : str | None
+        Directory where the guesses are saved and read from. They are only
+        cached when ``bem`` and ``trans`` are file names. None disables
+        caching.
+    n_jobs : int
+        Number of jobs used to compute the guesses.
+    """
+
+    def __init__(self, info, cov, bem, trans=None, min_dist=5.,
+                 cache_dir=None, n_jobs=1):
+        if isinstance(cov, str):
+            cov = mne.read_cov(cov)
+        self.info = info
+        self.min_dist = min_dist / 1000.
+        self.picks = pick_types(info, meg=True, eeg=True, ref_meg=False)
+        self.whitener, _, self.rank = compute_whitener(
+            cov, info, picks=self.picks, return_rank=True)
+
+        key = None if cache_dir is None else _guess_key(info, bem, trans,
+                                                        self.min_dist)
+        fname = None if key is None else op.join(
+            cache_dir, 'dipole-guesses-%s.pkl' % key)
+        if fname is not None and op.isfile(fname):
+            with open(fname, 'rb') as fid:
+                guesses = pickle.load(fid)
+        else:
+            guesses = _compute_guesses(info, bem, trans, self.min_dist,
+                                       n_jobs)
+            if fname is not None:
+                if not op.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                with open(fname + '.tmp', 'wb') as fid:
+                    pickle.dump(guesses, fid, pickle.HIGHEST_PROTOCOL)
+                os.rename(fname + '.tmp', fname)
+        self.fwd_data = guesses['fwd_data']
+        self.guess_rr = guesses['guess_rr']
+
+        # whiten and decompose the fields of all the guesses at once
+        fwd = np.dot(guesses['guess_fwd'], self.whitener.T)
+        fwd = fwd.reshape(len(self.guess_rr), 3, -1)
+        _, sing, self.guess_vv = np.linalg.svd(fwd, full_matrices=False)
+        # the components used by _dipole_gof
+        self.guess_ncomp = np.where(
+            sing[:, 2] / np.where(sing[:, 0] > 0, sing[:, 0], 1.) > 0.2,
+            3, 2)
+
+    def fit(self, evoked, n_jobs=1):
+        """Fit a dipole at each time point of an evoked response.
+
+        Parameters
+        ----------
+        evoked : instance of Evoked
+            The data, with the channels of ``info``.
+        n_jobs : int
+            Number of processes fitting segments of the time points.
+
+        Returns
+        -------
+        dip : instance of Dipole
+            The dipole fits.
+        residual : instance of Evoked
+            The data with the fitted dipolar activity removed.
+        """
+        data = evoked.data[self.picks]
+        if not np.isfinite(data).all():
+            raise ValueError('Evoked data must be finite')
+        context = dict(
+            fwd_data=self.fwd_data, whitener=self.whitener, rank=self.rank,
+            guess_rr=self.guess_rr, guess_vv=self.guess_vv,
+            guess_ncomp=self.guess_ncomp, min_dist=self.min_dist)
+        segments = [idx for idx in np.array_split(
+            np.arange(len(evoked.times)), max(int(n_jobs), 1)) if len(idx)]
+        with ProcessPoolExecutor(max_workers=len(segments),
+                                 initializer=_init_worker,
+                                 initargs=(context,)) as executor:
+            res = sum(executor.map(_fit_segment,
+                                   [data[:, idx] for idx in segments],
+                                   [evoked.times[idx] for idx in segments]),
+                      [])
+        conf = np.array([r[4] for r in res])
+        keys = ['vol', 'depth', 'long', 'trans', 'qlong', 'qtrans']
+        dip = Dipole(evoked.times.copy(), np.array([r[0] for r in res]),
+                     np.array([r[1] for r in res]),
+                     np.array([r[2] for r in res]),
+                     np.array([r[3] for r in res]) * 100, evoked.comment,
+                     dict((key, conf[:, ki]) for ki, key in enumerate(keys)),
+                     np.array([r[5] for r in res]),
+                     np.array([r[6] for r in res]))
+        ch_names = [evoked.info['ch_names'][p] for p in self.picks]
+        proj_op = make_projector(evoked.info['projs'], ch_names,
+                                 evoked.info['bads'])[0]
+        residual = evoked.copy().apply_proj()
+        residual.data[self.picks] = np.dot(proj_op, np.array(
+            [r[7] for r in res]).T)
+        return dip, residual
+
+
+# The fitting context in the worker processes
+_context = dict()
+
+
+def _init_worker(context):
+    _context.update(context)
+
+
+def _fit_segment(data, times):
+    """Fit consecutive time points, each one starting from the previous."""
+    from scipy.optimize import fmin_cobyla
+    ctx = _context
+    fwd_data, whitener = ctx['fwd_data'], ctx['whitener']
+    inner_skull = fwd_data['inner_skull']
+    if 'rr' in inner_skull:
+        constraint = partial(_surface_constraint, surf=inner_skull,
+                             min_dist_to_inner_skull=ctx['min_dist'])
+    else:
+        constraint = partial(_sphere_constraint, r0=inner_skull['r0'],
+                             R_adj=inner_skull['R'] - ctx['min_dist'])
+    mask = np.arange(3) < ctx['guess_ncomp'][:, np.newaxis]
+
+    res, previous = list(), None
+    for B_orig, t in zip(data.T, times):
+        B = np.dot(whitener, B_orig)
+        B2 = np.dot(B, B)
+        if B2 == 0:
+            mne.utils.warn('Zero field found for time %s' % t)
+            res.append((np.zeros(3), 0., np.zeros(3), 0., np.zeros(6), 0., 0,
+                        B_orig))
+            previous = None
+            continue
+        one = np.einsum('gkc,c->gk', ctx['guess_vv'], B)
+        misfit = 1. - np.sum(one * one * mask, axis=1) / B2
+        idx = np.argmin(misfit)
+        fun = partial(_fit_eval, B=B, B2=B2, fwd_data=fwd_data,
+                      whitener=whitener)
+        x0, rhobeg = ctx['guess_rr'][idx], _RHOBEG
+        if previous is not None and fun(previous) < misfit[idx]:
+            x0, rhobeg = previous, _WARM_RHOBEG
+        rd = fmin_cobyla(fun, x0, (constraint,), consargs=(), rhobeg=rhobeg,
+                         rhoend=_RHOEND, disp=False)
+        Q, gof, residual, n_comp = _fit_Q(fwd_data, whitener, B, B2, B_orig,
+                                          rd)
+        amp = np.sqrt(np.dot(Q, Q))
+        ori = Q / (1. if amp == 0. else amp)
+        conf = _fit_confidence(rd, Q, ori, whitener, fwd_data)
+        res.append((rd, amp, ori, gof, conf, (1 - gof) * B2,
+                    ctx['rank'] - n_comp, residual))
+        previous = rd
+    return res
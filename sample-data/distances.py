@@ -0,0 +1,229 @@
+"""Compute bounded cortical distances in blocks, in parallel and resumably.
+
+This gives the same distances and patch information as
+:func:`mne.add_source_space_distances`, but the vertices of each
+hemisphere are split in blocks of ``block_size`` sources whose geodesic
+distances are computed by a pool of processes, and only the distances
+below ``dist_limit`` of each block are kept, as the entries of a sparse
+matrix. Each finished block is saved in a checkpoint directory, so that an
+interrupted run only computes the missing blocks when started again::
+
+    python distances.py sample-oct-6-orig-src.fif sample-oct-6-src.fif \\
+        --dist 7 --n-jobs 8
+"""
+# License: BSD (3-clause)
+import argparse
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from scipy import sparse
+
+import mne
+from mne.surface import mesh_dist
+from mne.source_space import _add_patch_info
+
+_CHUNK = 20  # sources per call of dijkstra, to bound the memory
+
+# The connectivity of each hemisphere in the worker processes
+_connectivity = dict()
+
+
+def _init_worker(connectivity):
+    _connectivity.update(connectivity)
+
+
+def _block_distances(hemi, idx, vertno, limit):
+    """Distances from the vertices ``idx`` to ``vertno`` and all vertices.
+
+    Returns the sparse entries of the distances below ``limit`` to the
+    sources, and for each vertex of the surface the nearest of the block
+    vertices and its distance, used for the patch information.
+    """
+    from scipy.sparse.csgraph import dijkstra
+    con = _connectivity[hemi]
+    range_idx = np.arange(con.shape[0])
+    min_dist = np.full(con.shape[0], np.inf)
+    min_idx = np.zeros(con.shape[0], np.int32)
+    rows, cols, data = list(), list(), list()
+    for start in range(0, len(idx), _CHUNK):
+        these = idx[start:start + _CHUNK]
+        out = dijkstra(con, indices=these, limit=limit)
+        midx = np.argmin(out, axis=0)
+        closer = out[midx, range_idx] < min_dist
+        min_dist[closer] = out[midx, range_idx][closer]
+        min_idx[closer] = these[midx][closer]
+        out = out[:, vertno]
+        row, col = np.nonzero(np.isfinite(out) & (out > 0))
+        rows.append(these[row])
+        cols.append(vertno[col])
+        data.append(out[row, col].astype(np.float32))
+    return dict(rows=np.concatenate(rows).astype(np.int32),
+                cols=np.concatenate(cols).astype(np.int32),
+                data=np.concatenate(data), min_dist=min_dist, min_idx=min_idx)
+
+
+def _save_block(fname, block):
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as fid:
+        np.savez(fid, **block)
+    os.rename(tmp, fname)
+
+
+def _load_block(fname):
+    with np.load(fname) as npz:
+        return dict((key, npz[key]) for key in npz.files)
+
+
+def _surface_hash(s):
+    """Hash the vertex positions and the triangles of a source space."""
+    h = hashlib.sha1()
+    for key in ('rr', 'tris'):
+        h.update(str(s[key].shape).encode())
+        h.update(np.ascontiguousarray(s[key]).tobytes())
+    return h.hexdigest()
+
+
+def _prepare_checkpoint(checkpoint_dir, src, dist_limit, block_size):
+    """Empty the checkpoint directory if it was made for another problem."""
+    # the vertices in use alone do not identify the surfaces, e.g. those
+    # of ico subdivisions are the same for all the subjects
+    params = dict(dist_limit=float(dist_limit), block_size=block_size,
+                  vertno=[s['vertno'].tolist() for s in src],
+                  surfaces=[_surface_hash(s) for s in src])
+    fname = op.join(checkpoint_dir, 'params.json')
+    if op.isfile(fname):
+        with open(fname) as fid:
+            if json.load(fid) == params:
+                return
+        shutil.rmtree(checkpoint_dir)
+    if not op.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    with open(fname, 'w') as fid:
+        json.dump(params, fid)
+
+
+def add_distances(src, dist_limit=np.inf, n_jobs=1, block_size=200,
+                  checkpoint_dir=None, verbose=True):
+    """Add the cortical distances between sources to surface source spaces.
+
+    Parameters
+    ----------
+    src : instance of SourceSpaces
+        The source spaces, modified in place.
+    dist_limit : float
+        The largest distance kept, in meters.
+    n_jobs : int
+        Number of processes computing blocks.
+    block_size : int
+        Number of sources per block.
+    checkpoint_dir : str | None
+        Directory where the finished blocks are saved, and read back from
+        when computing distances again for the same source spaces and
+        parameters. None disables checkpointing.
+    verbose : bool
+        Print the progress and the throughput.
+
+    Returns
+    -------
+    src : instance of SourceSpaces
+        The source spaces, with ``dist`` and ``dist_limit``, and with the
+        patch information when ``dist_limit`` reaches all the vertices.
+    """
+    if any(s['type'] != 'surf' for s in src):
+        raise RuntimeError('Currently all source spaces must be of surface '
+                           'type')
+    if checkpoint_dir is not None:
+        _prepare_checkpoint(checkpoint_dir, src, dist_limit, block_size)
+    connectivity, blocks = dict(), dict()
+    todo = list()
+    for hemi, s in enumerate(src):
+        connectivity[hemi] = mesh_dist(s['tris'], s['rr'])
+        for bi, start in enumerate(range(0, s['nuse'], block_size)):
+            fname = None if checkpoint_dir is None else op.join(
+                checkpoint_dir, '%d-%05d.npz' % (hemi, bi))
+            if fname is not None and op.isfile(fname):
+                blocks[(hemi, bi)] = _load_block(fname)
+            else:
+                todo.append((hemi, bi, s['vertno'][start:start + block_size],
+                             fname))
+    n_blocks = len(blocks) + len(todo)
+    if verbose and blocks:
+        print('Resuming from %d of %d blocks' % (len(blocks), n_blocks))
+
+    t0, n_done = time.time(), 0
+    with ProcessPoolExecutor(max_workers=max(int(n_jobs), 1),
+                             initializer=_init_worker,
+                             initargs=(connectivity,)) as executor:
+        futures = dict((executor.submit(_block_distances, hemi, idx,
+                                        src[hemi]['vertno'], dist_limit),
+                        (hemi, bi, len(idx), fname))
+                       for hemi, bi, idx, fname in todo)
+        for future in as_completed(futures):
+            hemi, bi, n_sources, fname = futures[future]
+            blocks[(hemi, bi)] = future.result()
+            if fname is not None:
+                _save_block(fname, blocks[(hemi, bi)])
+            n_done += n_sources
+            if verbose:
+                elapsed = time.time() - t0
+                rate = n_done / max(elapsed, 1e-6)
+                n_left = sum(len(idx) for _, _, idx, _ in todo) - n_done
+                print('%d/%d blocks, %0.1f sources/s, %0.0f s left'
+                      % (len(blocks), n_blocks, rate, n_left / rate))
+
+    min_dists, min_idxs = list(), list()
+    for hemi, s in enumerate(src):
+        these = [blocks[key] for key in sorted(blocks) if key[0] == hemi]
+        min_dist = np.array([block['min_dist'] for block in these])
+        midx = np.argmin(min_dist, axis=0)
+        range_idx = np.arange(s['np'])
+        min_dists.append(min_dist[midx, range_idx])
+        min_idxs.append(np.array([block['min_idx'] for block in these])[
+            midx, range_idx])
+        s['dist'] = sparse.csr_matrix(
+            (np.concatenate([block['data'] for block in these]),
+             (np.concatenate([block['rows'] for block in these]),
+              np.concatenate([block['cols'] for block in these]))),
+            shape=(s['np'], s['np']), dtype=np.float32)
+        s['dist_limit'] = np.array([dist_limit], np.float32)
+
+    if not any(np.any(np.isinf(md)) for md in min_dists):
+        for s, min_dist, min_idx in zip(src, min_dists, min_idxs):
+            s['nearest'] = min_idx
+            s['nearest_dist'] = min_dist
+            _add_patch_info(s)
+    elif verbose:
+        print('Not adding patch information, dist_limit too small')
+    return src
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Add cortical distances to a source space.')
+    parser.add_argument('src', help='input source space')
+    parser.add_argument('out', help='output source space')
+    parser.add_argument('--dist', type=float, default=None,
+                        help='largest distance kept, in mm')
+    parser.add_argument('--n-jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--block-size', type=int, default=200)
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help='directory of the finished blocks, by default '
+                             'next to the output')
+    args = parser.parse_args()
+    checkpoint_dir = args.checkpoint_dir or args.out + '.blocks'
+    src = mne.read_source_spaces(args.src)
+    add_distances(src, np.inf if args.dist is None else args.dist / 1000.,
+                  n_jobs=args.n_jobs, block_size=args.block_size,
+                  checkpoint_dir=checkpoint_dir)
+    src.save(args.out)
+    shutil.rmtree(checkpoint_dir)
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
@@ -0,0 +1,129 @@
+"""Stand-ins of the FreeSurfer and MNE-C commands of the dataset builders.
+
+The stand-ins write empty files where the real commands write their
+outputs, so that the orchestration of the reconstructions by ``recon.py``
+(scheduling, skipping of finished steps, resuming, logs) and the
+conversions of ``fetch.py`` can be tested in seconds::
+
+    python fake_freesurfer.py install /tmp/fake-bin
+
+creates ``recon-all``, ``mne_watershed_bem``, ``mkheadsurf``,
+``mne_surf2bem``, ``mne_setup_forward_model`` and ``mne_ctf2fiff`` in
+``/tmp/fake-bin``.
+Each command sleeps ``FAKE_FREESURFER_DELAY`` seconds (0 by default), and
+``recon-all`` fails for the subjects listed in ``FAKE_FREESURFER_FAIL``
+(comma separated), leaving an unfinished subject behind as the real one
+would. Like the real one, it links ``$SUBJECTS_DIR/fsaverage`` to the
+fsaverage of ``$FREESURFER_HOME``, which need not exist.
+"""
+# License: BSD (3-clause)
+import os
+import os.path as op
+import stat
+import sys
+import time
+
+_commands = ('recon-all', 'mne_watershed_bem', 'mkheadsurf', 'mne_surf2bem',
+             'mne_setup_forward_model', 'mne_ctf2fiff')
+
+
+def _touch(fname):
+    if not op.isdir(op.dirname(fname)):
+        os.makedirs(op.dirname(fname))
+    with open(fname, 'a'):
+        pass
+
+
+def _option(args, name):
+    return args[args.index(name) + 1]
+
+
+def recon_all(args):
+    subject = _option(args, '-s')
+    subject_dir = op.join(os.environ['SUBJECTS_DIR'], subject)
+    if '-i' in args:
+        if op.isdir(subject_dir):
+            raise SystemExit('ERROR: %s already exists' % subject_dir)
+        _touch(op.join(subject_dir, 'mri', 'orig', '001.mgz'))
+    elif not op.isfile(op.join(subject_dir, 'mri', 'orig', '001.mgz')):
+        # as recon-all, which has no input to reconstruct
+        raise SystemExit('ERROR: no input volumes found in %s' % subject_dir)
+    _touch(op.join(subject_dir, 'scripts', 'IsRunning.lh+rh'))
+    if subject in os.getenv('FAKE_FREESURFER_FAIL', '').split(','):
+        raise SystemExit('ERROR: recon-all exited with errors')
+    for fname in ('mri/T1.mgz', 'mri/aseg.mgz', 'surf/lh.white',
+                  'surf/rh.white', 'surf/lh.pial', 'surf/rh.pial'):
+        _touch(op.join(subject_dir, fname))
+    if not op.isdir(op.join(subject_dir, 'bem')):
+        os.makedirs(op.join(subject_dir, 'bem'))
+    fsaverage = op.join(os.environ['SUBJECTS_DIR'], 'fsaverage')
+    freesurfer_home = os.getenv('FREESURFER_HOME', '/usr/local/freesurfer')
+    if not op.lexists(fsaverage):
+        os.symlink(op.join(freesurfer_home, 'subjects', 'fsaverage'),
+                   fsaverage)
+    os.remove(op.join(subject_dir, 'scripts', 'IsRunning.lh+rh'))
+    _touch(op.join(subject_dir, 'scripts', 'recon-all.done'))
+
+
+def watershed_bem(args):
+    subject = os.environ['SUBJECT']
+    watershed_dir = op.join(os.environ['SUBJECTS_DIR'], subject, 'bem',
+                            'watershed')
+    if op.isdir(watershed_dir) and '--overwrite' not in args:
+        raise SystemExit('ERROR: %s already exists, use --overwrite'
+                         % watershed_dir)
+    for surf in ('inner_skull', 'outer_skull', 'outer_skin'):
+        _touch(op.join(os.environ['SUBJECTS_DIR'], subject, 'bem',
+                       'watershed', '%s_%s_surface' % (subject, surf)))
+
+
+def mkheadsurf(args):
+    _touch(op.join(os.environ['SUBJECTS_DIR'], _option(args, '-s'), 'surf',
+                   'lh.seghead'))
+
+
+def surf2bem(args):
+    if not op.isfile(_option(args, '--surf')):
+        raise SystemExit('ERROR: cannot read %s' % _option(args, '--surf'))
+    _touch(_option(args, '--fif'))
+
+
+def setup_forward_model(args):
+    subject = os.environ['SUBJECT']
+    _touch(op.join(os.environ['SUBJECTS_DIR'], subject, 'bem',
+                   '%s-5120-bem-sol.fif' % subject))
+
+
+def ctf2fiff(args):
+    if not op.isdir(_option(args, '--ds')):
+        raise SystemExit('ERROR: cannot find %s' % _option(args, '--ds'))
+    _touch(_option(args, '--fif'))
+
+
+def install(bin_dir):
+    """Create the stand-in commands in a directory."""
+    if not op.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    script = op.abspath(__file__)
+    for command in _commands:
+        fname = op.join(bin_dir, command)
+        with open(fname, 'w') as fid:
+            fid.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n'
+                      % (sys.executable, script, command))
+        os.chmod(fname, os.stat(fname).st_mode | stat.S_IXUSR | stat.S_IXGRP |
+                 stat.S_IXOTH)
+
+
+def run():
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == 'install':
+        install(args[0])
+        return
+    print('%s %s' % (command, ' '.join(args)))
+    time.sleep(float(os.getenv('FAKE_FREESURFER_DELAY', 0)))
+    dict(zip(_commands, (recon_all, watershed_bem, mkheadsurf, surf2bem,
+                         setup_forward_model, ctf2fiff)))[command](args)
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
@@ -0,0 +1,278 @@
+"""Download, extract and convert the CTF recordings of a dataset, overlapped.
+
+Each archive is fetched and extracted in its own thread. The members of
+each ``.ds`` directory are extracted first, one directory after the other,
+and each ``.ds`` is handed to a pool of ``mne_ctf2fiff`` workers as soon as
+its last member is on disk, while the extraction goes on. A zip archive can
+only be read once it is complete, so the downloads themselves are not
+overlapped with the extraction of the same archive.
+
+The SHA-256 of each archive is recorded in ``fetch-state.json`` once it is
+extracted and its recordings converted: an archive with the same checksum
+is neither downloaded nor extracted again. Expected checksums can also be
+given to verify the downloads.
+
+Archives are fetched from a URL template, or from a local directory, e.g.
+to test the bootstrap scripts without network::
+
+    python fetch.py $TMPDIR sample_auditory.zip sample_raw.zip \\
+        --url 'http://neuroimage.usc.edu/bst/getupdate.php?u=mne&s={stem}' \\
+        --rename Data=data --rename Anatomy=anatomy --remove-ds
+"""
+# License: BSD (3-clause)
+import argparse
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import subprocess
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+_CHUNK = 16 * 1024 * 1024
+
+
+class URLFetcher(object):
+    """Download archives from a URL template.
+
+    The template is formatted with ``name``, the archive file name, and
+    ``stem``, the name without its extension.
+    """
+
+    def __init__(self, template):
+        self.template = template
+
+    def fetch(self, name, fname):
+        from urllib.request import urlopen
+        url = self.template.format(name=name, stem=op.splitext(name)[0])
+        print('Downloading %s' % url)
+        tmp = fname + '.part'
+        with open(tmp, 'wb') as fout:
+            response = urlopen(url)
+            try:
+                shutil.copyfileobj(response, fout, _CHUNK)
+            finally:
+                response.close()
+        os.rename(tmp, fname)
+
+
+class LocalFetcher(object):
+    """Copy archives from a local directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def fetch(self, name, fname):
+        shutil.copyfile(op.join(self.directory, name), fname)
+
+
+def get_fetcher(source):
+    """A fetcher for a URL template or a local directory."""
+    if op.isdir(source):
+        return LocalFetcher(source)
+    return URLFetcher(source)
+
+
+def _sha256(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FetchState(object):
+    """The checksums of the archives that were extracted and converted."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._lock = threading.Lock()
+        self.archives = dict()
+        if op.isfile(fname):
+            with open(fname) as fid:
+                self.archives = json.load(fid)['archives']
+
+    def set(self, name, sha256):
+        with self._lock:
+            self.archives[name] = sha256
+            tmp = self.fname + '.tmp'
+            with open(tmp, 'w') as fid:
+                json.dump(dict(archives=self.archives), fid, indent=2,
+                          sort_keys=True)
+            os.rename(tmp, self.fname)
+
+
+def _rename(member, rename):
+    """Apply the renaming of path components to a member name."""
+    return '/'.join(rename.get(part, part) for part in member.split('/'))
+
+
+def _ds_root(member):
+    """The ``.ds`` directory a member belongs to, None if there is none."""
+    parts = member.rstrip('/').split('/')
+    for ii, part in enumerate(parts[:-1]):
+        if part.endswith('.ds'):
+            return '/'.join(parts[:ii + 1])
+    return None
+
+
+def _group_members(members):
+    """Group the members by ``.ds`` directory, the others last."""
+    groups, others = dict(), list()
+    for member in members:
+        root = _ds_root(member.filename)
+        if root is None:
+            others.append(member)
+        else:
+            groups.setdefault(root, list()).append(member)
+    return sorted(groups.items()), others
+
+
+def _extract(zf, member, out_dir, rename):
+    target = op.join(out_dir, *_rename(member.filename, rename).split('/'))
+    if member.filename.endswith('/'):
+        if not op.isdir(target):
+            os.makedirs(target)
+        return
+    if not op.isdir(op.dirname(target)):
+        os.makedirs(op.dirname(target))
+    with zf.open(member) as fin, open(target, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, _CHUNK)
+
+
+def convert_ds(ds_dir, fif_fname, remove_ds=False):
+    """Convert a CTF directory with ``mne_ctf2fiff``, if not done before."""
+    if not op.isfile(fif_fname):
+        print('Converting %s' % op.basename(ds_dir))
+        if not op.isdir(op.dirname(fif_fname)):
+            os.makedirs(op.dirname(fif_fname))
+        tmp = fif_fname[:-len('_raw.fif')] + '-tmp_raw.fif'
+        subprocess.check_call(['mne_ctf2fiff', '--ds', ds_dir, '--fif', tmp])
+        os.rename(tmp, fif_fname)
+    if remove_ds:
+        shutil.rmtree(ds_dir)
+
+
+def _fif_fname(ds_dir, fif_dir):
+    stem = op.splitext(op.basename(ds_dir))[0]
+    return op.join(fif_dir or op.dirname(ds_dir), stem + '_raw.fif')
+
+
+def process_archive(name, out_dir, fetcher, state, converter, rename=None,
+                    fif_dir=None, remove_ds=False, sha256=None):
+    """Fetch and extract an archive, converting its recordings on the fly.
+
+    Parameters
+    ----------
+    name : str
+        The file name of the archive.
+    out_dir : str
+        The directory the archive is downloaded to and extracted in.
+    fetcher : instance of URLFetcher | LocalFetcher
+        The fetcher of the archive.
+    state : instance of FetchState
+        The checksums of the archives already extracted.
+    converter : instance of ThreadPoolExecutor
+        The workers converting the recordings.
+    rename : dict | None
+        Path components renamed on extraction, e.g. ``{'Data': 'data'}``.
+    fif_dir : str | None
+        The directory of the converted recordings. None writes them next
+        to their ``.ds`` directory.
+    remove_ds : bool
+        Remove the ``.ds`` directories once converted.
+    sha256 : str | None
+        The expected checksum of the archive.
+    """
+    rename = dict() if rename is None else rename
+    fname = op.join(out_dir, name)
+    if not op.isfile(fname):
+        fetcher.fetch(name, fname)
+    checksum = _sha256(fname)
+    if sha256 is not None and checksum != sha256:
+        os.remove(fname)
+        raise RuntimeError('Checksum mismatch for %s, it was removed and will '
+                           'be downloaded again' % name)
+    if state.archives.get(name) == checksum:
+        print('Skipping %s, extracted before' % name)
+        return
+
+    with zipfile.ZipFile(fname) as zf:
+        groups, others = _group_members(zf.infolist())
+        futures = list()
+        for root, members in groups:
+            ds_dir = op.join(out_dir, *_rename(root, rename).split('/'))
+            fif_fname = _fif_fname(ds_dir, fif_dir)
+            if not op.isfile(fif_fname):
+                for member in members:
+                    _extract(zf, member, out_dir, rename)
+            futures.append(converter.submit(convert_ds, ds_dir, fif_fname,
+                                            remove_ds and op.isdir(ds_dir)))
+        for member in others:
+            _extract(zf, member, out_dir, rename)
+    for future in futures:
+        future.result()
+    state.set(name, checksum)
+    print('Finished %s' % name)
+
+
+def bootstrap(out_dir, archives, fetcher, n_jobs=2, rename=None,
+              fif_dir=None, remove_ds=False, checksums=None):
+    """Fetch, extract and convert several archives concurrently.
+
+    See :func:`process_archive` for the parameters, ``n_jobs`` is the
+    number of conversion workers and ``checksums`` maps archive names to
+    their expected SHA-256.
+    """
+    if not op.isdir(out_dir):
+        os.makedirs(out_dir)
+    checksums = dict() if checksums is None else checksums
+    state = FetchState(op.join(out_dir, 'fetch-state.json'))
+    with ThreadPoolExecutor(max_workers=n_jobs) as converter, \
+            ThreadPoolExecutor(max_workers=len(archives)) as executor:
+        futures = [executor.submit(process_archive, name, out_dir, fetcher,
+                                   state, converter, rename, fif_dir,
+                                   remove_ds, checksums.get(name))
+                   for name in archives]
+        for future in futures:
+            future.result()
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Download, extract and convert CTF datasets.')
+    parser.add_argument('out_dir', help='directory of the archives and of '
+                                        'the extracted data')
+    parser.add_argument('archives', nargs='+', help='archive file names')
+    parser.add_argument('--url', default=None,
+                        help='URL template of the archives, with {name} '
+                             'and {stem}')
+    parser.add_argument('--source', default=None,
+                        help='local directory with the archives, used '
+                             'instead of the URL')
+    parser.add_argument('--rename', action='append', default=[],
+                        help='path component renamed on extraction, as '
+                             'old=new')
+    parser.add_argument('--fif-dir', default=None,
+                        help='directory of the converted recordings')
+    parser.add_argument('--remove-ds', action='store_true',
+                        help='remove the .ds directories once converted')
+    parser.add_argument('--sha256', action='append', default=[],
+                        help='expected checksum, as archive=sha256')
+    parser.add_argument('--n-jobs', type=int, default=2,
+                        help='number of conversions run in parallel')
+    args = parser.parse_args()
+    source = args.source or args.url
+    if source is None:
+        parser.error('Give --url or --source')
+    bootstrap(args.out_dir, args.archives, get_fetcher(source),
+              n_jobs=args.n_jobs,
+              rename=dict(spec.split('=', 1) for spec in args.rename),
+              fif_dir=args.fif_dir, remove_ds=args.remove_ds,
+              checksums=dict(spec.split('=', 1) for spec in args.sha256))
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
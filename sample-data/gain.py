@@ -0,0 +1,149 @@
+"""Memory-mapped gain matrices of forward solutions.
+
+Reading a ``-fwd.fif`` file loads the whole gain matrix, and each later
+stage using it reads and converts it again. The forward stage therefore
+also writes the gain matrix in surface orientation to a sidecar file: a
+small JSON header (channel names, orientation and source vertices)
+followed, at a page boundary, by the raw C-ordered array. The stages that
+only need the gain map it read-only, so that
+
+- nothing is read before it is used, and picking channel rows only reads
+  those rows from the disk,
+- processes running in parallel share the same page cache copy of it.
+
+The gain of ``sample_audvis-meg-oct-6-fwd.fif`` is written to
+``sample_audvis-meg-oct-6-fwd-gain.dat``, next to it or in another
+directory, e.g. to keep it out of a dataset that is published.
+"""
+# License: BSD (3-clause)
+import json
+import os
+import os.path as op
+import struct
+
+import numpy as np
+
+import mne
+
+_MAGIC = b'MNEGAIN1'
+_ALIGN = 4096
+
+
+def gain_fname(fwd_fname, gain_dir=None):
+    """The sidecar file name of a forward solution.
+
+    It is next to the forward solution, or in ``gain_dir`` if not None.
+    """
+    fname = fwd_fname[:-len('.fif')] + '-gain.dat'
+    if gain_dir is not None:
+        fname = op.join(gain_dir, op.basename(fname))
+    return fname
+
+
+def write_gain(fname, fwd, surf_ori=True, dtype=np.float64):
+    """Write the gain matrix of a forward solution for memory mapping.
+
+    Parameters
+    ----------
+    fname : str
+        The output file name.
+    fwd : dict
+        The forward solution.
+    surf_ori : bool
+        Convert a free orientation forward to surface orientation first, as
+        needed by the sensitivity maps and the loose orientation inverses.
+    dtype : dtype
+        The type the gain is stored with.
+    """
+    if surf_ori and not fwd['surf_ori']:
+        fwd = mne.convert_forward_solution(fwd, surf_ori=True)
+    data = fwd['sol']['data']
+    header = dict(
+        dtype=np.dtype(dtype).str, shape=list(data.shape),
+        row_names=list(fwd['sol']['row_names']), surf_ori=fwd['surf_ori'],
+        source_ori=int(fwd['source_ori']), nsource=int(fwd['nsource']),
+        coord_frame=int(fwd['coord_frame']),
+        src=[dict(type=s['type'], vertno=s['vertno'].tolist(),
+                  subject_his_id=s.get('subject_his_id')) for s in fwd['src']])
+    header = json.dumps(header).encode('utf-8')
+    if not op.isdir(op.dirname(op.abspath(fname))):
+        os.makedirs(op.dirname(op.abspath(fname)))
+    offset = -(-(len(_MAGIC) + 8 + len(header)) // _ALIGN) * _ALIGN
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as fid:
+        fid.write(_MAGIC + struct.pack('<Q', len(header)) + header)
+        fid.write(b'\0' * (offset - fid.tell()))
+        # by blocks of rows, so that the cast to dtype is not a full copy
+        for start in range(0, data.shape[0], 64):
+            np.asarray(data[start:start + 64], dtype).tofile(fid)
+    os.rename(tmp, fname)
+
+
+def read_gain(fname, info=None):
+    """Map the gain matrix of a forward solution.
+
+    Parameters
+    ----------
+    fname : str
+        The file written by :func:`write_gain`.
+    info : instance of Info | None
+        The measurement info of the recording the forward was computed for,
+        restricted to the channels of the forward when given.
+
+    Returns
+    -------
+    fwd : dict
+        The parts of the forward solution used by the gain-only stages:
+        ``sol`` with the read-only mapped ``data`` and ``row_names``,
+        ``nchan``, ``nsource``, ``source_ori``, ``surf_ori``,
+        ``coord_frame``, ``src`` with the ``type``, ``vertno`` and
+        ``subject_his_id`` of each source space, and ``info``.
+    """
+    with open(fname, 'rb') as fid:
+        if fid.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError('%s is not a gain matrix file' % fname)
+        size, = struct.unpack('<Q', fid.read(8))
+        header = json.loads(fid.read(size).decode('utf-8'))
+    offset = -(-(len(_MAGIC) + 8 + size) // _ALIGN) * _ALIGN
+    data = np.memmap(fname, dtype=header['dtype'], mode='r', offset=offset,
+                     shape=tuple(header['shape']))
+    for s in header['src']:
+        s['vertno'] = np.array(s['vertno'], int)
+    if info is not None:
+        info = mne.pick_info(info, [info['ch_names'].index(name)
+                                    for name in header['row_names']])
+    return dict(sol=dict(data=data, row_names=header['row_names'],
+                         nrow=data.shape[0], ncol=data.shape[1]),
+                nchan=data.shape[0], nsource=header['nsource'],
+                source_ori=header['source_ori'], surf_ori=header['surf_ori'],
+                coord_frame=header['coord_frame'], src=header['src'],
+                info=info)
+
+
+def pick_gain(fwd, ch_names=None, sources=None):
+    """Read the gain of some channels and sources of a mapped forward.
+
+    Parameters
+    ----------
+    fwd : dict
+        The forward from :func:`read_gain`.
+    ch_names : list of str | None
+        The channels, None for all.
+    sources : array of int | None
+        The indices of the sources, over all source spaces, None for all.
+        The columns of all orientations of each source are returned.
+
+    Returns
+    -------
+    gain : array, shape (n_channels, n_sources * n_orient)
+        The gain, read into memory.
+    """
+    data = fwd['sol']['data']
+    rows = np.arange(data.shape[0]) if ch_names is None else \
+        np.array([fwd['sol']['row_names'].index(name) for name in ch_names])
+    if sources is None:
+        return np.array(data[rows])
+    n_orient = data.shape[1] // fwd['nsource']
+    cols = (np.asarray(sources)[:, np.newaxis] * n_orient +
+            np.arange(n_orient)).ravel()
+    return np.array(data[np.ix_(rows, cols)])
@@ -0,0 +1,582 @@
+"""Build and apply inverse operators sharing their preparation.
+
+The inverse operators are assembled from the steps of
+:func:`mne.minimum_norm.make_inverse_operator`, each computed a single time
+no matter how many operators use it: reading (and orienting) a forward
+solution, reading a noise covariance or taking its diagonal, selecting the
+channels, the depth and orientation priors and the whitener. The SVD of the
+weighted and whitened lead field is computed once per distinct combination
+of these, in worker processes which receive the prepared steps when they
+start, and its operator is written to all the files asking for it.
+
+When applied, an inverse operator is prepared (regularization, projector
+and whitener) and its imaging kernel assembled once per number of
+averages, and the kernel is applied to batches of evoked responses or
+epochs stacked in a single matrix product. The source estimates are
+produced lazily, batch by batch, so that they can be written as they come
+instead of being held in memory::
+
+    kernel = InverseKernel(read_inverse_operator(inv_fname), method='MNE')
+    stcs = kernel.apply_epochs(epochs, batch_size=16)
+    save_stcs(stcs, ('epoch-%04d' % ii for ii in itertools.count()))
+"""
+# License: BSD (3-clause)
+import os.path as op
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+
+import numpy as np
+from scipy import linalg
+
+import mne
+from mne.cov import compute_whitener, prepare_noise_cov
+from mne.fixes import _safe_svd
+from mne.forward import (compute_depth_prior, compute_orient_prior,
+                         convert_forward_solution, is_fixed_orient)
+from mne.forward.forward import _select_orient_forward
+from mne.io.constants import FIFF
+from mne.io.pick import channel_type
+from mne.minimum_norm import write_inverse_operator, prepare_inverse_operator
+from mne.minimum_norm.inverse import (InverseOperator, _assemble_kernel,
+                                      _check_ch_names, _check_ori,
+                                      _pick_channels_inverse_operator,
+                                      _subject_from_inverse, combine_xyz)
+from mne.source_estimate import _get_src_type, _make_stc
+from mne.utils.check import _check_depth
+
+import profiling
+from profiling import StageProfiler
+
+
+class _Timer(object):
+    """Keep track of the steps shared by several operators."""
+
+    def __init__(self):
+        self.steps = dict()
+        self.results = dict()
+
+    def get(self, name, func, *args, **kwargs):
+        """The result of a step, computed the first time it is used."""
+        if name not in self.results:
+            t0 = time.time()
+            self.results[name] = func(*args, **kwargs)
+            self.steps[name] = [time.time() - t0, 0]
+        self.steps[name][1] += 1
+        return self.results[name]
+
+    def report(self, records):
+        """Print the time of each shared step and of each operator."""
+        print('%8s %5s  %s' % ('Time (s)', 'Uses', 'Shared step'))
+        for name, (duration, uses) in sorted(self.steps.items()):
+            # the steps are named after full paths, only show the files
+            print('%8.1f %5d  %s' % (duration, uses,
+                                     re.sub(r'/\S*/', '', name)))
+        print('%-60s %8s' % ('Inverse operator', 'Time (s)'))
+        for record in records:
+            print('%-60s %8.1f' % (record['name'][-60:],
+                                   record['wall_time']))
+
+
+_defaults = dict(loose='auto', depth=0.8, fixed='auto', rank=None,
+                 use_cps=True, diag=False)
+
+
+def _parse_options(options, src_kind):
+    """Check the options, resolving loose and fixed as mne does."""
+    unknown = sorted(set(options) - set(_defaults))
+    if unknown:
+        raise TypeError('Unknown inverse operator options %s' % unknown)
+    options = dict(_defaults, **options)
+    loose, fixed = options['loose'], options.pop('fixed')
+    if fixed == 'auto':
+        if loose == 'auto':
+            fixed = False
+            loose = 0.2 if src_kind == 'surface' else 1.
+        else:
+            fixed = float(loose) == 0
+    if fixed:
+        if loose not in ['auto', 0.]:
+            raise ValueError('When using fixed=True, loose must be 0. or '
+                             '"auto", got %s' % (loose,))
+        loose = 0.
+    elif loose == 'auto':
+        loose = 0.2 if src_kind == 'surface' else 1.
+    elif loose == 0.:
+        raise ValueError('If loose==0., then fixed must be True or "auto",'
+                         'got %s' % (fixed,))
+    loose = float(loose)
+    if not 0 <= loose <= 1:
+        raise ValueError('loose must be between 0 and 1, got %s' % loose)
+    if src_kind != 'surface' and loose != 1:
+        raise ValueError('loose parameter has to be 1 or "auto" for '
+                         'non-surface source space (Got loose=%s for %s '
+                         'source space).' % (loose, src_kind))
+    options['loose'] = loose
+    options['depth'] = _check_depth(options['depth'], 'depth_mne')
+    exp = options['depth']['exp']
+    if exp is not None:
+        exp = float(exp)
+        if not 0 <= exp <= 1:
+            raise ValueError('depth exponent should be a scalar between '
+                             '0 and 1, got %s' % (exp,))
+        options['depth']['exp'] = exp or None
+    return options
+
+
+def _copy_forward(fwd):
+    """Copy a forward, sharing its source spaces which are only read."""
+    src, fwd['src'] = fwd['src'], None
+    try:
+        copy = fwd.copy()
+    finally:
+        fwd['src'] = src
+    copy['src'] = src
+    return copy
+
+
+def _check_forward(fwd, loose, depth):
+    if loose == 0.:
+        if (is_fixed_orient(fwd) and depth['exp'] is not None and
+                not depth['allow_fixed_depth']):
+            raise ValueError(
+                'For a fixed orientation inverse solution with depth '
+                'weighting, the forward solution must be free-orientation and '
+                'in surface orientation')
+    elif is_fixed_orient(fwd):
+        raise ValueError(
+            'Forward operator has fixed orientation and can only '
+            'be used to make a fixed-orientation inverse '
+            'operator.')
+
+
+def _orientation(fwd, loose, depth):
+    """The orientation the priors are computed in, if it is converted."""
+    if loose == 0. and depth['allow_fixed_depth'] and \
+            not is_fixed_orient(fwd):
+        return 'fixed orientation'
+    elif 0. < loose < 1. and not fwd['surf_ori']:
+        return 'surface orientation'
+
+
+def _orient_forward(fwd, orientation):
+    if orientation == 'fixed orientation':
+        kwargs = dict(force_fixed=True, use_cps=True)
+    else:
+        kwargs = dict(surf_ori=True, use_cps=True)
+    return convert_forward_solution(_copy_forward(fwd), copy=False, **kwargs)
+
+
+def _select_channels(fwd, info, noise_cov):
+    """Pick the channels of a forward, sharing its source spaces."""
+    src, fwd['src'] = fwd['src'], None
+    try:
+        picked, info_picked = _select_orient_forward(fwd, info, noise_cov,
+                                                     verbose=False)
+    finally:
+        fwd['src'] = src
+    picked['src'] = src
+    return picked, info_picked
+
+
+def _fixed_forward(fwd, depth_prior, use_cps):
+    """The fixed orientation forward and depth prior of a free forward."""
+    if depth_prior is not None:
+        depth_prior = depth_prior[2::3]
+    fwd = convert_forward_solution(_copy_forward(fwd), surf_ori=True,
+                                   force_fixed=True, use_cps=use_cps,
+                                   copy=False)
+    return fwd, depth_prior
+
+
+def _diagonal(noise_cov):
+    # as_diag changes the covariance in place
+    return noise_cov.copy().as_diag()
+
+
+def _whitener(noise_cov, info, ch_names, rank):
+    noise_cov = prepare_noise_cov(noise_cov, info, ch_names, rank)
+    whitener, _ = compute_whitener(noise_cov, info, ch_names, pca='white',
+                                   verbose=False)
+    return noise_cov, whitener
+
+
+# The prepared steps in the worker processes
+_context = dict()
+
+
+def _init_worker(context):
+    _context.update(context)
+
+
+def _make_operator(job):
+    """Compute the SVD of one operator and write it, in a worker process."""
+    fwd_key, cov_key, depth_key, orient_key, fnames = job
+    fwd, info_picked = _context['fwds'][fwd_key]
+    noise_cov, whitener = _context['whiteners'][cov_key]
+    depth_prior = _context['priors'][depth_key]
+    orient_prior = _context['priors'][orient_key]
+    info = _context['info']
+    with StageProfiler(', '.join(op.basename(f) for f in fnames)) as profiler:
+        gain = np.dot(whitener, fwd['sol']['data'])
+        source_std = np.ones(gain.shape[1])
+        if depth_prior is not None:
+            source_std *= depth_prior
+        if orient_prior is not None:
+            source_std *= orient_prior
+        np.sqrt(source_std, out=source_std)
+        gain *= source_std
+        # scale the source covariance so that the trace of G R G^T is the
+        # number of sensors
+        trace_GRGT = linalg.norm(gain, ord='fro') ** 2
+        scale = np.sqrt((noise_cov['eig'] > 0).sum() / trace_GRGT)
+        source_std *= scale
+        gain *= scale
+        eigen_fields, sing, eigen_leads = _safe_svd(gain, full_matrices=False)
+        del gain
+        inv = _inverse_operator(info, fwd, info_picked, noise_cov,
+                                depth_prior, orient_prior, source_std,
+                                eigen_fields, sing, eigen_leads)
+        for fname in fnames:
+            write_inverse_operator(fname, inv)
+    return profiler.record
+
+
+def _inverse_operator(info, fwd, info_picked, noise_cov, depth_prior,
+                      orient_prior, source_std, eigen_fields, sing,
+                      eigen_leads):
+    """Assemble the operator as make_inverse_operator does."""
+    eigen_fields = dict(data=eigen_fields.T,
+                        col_names=info_picked['ch_names'], row_names=[],
+                        nrow=eigen_fields.shape[1],
+                        ncol=eigen_fields.shape[0])
+    eigen_leads = dict(data=eigen_leads.T, nrow=eigen_leads.shape[1],
+                       ncol=eigen_leads.shape[0], row_names=[],
+                       col_names=[])
+    ch_types = set(channel_type(info_picked, idx)
+                   for idx in range(info_picked['nchan']))
+    has_meg = bool(ch_types & set(['mag', 'grad']))
+    if 'eeg' in ch_types and has_meg:
+        methods = FIFF.FIFFV_MNE_MEG_EEG
+    elif has_meg:
+        methods = FIFF.FIFFV_MNE_MEG
+    else:
+        methods = FIFF.FIFFV_MNE_EEG
+    if orient_prior is not None:
+        orient_prior = dict(data=orient_prior,
+                            kind=FIFF.FIFFV_MNE_ORIENT_PRIOR_COV,
+                            bads=[], diag=True, names=[], eig=None,
+                            eigvec=None, dim=orient_prior.size, nfree=1,
+                            projs=[])
+    if depth_prior is not None:
+        depth_prior = dict(data=depth_prior,
+                           kind=FIFF.FIFFV_MNE_DEPTH_PRIOR_COV,
+                           bads=[], diag=True, names=[], eig=None,
+                           eigvec=None, dim=depth_prior.size, nfree=1,
+                           projs=[])
+    source_cov = dict(data=source_std * source_std, dim=source_std.size,
+                      kind=FIFF.FIFFV_MNE_SOURCE_COV, diag=True,
+                      names=[], projs=[], eig=None, eigvec=None,
+                      nfree=1, bads=[])
+    # the operator is only written, its source spaces are not copied
+    inv = dict(eigen_fields=eigen_fields, eigen_leads=eigen_leads,
+               sing=sing, nave=1., depth_prior=depth_prior,
+               source_cov=source_cov, noise_cov=noise_cov,
+               orient_prior=orient_prior,
+               projs=deepcopy(info_picked['projs']),
+               eigen_leads_weighted=False, source_ori=fwd['source_ori'],
+               mri_head_t=deepcopy(fwd['mri_head_t']), methods=methods,
+               nsource=fwd['nsource'], coord_frame=fwd['coord_frame'],
+               source_nn=fwd['source_nn'].copy(), src=fwd['src'],
+               fmri_prior=None, units='Am')
+    inv_info = deepcopy(fwd['info'])
+    inv_info['bads'] = [bad for bad in info['bads']
+                        if bad in fwd['info']['ch_names']]
+    inv_info._check_consistency()
+    inv['info'] = inv_info
+    return InverseOperator(inv)
+
+
+def make_inverse_operators(info, specs, n_jobs=1, verbose=True):
+    """Make and write inverse operators from a list of specifications.
+
+    Parameters
+    ----------
+    info : instance of Info
+        The measurement info.
+    specs : list of tuple
+        Each element is ``(fwd_fname, cov_fname, fname, options)`` where
+        ``options`` is a dict of the ``loose``, ``depth``, ``fixed``,
+        ``rank`` and ``use_cps`` arguments of
+        :func:`mne.minimum_norm.make_inverse_operator`. It can also contain
+        ``diag=True`` to only use the diagonal of the noise covariance.
+    n_jobs : int
+        Number of worker processes computing the SVDs.
+    verbose : bool
+        Print the time spent in the shared steps and in the SVD of each
+        operator.
+
+    Returns
+    -------
+    steps : dict
+        The ``(time, uses)`` of each shared step: the time in seconds it
+        took and the number of operators using its result.
+    """
+    timer = _Timer()
+    jobs = dict()
+    for fwd_fname, cov_fname, fname, options in specs:
+        fwd = timer.get('read forward %s' % fwd_fname,
+                        mne.read_forward_solution, fwd_fname)
+        options = _parse_options(options, fwd['src'].kind)
+        loose, depth = options['loose'], options['depth']
+        cov_key = 'read covariance %s' % cov_fname
+        noise_cov = timer.get(cov_key, mne.read_cov, cov_fname)
+        if options['diag']:
+            cov_key = 'diagonal of %s' % cov_fname
+            noise_cov = timer.get(cov_key, _diagonal, noise_cov)
+
+        _check_forward(fwd, loose, depth)
+        fwd_key = fwd_fname
+        orientation = _orientation(fwd, loose, depth)
+        if orientation is not None:
+            fwd_key = '%s (%s)' % (fwd_fname, orientation)
+            fwd = timer.get(fwd_key, _orient_forward, fwd, orientation)
+        # the channels only depend on the names and bads of the covariance,
+        # not on its diagonal
+        fwd_key = 'channels of %s for %s' % (fwd_key, cov_fname)
+        fwd, info_picked = timer.get(fwd_key, _select_channels, fwd, info,
+                                     noise_cov)
+        whitener_key = 'whitener of %s, rank=%r (%s)' % (
+            cov_key, options['rank'], fwd_key)
+        noise_cov, whitener = timer.get(
+            whitener_key, _whitener, noise_cov, info,
+            info_picked['ch_names'], options['rank'])
+        depth_key = 'depth prior %s (%s)' % (', '.join(
+            '%s=%s' % item for item in sorted(depth.items())), fwd_key)
+        if depth['limit_depth_chs'] == 'whiten':
+            depth_key += ' (%s)' % cov_key
+        depth_prior = None
+        if depth['exp'] is not None:
+            depth_prior = timer.get(
+                depth_key, compute_depth_prior, fwd, info_picked,
+                exp=depth['exp'], limit_depth_chs=depth['limit_depth_chs'],
+                combine_xyz=depth['combine_xyz'], limit=depth['limit'],
+                noise_cov=noise_cov, verbose=False)
+        orient_key = 'orientation prior loose=%s (%s)' % (loose, fwd_key)
+        orient_prior = None
+        if loose == 0.:
+            if not is_fixed_orient(fwd):
+                fwd_key = 'fixed orientation, use_cps=%s, of %s' % (
+                    options['use_cps'], depth_key)
+                fwd, depth_prior = timer.get(
+                    fwd_key, _fixed_forward, fwd, depth_prior,
+                    options['use_cps'])
+        else:
+            orient_prior = timer.get(orient_key, compute_orient_prior, fwd,
+                                     loose=loose, verbose=False)
+        key = (fwd_key, whitener_key, depth_key, orient_key)
+        if key not in jobs:
+            jobs[key] = (fwd_key, whitener_key, (fwd, info_picked),
+                         (noise_cov, whitener), (depth_key, depth_prior),
+                         (orient_key, orient_prior), list())
+        jobs[key][-1].append(fname)
+
+    # only the prepared steps used by the operators go to the workers
+    timer.results.clear()
+    context = dict(info=info, fwds=dict(), whiteners=dict(), priors=dict())
+    for fwd_key, whitener_key, fwd, whitener, depth, orient, _ in \
+            jobs.values():
+        context['fwds'][fwd_key] = fwd
+        context['whiteners'][whitener_key] = whitener
+        context['priors'].update([depth, orient])
+    jobs = [(fwd_key, whitener_key, depth[0], orient[0], fnames)
+            for fwd_key, whitener_key, _, _, depth, orient, fnames in
+            jobs.values()]
+    n_jobs = min(max(int(n_jobs), 1), len(jobs))
+    if n_jobs == 1:
+        _init_worker(context)
+        try:
+            records = [_make_operator(job) for job in jobs]
+        finally:
+            _context.clear()
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(context,)) as executor:
+            records = list(executor.map(_make_operator, jobs))
+    # the operators are steps of the calling stage in the reports
+    profiling._steps.extend(records)
+    if verbose:
+        timer.report(records)
+    return dict((name, tuple(step)) for name, step in timer.steps.items())
+
+
+class InverseKernel(object):
+    """An inverse operator applied to many data sets with shared kernels.
+
+    Parameters
+    ----------
+    inverse_operator : instance of InverseOperator
+        The inverse operator, not prepared.
+    lambda2 : float
+        The regularization parameter.
+    method : 'MNE' | 'dSPM' | 'sLORETA'
+        The inverse method.
+    pick_ori : None | 'normal' | 'vector'
+        The orientation of the estimates, as in
+        :func:`mne.minimum_norm.apply_inverse`.
+    label : instance of Label | None
+        Restrict the estimates to a label.
+    """
+
+    def __init__(self, inverse_operator, lambda2=1. / 9., method='dSPM',
+                 pick_ori=None, label=None):
+        _check_ori(pick_ori, inverse_operator['source_ori'])
+        self.inv = inverse_operator
+        self.lambda2 = lambda2
+        self.method = method
+        self.pick_ori = pick_ori
+        self.label = label
+        self.subject = _subject_from_inverse(inverse_operator)
+        self._kernels = dict()
+
+    def _kernel(self, info, nave):
+        """The kernel for a number of averages and channels, made once."""
+        key = (nave, tuple(info['ch_names']))
+        if key not in self._kernels:
+            _check_ch_names(self.inv, info)
+            inv = prepare_inverse_operator(self.inv, nave, self.lambda2,
+                                           self.method)
+            sel = _pick_channels_inverse_operator(info['ch_names'], inv)
+            K, noise_norm, vertno, source_nn = _assemble_kernel(
+                inv, self.label, self.method, self.pick_ori)
+            combine = (self.inv['source_ori'] == FIFF.FIFFV_MNE_FREE_ORI and
+                       self.pick_ori is None)
+            if noise_norm is not None:
+                if self.pick_ori == 'vector':
+                    noise_norm = noise_norm.repeat(3, axis=0)
+                if not combine:
+                    # linear: the normalization goes in the kernel
+                    K *= noise_norm
+                    noise_norm = None
+            self._kernels[key] = (sel, K, noise_norm, vertno, source_nn,
+                                  combine,
+                                  _get_src_type(self.inv['src'], vertno))
+        return self._kernels[key]
+
+    def _apply(self, data, info, tmin, nave):
+        """Estimates of data sets sharing their info and number of averages.
+
+        The data sets are stacked along time, the kernel and the component
+        combination being applied to all of them at once.
+        """
+        sel, K, noise_norm, vertno, source_nn, combine, src_type = \
+            self._kernel(info, nave)
+        sol = np.dot(K, np.concatenate([d[sel] for d in data], axis=1))
+        if combine:
+            sol = combine_xyz(sol)
+        if noise_norm is not None:
+            sol *= noise_norm
+        stcs, start = list(), 0
+        for d in data:
+            stcs.append(_make_stc(
+                sol[:, start:start + d.shape[1]], vertno, tmin=tmin,
+                tstep=1. / info['sfreq'], subject=self.subject,
+                vector=(self.pick_ori == 'vector'), source_nn=source_nn,
+                src_type=src_type))
+            start += d.shape[1]
+        return stcs
+
+    def apply_evokeds(self, evokeds, batch_size=16):
+        """Estimate the sources of evoked responses, e.g. of conditions.
+
+        Parameters
+        ----------
+        evokeds : iterable of Evoked
+            The evoked responses. Those with the same number of averages
+            and channels share their kernel and are processed together.
+        batch_size : int
+            Number of evoked responses processed at once.
+
+        Returns
+        -------
+        stcs : generator of SourceEstimate
+            The estimates, in the order of ``evokeds``.
+        """
+        batch = list()
+        for evoked in evokeds:
+            batch.append(evoked)
+            if len(batch) == batch_size:
+                for stc in self._apply_evoked_batch(batch):
+                    yield stc
+                batch = list()
+        for stc in self._apply_evoked_batch(batch):
+            yield stc
+
+    def _apply_evoked_batch(self, batch):
+        groups = dict()
+        for ii, evoked in enumerate(batch):
+            key = (evoked.nave, tuple(evoked.ch_names),
+                   float(evoked.times[0]), evoked.info['sfreq'])
+            groups.setdefault(key, list()).append(ii)
+        stcs = [None] * len(batch)
+        for idx in groups.values():
+            evoked = batch[idx[0]]
+            for ii, stc in zip(idx, self._apply(
+                    [batch[ii].data for ii in idx], evoked.info,
+                    float(evoked.times[0]), evoked.nave)):
+                stcs[ii] = stc
+        return stcs
+
+    def apply_epochs(self, epochs, batch_size=16):
+        """Estimate the sources of each epoch, reading epochs in batches.
+
+        Parameters
+        ----------
+        epochs : instance of Epochs
+            The epochs, read one after the other if not preloaded.
+        batch_size : int
+            Number of epochs processed at once. The estimates of a batch
+            are in memory together, with free orientations three times.
+
+        Returns
+        -------
+        stcs : generator of SourceEstimate
+            The estimates of the epochs.
+        """
+        tmin = float(epochs.times[0])
+        batch = list()
+        for data in epochs:
+            batch.append(data)
+            if len(batch) == batch_size:
+                for stc in self._apply(batch, epochs.info, tmin, 1):
+                    yield stc
+                batch = list()
+        if batch:
+            for stc in self._apply(batch, epochs.info, tmin, 1):
+                yield stc
+
+
+def save_stcs(stcs, fnames, ftype='stc'):
+    """Write source estimates as they are produced.
+
+    Parameters
+    ----------
+    stcs : iterable of SourceEstimate
+        The estimates, e.g. from :class:`InverseKernel`.
+    fnames : iterable of str
+        The file name of each estimate, without the hemisphere suffixes.
+    ftype : str
+        The file type passed to ``stc.save``.
+
+    Returns
+    -------
+    fnames : list of str
+        The file names written.
+    """
+    written = list()
+    for stc, fname in zip(stcs, fnames):
+        stc.save(fname, ftype=ftype)
+        written.append(fname)
+    return written
@@ -0,0 +1,157 @@
+"""Morph source estimates with operators cached on disk.
+
+Computing the sparse morphing matrix between two subjects is much more
+expensive than applying it. The matrices are therefore saved in a cache
+directory, keyed on the subjects, the source vertices, the target grade,
+the smoothing steps and the content of the sphere registrations and morph
+maps they are computed from. Morphing an estimate with a cached operator
+is a single sparse-dense product.
+
+The cache is kept outside of the subjects directory, by default in
+``~/.cache/mne-scripts/morph``, so that it is not distributed with the
+data.
+"""
+# License: BSD (3-clause)
+import hashlib
+import os
+import os.path as op
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+import mne
+from mne.morph import _compute_morph_matrix
+from mne.utils import get_subjects_dir
+
+from cache import _hash_file
+
+default_cache_dir = op.join(op.expanduser('~'), '.cache', 'mne-scripts',
+                            'morph')
+
+
+def _morph_files(subject_from, subject_to, subjects_dir):
+    """Files a morphing matrix between two subjects is computed from.
+
+    The morph maps are made first if they do not exist, so that the files
+    and thus the cache key are the same before and after the first run.
+    """
+    map_names = [op.join(subjects_dir, 'morph-maps', '%s-%s-morph.fif' % pair)
+                 for pair in ((subject_from, subject_to),
+                              (subject_to, subject_from))]
+    if not any(op.isfile(fname) for fname in map_names):
+        mne.read_morph_map(subject_from, subject_to, subjects_dir)
+    fnames = list()
+    for subject in (subject_from, subject_to):
+        for hemi in ('lh', 'rh'):
+            fnames.append(op.join(subjects_dir, subject, 'surf',
+                                  '%s.sphere.reg' % hemi))
+    return fnames + map_names
+
+
+def _operator_key(subject_from, subject_to, vertices_from, grade, smooth,
+                  subjects_dir):
+    h = hashlib.sha1()
+    h.update(repr((subject_from, subject_to, smooth,
+                   mne.__version__)).encode('utf-8'))
+    if grade is None or isinstance(grade, int):
+        h.update(repr(grade).encode('utf-8'))
+    else:
+        for verts in grade:
+            h.update(np.asarray(verts, np.int64).tobytes())
+    for verts in vertices_from:
+        h.update(b'|' + np.asarray(verts, np.int64).tobytes())
+    for fname in _morph_files(subject_from, subject_to, subjects_dir):
+        h.update(b'|' + op.relpath(fname, subjects_dir).encode('utf-8'))
+        if op.isfile(fname):
+            h.update(_hash_file(fname).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _write_operator(fname, morph_mat, vertices_to):
+    morph_mat = sparse.csr_matrix(morph_mat)
+    # a unique temporary file, as other processes may write the same operator
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=op.dirname(fname))
+    with os.fdopen(fd, 'wb') as fid:
+        np.savez_compressed(fid, data=morph_mat.data,
+                            indices=morph_mat.indices,
+                            indptr=morph_mat.indptr,
+                            shape=np.array(morph_mat.shape),
+                            vertices_lh=vertices_to[0],
+                            vertices_rh=vertices_to[1])
+    os.rename(tmp, fname)
+
+
+def _read_operator(fname):
+    with np.load(fname) as npz:
+        morph_mat = sparse.csr_matrix(
+            (npz['data'], npz['indices'], npz['indptr']),
+            shape=tuple(npz['shape']))
+        vertices_to = [npz['vertices_lh'], npz['vertices_rh']]
+    return morph_mat, vertices_to
+
+
+def get_morph_operator(subject_from, subject_to, vertices_from, grade=5,
+                       smooth=None, subjects_dir=None, cache_dir=None):
+    """Get the morphing matrix, computing it only if it is not cached.
+
+    Parameters
+    ----------
+    subject_from : str
+        The subject the source estimates are defined on.
+    subject_to : str
+        The subject to morph to.
+    vertices_from : list of array of int
+        The vertices of the source estimates, for each hemisphere.
+    grade : int | list of array of int | None
+        The target vertices, as in :meth:`mne.SourceEstimate.morph`.
+    smooth : int | None
+        Number of smoothing iterations.
+    subjects_dir : str | None
+        The FreeSurfer subjects directory.
+    cache_dir : str | None
+        Directory of the cached operators. Defaults to
+        ``~/.cache/mne-scripts/morph``.
+
+    Returns
+    -------
+    morph_mat : sparse matrix
+        The morphing matrix.
+    vertices_to : list of array of int
+        The vertices of the morphed source estimates.
+    """
+    subjects_dir = get_subjects_dir(subjects_dir, raise_error=True)
+    if cache_dir is None:
+        cache_dir = default_cache_dir
+    if not op.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    key = _operator_key(subject_from, subject_to, vertices_from, grade,
+                        smooth, subjects_dir)
+    fname = op.join(cache_dir, '%s-%s-%s-morph.npz'
+                    % (subject_from, subject_to, key))
+    if op.isfile(fname):
+        return _read_operator(fname)
+
+    if grade is None or isinstance(grade, int):
+        vertices_to = mne.grade_to_vertices(subject_to, grade, subjects_dir)
+    else:
+        vertices_to = grade
+    morph_mat = _compute_morph_matrix(subject_from, subject_to,
+                                      vertices_from, vertices_to,
+                                      smooth=smooth,
+                                      subjects_dir=subjects_dir)
+    _write_operator(fname, morph_mat, vertices_to)
+    return morph_mat, vertices_to
+
+
+def morph_stc(stc, subject_to, grade=5, smooth=None, subjects_dir=None,
+              cache_dir=None):
+    """Morph a source estimate, like stc.morph but with a cached operator.
+
+    See :func:`get_morph_operator` for the parameters.
+    """
+    morph_mat, vertices_to = get_morph_operator(
+        stc.subject, subject_to, stc.vertices, grade=grade, smooth=smooth,
+        subjects_dir=subjects_dir, cache_dir=cache_dir)
+    return mne.SourceEstimate(morph_mat * stc.data, vertices_to, stc.tmin,
+                              stc.tstep, subject=subject_to)
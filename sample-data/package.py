@@ -0,0 +1,377 @@
+"""Pack dataset bundles with parallel compression, deduplication and indexes.
+
+The archives are ordinary ``.tar.bz2`` files that ``tar -xjf`` extracts,
+but the bzip2 data is made of independent streams of ``block_size`` bytes
+of the tar file each, compressed concurrently by a pool of threads, and
+the tar file is written straight from the source directories, under the
+names given for them, without copying them to a staging directory first.
+
+Identical files within a bundle are stored once, the copies being tar hard
+links. With ``--shared``, files found in several bundles are stored once in
+a separate shared archive, that must then be downloaded with the bundles,
+which are extracted with ``package.py extract`` rather than ``tar``.
+
+Each archive comes with a JSON manifest (``<archive>.json``) giving the
+SHA-256 of every file, the position of its data in the tar file and the
+positions of the bzip2 streams, so that a member is extracted by only
+decompressing the streams it spans::
+
+    python package.py pack $OUT --bundle bst_raw \\
+        bst_raw/MEG/bst_raw=$TMPDIR/sample_raw/data \\
+        bst_raw/subjects/bst_raw=$SUBJECTS_DIR/bst_raw --n-jobs 8
+    python package.py extract $OUT/bst_raw.tar.bz2 out 'bst_raw/MEG/*'
+"""
+# License: BSD (3-clause)
+import argparse
+import bz2
+import fnmatch
+import hashlib
+import json
+import os
+import os.path as op
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_CHUNK = 1024 * 1024
+
+
+class ParallelBZ2Writer(object):
+    """A file object compressing fixed size blocks in parallel threads.
+
+    The blocks are written in order as independent bzip2 streams, whose
+    ``(offset, compressed_offset, compressed_size)`` are kept in
+    ``blocks``.
+    """
+
+    def __init__(self, fname, n_jobs=1, block_size=8 * 1024 * 1024):
+        self._fid = open(fname, 'wb')
+        self._executor = ThreadPoolExecutor(max_workers=n_jobs)
+        self._max_pending = 2 * n_jobs
+        self._pending = deque()
+        self._buf = list()
+        self._buf_size = 0
+        self.block_size = block_size
+        self.blocks = list()
+        self._offset = 0  # uncompressed bytes written
+        self._block_offset = 0  # uncompressed offset of the next block
+
+    def tell(self):
+        return self._offset
+
+    def _flush_one(self):
+        offset, future = self._pending.popleft()
+        data = future.result()
+        self.blocks.append((offset, self._fid.tell(), len(data)))
+        self._fid.write(data)
+
+    def _submit(self):
+        data = b''.join(self._buf)
+        self._buf, self._buf_size = list(), 0
+        self._pending.append((self._block_offset,
+                              self._executor.submit(bz2.compress, data, 9)))
+        self._block_offset += len(data)
+        while len(self._pending) > self._max_pending:
+            self._flush_one()
+
+    def write(self, data):
+        self._buf.append(bytes(data))
+        self._buf_size += len(data)
+        self._offset += len(data)
+        if self._buf_size >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def close(self):
+        if self._buf_size:
+            self._submit()
+        while self._pending:
+            self._flush_one()
+        self._executor.shutdown()
+        self._fid.close()
+
+
+def _sha256(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _walk(mapping):
+    """The (arcname, path) of the entries of the mapped trees, sorted."""
+    entries = list()
+    for arcname, src in sorted(mapping.items()):
+        entries.append((arcname, src))
+        if op.isdir(src) and not op.islink(src):
+            for dirpath, dirnames, filenames in os.walk(src):
+                dirnames.sort()
+                rel = op.relpath(dirpath, src)
+                for name in dirnames + sorted(filenames):
+                    path = op.join(dirpath, name)
+                    entries.append(('/'.join(
+                        [arcname] + ([] if rel == '.' else rel.split(os.sep)) +
+                        [name]), path))
+    return entries
+
+
+def _hash_files(entries, n_jobs):
+    """The SHA-256 of the regular files, computed in parallel."""
+    files = [path for _, path in entries
+             if op.isfile(path) and not op.islink(path)]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return dict(zip(files, executor.map(_sha256, files)))
+
+
+def _write_archive(fname, entries, hashes, shared, n_jobs, block_size):
+    """Write a tar.bz2 archive and return its manifest."""
+    writer = ParallelBZ2Writer(fname, n_jobs, block_size)
+    members, first = list(), dict()
+    with tarfile.open(fileobj=writer, mode='w',
+                      format=tarfile.PAX_FORMAT) as tar:
+        for arcname, path in entries:
+            info = tar.gettarinfo(path, arcname)
+            if info.islnk():
+                # a second hard link to a file already added: stored as a
+                # file, hence as a link to its first copy if not shared
+                info.type = tarfile.REGTYPE
+                info.linkname = ''
+                info.size = os.stat(path).st_size
+            info.uname = info.gname = ''
+            info.uid = info.gid = 0
+            member = dict(name=arcname)
+            if info.isfile():
+                sha = hashes[path]
+                member.update(type='file', size=info.size, sha256=sha)
+                if sha in shared:
+                    member['archive'] = shared[sha]
+                    members.append(member)
+                    continue
+                if sha in first:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = first[sha]
+                    info.size = 0
+                    member.update(link=first[sha])
+                    tar.addfile(info)
+                else:
+                    first[sha] = arcname
+                    with open(path, 'rb') as fid:
+                        tar.addfile(info, fid)
+                    member['data_offset'] = tar.offset - (
+                        (info.size + tarfile.BLOCKSIZE - 1) //
+                        tarfile.BLOCKSIZE * tarfile.BLOCKSIZE)
+            else:
+                member['type'] = 'symlink' if info.issym() else 'dir'
+                if info.issym():
+                    member['link'] = info.linkname
+                tar.addfile(info)
+            members.append(member)
+    writer.close()
+    return dict(archive=op.basename(fname), blocks=writer.blocks,
+                members=members)
+
+
+def _write_manifest(fname, manifest):
+    with open(fname + '.json', 'w') as fid:
+        json.dump(manifest, fid, indent=1, sort_keys=True)
+
+
+def pack(out_dir, bundles, shared_name=None, n_jobs=1,
+         block_size=8 * 1024 * 1024):
+    """Pack bundles of directories into indexed .tar.bz2 archives.
+
+    Parameters
+    ----------
+    out_dir : str
+        The directory of the archives and their manifests.
+    bundles : dict
+        For each bundle name, a dict mapping names in the archive to the
+        files or directories stored under them.
+    shared_name : str | None
+        If not None, the files found in several bundles are stored once,
+        in the archive of that name.
+    n_jobs : int
+        Number of threads hashing and compressing.
+    block_size : int
+        Size in bytes of the independently compressed blocks.
+
+    Returns
+    -------
+    fnames : list of str
+        The archives written.
+    """
+    if not op.isdir(out_dir):
+        os.makedirs(out_dir)
+    entries = dict((name, _walk(mapping)) for name, mapping in
+                   bundles.items())
+    hashes = _hash_files(sum(entries.values(), []), n_jobs)
+
+    shared, shared_entries = dict(), list()
+    if shared_name is not None:
+        bundles_of, paths = dict(), dict()
+        for name, these in entries.items():
+            for _, path in these:
+                if path in hashes:
+                    bundles_of.setdefault(hashes[path], set()).add(name)
+                    paths[hashes[path]] = path
+        for sha, names in sorted(bundles_of.items()):
+            if len(names) > 1:
+                shared[sha] = shared_name + '.tar.bz2'
+                shared_entries.append((sha, paths[sha]))
+
+    fnames = list()
+    if shared_entries:
+        fnames.append(op.join(out_dir, shared_name + '.tar.bz2'))
+        print('Packing %s' % op.basename(fnames[-1]))
+        manifest = _write_archive(fnames[-1], shared_entries, hashes,
+                                  dict(), n_jobs, block_size)
+        _write_manifest(fnames[-1], manifest)
+    for name in sorted(entries):
+        fnames.append(op.join(out_dir, name + '.tar.bz2'))
+        print('Packing %s' % op.basename(fnames[-1]))
+        manifest = _write_archive(fnames[-1], entries[name], hashes, shared,
+                                  n_jobs, block_size)
+        _write_manifest(fnames[-1], manifest)
+    return fnames
+
+
+def read_manifest(fname):
+    with open(fname + '.json') as fid:
+        return json.load(fid)
+
+
+class _BlockReader(object):
+    """Read ranges of the tar data of an archive, block by block."""
+
+    def __init__(self, fname, blocks):
+        self._fid = open(fname, 'rb')
+        self._blocks = blocks
+        self._cache = (None, None)
+
+    def _block(self, idx):
+        if self._cache[0] != idx:
+            _, offset, size = self._blocks[idx]
+            self._fid.seek(offset)
+            self._cache = (idx, bz2.decompress(self._fid.read(size)))
+        return self._cache[1]
+
+    def copy(self, start, size, fout):
+        """Copy ``size`` bytes from ``start`` to a file object."""
+        starts = [block[0] for block in self._blocks]
+        idx = max(i for i, s in enumerate(starts) if s <= start)
+        while size > 0:
+            data = self._block(idx)
+            begin = start - self._blocks[idx][0]
+            chunk = data[begin:begin + size]
+            fout.write(chunk)
+            start += len(chunk)
+            size -= len(chunk)
+            idx += 1
+
+    def close(self):
+        self._fid.close()
+
+
+def extract(fname, out_dir, patterns=None):
+    """Extract members of an archive, decompressing only what is needed.
+
+    Parameters
+    ----------
+    fname : str
+        The archive, with its manifest next to it.
+    out_dir : str
+        The directory the members are written to.
+    patterns : list of str | None
+        Shell patterns of the member names to extract. None extracts all.
+        Files stored in a shared archive are read from it, in the same
+        directory.
+
+    Returns
+    -------
+    names : list of str
+        The members extracted.
+    """
+    manifest = read_manifest(fname)
+    readers = dict()
+
+    def reader(archive):
+        """The block reader and the stored files by SHA-256 of an archive."""
+        if archive not in readers:
+            path = op.join(op.dirname(fname), archive)
+            this = manifest if archive == manifest['archive'] else \
+                read_manifest(path)
+            readers[archive] = (_BlockReader(path, this['blocks']),
+                                dict((m['sha256'], m) for m in this['members']
+                                     if 'data_offset' in m))
+        return readers[archive]
+
+    names = list()
+    try:
+        for member in manifest['members']:
+            if patterns is not None and not any(
+                    fnmatch.fnmatch(member['name'], pattern)
+                    for pattern in patterns):
+                continue
+            target = op.join(out_dir, *member['name'].split('/'))
+            names.append(member['name'])
+            if member['type'] == 'dir':
+                if not op.isdir(target):
+                    os.makedirs(target)
+                continue
+            if not op.isdir(op.dirname(target)):
+                os.makedirs(op.dirname(target))
+            if op.lexists(target):
+                os.remove(target)
+            if member['type'] == 'symlink':
+                os.symlink(member['link'], target)
+            else:
+                this_reader, stored = reader(
+                    member.get('archive', manifest['archive']))
+                stored = stored[member['sha256']]
+                with open(target, 'wb') as fout:
+                    this_reader.copy(stored['data_offset'], stored['size'],
+                                     fout)
+    finally:
+        for this_reader, _ in readers.values():
+            this_reader.close()
+    return names
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Pack and extract indexed dataset archives.')
+    sub = parser.add_subparsers(dest='command')
+    pack_parser = sub.add_parser('pack', help='pack bundles')
+    pack_parser.add_argument('out_dir', help='directory of the archives')
+    pack_parser.add_argument('--bundle', nargs='+', action='append',
+                             required=True,
+                             help='bundle name followed by the directories '
+                                  'it contains, as name_in_archive=path')
+    pack_parser.add_argument('--shared', default=None,
+                             help='archive of the files found in several '
+                                  'bundles')
+    pack_parser.add_argument('--n-jobs', type=int, default=os.cpu_count())
+    pack_parser.add_argument('--block-size', type=float, default=8.,
+                             help='size of the compressed blocks in MB')
+    extract_parser = sub.add_parser('extract', help='extract members')
+    extract_parser.add_argument('archive')
+    extract_parser.add_argument('out_dir')
+    extract_parser.add_argument('patterns', nargs='*',
+                                help='patterns of the members to extract')
+    args = parser.parse_args()
+    if args.command == 'pack':
+        bundles = dict((spec[0], dict(item.split('=', 1)
+                                      for item in spec[1:]))
+                       for spec in args.bundle)
+        pack(args.out_dir, bundles, args.shared, args.n_jobs,
+             int(args.block_size * 1024 * 1024))
+    elif args.command == 'extract':
+        names = extract(args.archive, args.out_dir, args.patterns or None)
+        print('Extracted %d members' % len(names))
+    else:
+        parser.print_help()
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
@@ -0,0 +1,224 @@
+"""Run the stages of a data generation script as a dependency graph.
+
+Each :class:`Stage` declares the files it reads and the files it writes.
+A stage becomes ready once every stage producing one of its inputs has
+finished, and ready stages are executed in a process pool as long as the
+sum of their ``n_jobs`` stays within a global CPU budget.
+
+Stage functions must be defined at module level so that they can be sent
+to the worker processes, and they must only communicate through files.
+This also allows their outputs to be reused from an
+:class:`cache.ArtifactCache` when their inputs did not change.
+"""
+# License: BSD (3-clause)
+import json
+import os
+import os.path as op
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import profiling
+from profiling import StageProfiler, write_report, print_summary
+
+
+class Stage(object):
+    """A single step of a pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the stage.
+    func : callable
+        Module level function called as ``func(**kwargs)``.
+    inputs : list of str
+        Files read by the stage.
+    outputs : list of str
+        Files written by the stage.
+    **kwargs
+        Keyword arguments passed to ``func``. If it contains ``n_jobs``,
+        that many CPUs of the budget are reserved while the stage runs.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), **kwargs):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.kwargs = kwargs
+
+    @property
+    def n_jobs(self):
+        return self.kwargs.get('n_jobs', 1)
+
+    def __repr__(self):
+        return '<Stage | %s>' % self.name
+
+
+def _stage_dependencies(stages):
+    """Map each stage name to the names of the stages it depends on."""
+    producers = dict()
+    for stage in stages:
+        for fname in stage.outputs:
+            if fname in producers:
+                raise ValueError('%s is written by both %s and %s'
+                                 % (fname, producers[fname], stage.name))
+            producers[fname] = stage.name
+    deps = dict()
+    for stage in stages:
+        deps[stage.name] = set()
+        for fname in stage.inputs:
+            if fname in producers:
+                deps[stage.name].add(producers[fname])
+            elif not op.exists(fname):
+                raise RuntimeError('Input %s of stage %s does not exist and '
+                                   'is not produced by any stage'
+                                   % (fname, stage.name))
+    return deps
+
+
+def _check_acyclic(deps):
+    """Raise an error if the dependency graph contains a cycle."""
+    deps = dict((name, set(d)) for name, d in deps.items())
+    while deps:
+        free = [name for name, d in deps.items() if not d]
+        if not free:
+            raise ValueError('The stages %s form a dependency cycle'
+                             % sorted(deps))
+        for name in free:
+            del deps[name]
+        for d in deps.values():
+            d.difference_update(free)
+
+
+def _run_stage(stage):
+    """Execute one stage, this runs in a worker process."""
+    for fname in stage.outputs:
+        dirname = op.dirname(fname)
+        if dirname and not op.isdir(dirname):
+            os.makedirs(dirname)
+    del profiling._steps[:]
+    with StageProfiler(stage.name) as profiler:
+        stage.func(**stage.kwargs)
+    missing = [fname for fname in stage.outputs if not op.exists(fname)]
+    if missing:
+        raise RuntimeError('Stage %s did not write %s'
+                           % (stage.name, ', '.join(missing)))
+    profiler.record['n_jobs'] = stage.n_jobs
+    profiler.record['steps'] = list(profiling._steps)
+    return profiler.record
+
+
+def _read_checkpoint(fname):
+    """Names of the stages recorded as finished in a checkpoint file."""
+    if fname is None or not op.isfile(fname):
+        return set()
+    with open(fname) as fid:
+        return set(json.load(fid)['finished'])
+
+
+def _write_checkpoint(fname, finished):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as fid:
+        json.dump(dict(finished=sorted(finished)), fid, indent=2)
+    os.rename(tmp, fname)
+
+
+def run_stages(stages, n_jobs=1, cache=None, report=None, checkpoint=None,
+               verbose=True):
+    """Run stages concurrently while respecting their dependencies.
+
+    Parameters
+    ----------
+    stages : list of Stage
+        The stages to run.
+    n_jobs : int
+        Global CPU budget. Stages whose own ``n_jobs`` exceeds the budget
+        are run alone with ``n_jobs`` lowered to the budget.
+    cache : ArtifactCache | None
+        If not None, stages found in the cache are skipped and their
+        outputs restored, and the outputs of the other stages are added to
+        the cache once they finished.
+    report : str | None
+        If not None, a JSON file where the resources used by each stage
+        are written. A summary table is also printed.
+    checkpoint : str | None
+        If not None, a JSON file where the finished stages are recorded.
+        When restarting after a failure, the stages it lists whose outputs
+        all exist are skipped.
+    verbose : bool
+        Print when stages start and finish.
+
+    Returns
+    -------
+    order : list of str
+        The names of the stages in the order they finished.
+    """
+    n_jobs = max(int(n_jobs), 1)
+    by_name = dict()
+    for stage in stages:
+        if stage.name in by_name:
+            raise ValueError('Duplicate stage name %s' % stage.name)
+        by_name[stage.name] = stage
+    deps = _stage_dependencies(stages)
+    _check_acyclic(deps)
+
+    checkpointed = _read_checkpoint(checkpoint)
+    pending = [stage.name for stage in stages]
+    running = dict()
+    order = list()
+    records = list()
+    used = 0
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        while pending or running:
+            for name in list(pending):
+                stage = by_name[name]
+                if deps[name].difference(order):
+                    continue
+                if name in checkpointed and all(op.exists(fname) for fname
+                                                in stage.outputs):
+                    if verbose:
+                        print('Skipped %s, finished before' % name)
+                    pending.remove(name)
+                    order.append(name)
+                    continue
+                if cache is not None and cache.restore(stage):
+                    if verbose:
+                        print('Restored %s from the cache' % name)
+                    pending.remove(name)
+                    order.append(name)
+                    continue
+                cost = min(stage.n_jobs, n_jobs)
+                if used + cost > n_jobs:
+                    continue
+                if cost < stage.n_jobs:
+                    stage.kwargs['n_jobs'] = cost
+                if verbose:
+                    print('Starting %s (n_jobs=%d)' % (name, cost))
+                pending.remove(name)
+                running[executor.submit(_run_stage, stage)] = (name, cost)
+                used += cost
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, cost = running.pop(future)
+                used -= cost
+                try:
+                    records.append(future.result())
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+                if cache is not None:
+                    cache.store(by_name[name])
+                order.append(name)
+                if checkpoint is not None:
+                    _write_checkpoint(checkpoint, order)
+                if verbose:
+                    print('Finished %s' % name)
+    if report is not None:
+        write_report(report, records, n_jobs=n_jobs,
+                     restored=[name for name in order
+                               if name not in [rec['name']
+                                               for rec in records]])
+        print_summary(records)
+    return order
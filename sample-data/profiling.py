@@ -0,0 +1,305 @@
+"""Measure the resources used by each stage of the data generation scripts.
+
+:class:`StageProfiler` records, for a block of code, the wall and CPU time
+(including the child processes such as FreeSurfer commands), the peak
+resident memory of the process and of its children, the bytes read from
+and written to disk and the largest number of threads and child processes.
+The memory is sampled from ``/proc``, or with psutil if it is installed
+where ``/proc`` is not available. Reports are written as JSON and can
+be compared to find regressions, e.g. after upgrading mne::
+
+    python profiling.py old_report.json new_report.json
+"""
+# License: BSD (3-clause)
+import argparse
+import json
+import os
+import os.path as op
+import platform
+import resource
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_PROC = op.isdir('/proc/self')
+
+
+def _proc_status(key, pid='self'):
+    """Read a value of /proc/<pid>/status, None if not available."""
+    if not _PROC:
+        return None
+    try:
+        with open('/proc/%s/status' % pid) as fid:
+            for line in fid:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError):  # the process exited
+        pass
+    return None
+
+
+def _proc_io():
+    """Bytes read and written by this process, from /proc/self/io."""
+    counts = dict(read_bytes=0, write_bytes=0)
+    if _PROC and op.isfile('/proc/self/io'):
+        try:
+            with open('/proc/self/io') as fid:
+                for line in fid:
+                    key, value = line.split(':')
+                    if key in counts:
+                        counts[key] = int(value)
+        except (IOError, OSError):  # not readable in some containers
+            pass
+    return counts
+
+
+def _children(pid='self'):
+    """The ids of the direct child processes of a process."""
+    children = set()
+    if not _PROC:
+        return children
+    try:
+        for tid in os.listdir('/proc/%s/task' % pid):
+            fname = op.join('/proc/%s/task' % pid, tid, 'children')
+            with open(fname) as fid:
+                children.update(fid.read().split())
+    except (IOError, OSError):  # the process exited
+        pass
+    return children
+
+
+def _n_children():
+    """Number of direct child processes."""
+    return len(_children())
+
+
+def _children_rss():
+    """Resident memory of all the descendant processes together, in bytes."""
+    if _PROC:
+        rss, pids, seen = 0, _children(), set()
+        while pids:
+            pid = pids.pop()
+            if pid not in seen:
+                seen.add(pid)
+                rss += (_proc_status('VmRSS', pid) or 0) * 1024
+                pids.update(_children(pid))
+        return rss
+    if psutil is not None:
+        rss = 0
+        for child in psutil.Process().children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:  # the process exited
+                pass
+        return rss
+    return 0
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1], times[2] + times[3]
+
+
+class StageProfiler(object):
+    """Profile a block of code, used as a context manager.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    interval : float
+        Interval in seconds at which the memory and the number of threads
+        and processes are sampled.
+
+    Attributes
+    ----------
+    record : dict
+        The measurements, available after the block exited.
+    """
+
+    def __init__(self, name, interval=0.1):
+        self.name = name
+        self.interval = interval
+        self.record = None
+
+    def _sample(self):
+        rss = _proc_status('VmRSS')
+        if rss is not None:
+            self._peak_rss = max(self._peak_rss, rss * 1024)
+        elif psutil is not None:
+            self._peak_rss = max(self._peak_rss,
+                                 psutil.Process().memory_info().rss)
+        self._children_rss = max(self._children_rss, _children_rss())
+        self._n_threads = max(self._n_threads,
+                              _proc_status('Threads') or
+                              threading.active_count())
+        self._n_processes = max(self._n_processes, 1 + _n_children())
+
+    def _monitor(self):
+        while not self._done.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._peak_rss, self._n_threads, self._n_processes = 0, 0, 1
+        self._children_rss = 0
+        self._io = _proc_io()
+        self._cpu = _cpu_time()
+        self._done = threading.Event()
+        self._sample()
+        self._thread = threading.Thread(target=self._monitor)
+        self._thread.daemon = True
+        self._wall = time.time()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.time() - self._wall
+        self._done.set()
+        self._thread.join()
+        self._sample()
+        cpu_self, cpu_children = _cpu_time()
+        io = _proc_io()
+        # ru_maxrss is in kB on Linux, and the peak over the whole process
+        # life, it is only used when the memory could not be sampled
+        if not self._peak_rss:
+            self._peak_rss = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * 1024
+        # the children are sampled while the block runs: the ru_maxrss of
+        # RUSAGE_CHILDREN would be that of the largest child that ever
+        # exited, including those of previous stages
+        self.record = dict(
+            name=self.name, wall_time=wall,
+            cpu_time=cpu_self - self._cpu[0],
+            children_cpu_time=cpu_children - self._cpu[1],
+            peak_rss=self._peak_rss, children_peak_rss=self._children_rss,
+            read_bytes=io['read_bytes'] - self._io['read_bytes'],
+            write_bytes=io['write_bytes'] - self._io['write_bytes'],
+            n_threads=self._n_threads, n_processes=self._n_processes)
+        return False
+
+
+_steps = list()
+
+
+class ProfileStep(StageProfiler):
+    """Profile a part of a stage, recorded in the ``steps`` of the stage.
+
+    The CPU, memory and I/O measurements are those of the whole process,
+    so they include concurrent steps running in other threads.
+    """
+
+    def __exit__(self, *args):
+        super(ProfileStep, self).__exit__(*args)
+        _steps.append(self.record)
+        return False
+
+
+def write_report(fname, records, **meta):
+    """Write stage records and metadata to a JSON report."""
+    try:
+        import mne
+        mne_version = mne.__version__
+    except ImportError:
+        mne_version = None
+    meta.update(mne_version=mne_version, host=platform.node(),
+                python=platform.python_version(), n_cpus=os.cpu_count(),
+                date=time.strftime('%Y-%m-%d %H:%M:%S'))
+    with open(fname, 'w') as fid:
+        json.dump(dict(meta=meta, stages=records), fid, indent=2,
+                  sort_keys=True)
+
+
+def read_report(fname):
+    with open(fname) as fid:
+        return json.load(fid)
+
+
+def print_summary(records):
+    """Print a compact table of the stage records."""
+    print('%-28s %9s %9s %9s %9s %9s %4s' % ('Stage', 'Wall (s)', 'CPU (s)',
+                                             'RSS (MB)', 'Read (MB)',
+                                             'Wrote(MB)', 'Thr'))
+    for rec in records:
+        for this_rec, indent in ([(rec, '')] +
+                                 [(step, '  ') for step in
+                                  rec.get('steps', [])]):
+            print('%-28s %9.1f %9.1f %9.0f %9.0f %9.0f %4d'
+                  % ((indent + this_rec['name'])[:28], this_rec['wall_time'],
+                     this_rec['cpu_time'] + this_rec['children_cpu_time'],
+                     max(this_rec['peak_rss'],
+                         this_rec['children_peak_rss']) / 1e6,
+                     this_rec['read_bytes'] / 1e6,
+                     this_rec['write_bytes'] / 1e6, this_rec['n_threads']))
+    print('%-28s %9.1f' % ('Total', sum(rec['wall_time']
+                                        for rec in records)))
+
+
+def _flatten(fname):
+    """The records of the stages and of their steps."""
+    for rec in read_report(fname)['stages']:
+        yield rec
+        for step in rec.get('steps', []):
+            yield dict(step, name='%s/%s' % (rec['name'], step['name']))
+
+
+def compare_reports(fname_ref, fname_new, tolerance=0.1,
+                    keys=('wall_time', 'cpu_time', 'peak_rss')):
+    """Compare two reports and print the stages that got slower or larger.
+
+    Parameters
+    ----------
+    fname_ref : str
+        The reference report.
+    fname_new : str
+        The report to compare to the reference.
+    tolerance : float
+        Relative increase above which a measurement is a regression.
+    keys : list of str
+        The measurements compared.
+
+    Returns
+    -------
+    regressions : list of tuple
+        The ``(stage, key, reference, new)`` measurements that increased
+        by more than ``tolerance``.
+    """
+    ref, new = [dict((rec['name'], rec) for rec in _flatten(fname))
+                for fname in (fname_ref, fname_new)]
+    regressions = list()
+    print('%-28s %-12s %12s %12s %8s' % ('Stage', 'Measure', 'Reference',
+                                         'New', 'Ratio'))
+    for name in sorted(set(ref) & set(new)):
+        for key in keys:
+            a, b = ref[name][key], new[name][key]
+            ratio = b / float(a) if a else float('inf') if b else 1.
+            flag = ''
+            if ratio > 1 + tolerance:
+                regressions.append((name, key, a, b))
+                flag = ' !'
+            print('%-28s %-12s %12.4g %12.4g %8.2f%s'
+                  % (name[:28], key, a, b, ratio, flag))
+    for name in sorted(set(ref) ^ set(new)):
+        print('%-28s only in %s' % (name[:28], 'reference' if name in ref
+                                    else 'new report'))
+    return regressions
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Compare two performance reports.')
+    parser.add_argument('reference')
+    parser.add_argument('new')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative increase considered a regression')
+    args = parser.parse_args()
+    regressions = compare_reports(args.reference, args.new, args.tolerance)
+    if regressions:
+        raise SystemExit('%d regressions found' % len(regressions))
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
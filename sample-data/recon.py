@@ -0,0 +1,311 @@
+"""Run the FreeSurfer reconstructions of several subjects concurrently.
+
+For each subject, the chain of the dataset builders is run: ``recon-all``,
+removal of the symbolic links in the subject directory, the watershed BEM
+surfaces, the high resolution head surface (``mkheadsurf`` and
+``mne_surf2bem``) and optionally the BEM model
+(``mne_setup_forward_model``). The steps of a subject run one after the
+other, and the subjects run concurrently as long as the cores and memory
+reserved by their running steps fit in the budget, so that the whole takes
+about as long as the slowest subject. Once all the subjects are done, the
+links to fsaverage that ``recon-all`` leaves in the subjects directory can
+be removed, so that the directory can be archived.
+
+A step is skipped when its outputs exist, and an interrupted ``recon-all``
+is resumed, so the same command can be run again after a failure. The
+output of the commands of each subject is appended to its own log file::
+
+    python recon.py $SUBJECTS_DIR bst_raw=/data/raw/T1.mgz \\
+        bst_auditory=/data/auditory/T1.mgz --n-jobs 8 --mem 16
+
+``fake_freesurfer.py`` provides stand-ins of the FreeSurfer and MNE-C
+commands, to test the orchestration without FreeSurfer::
+
+    python fake_freesurfer.py install /tmp/fake-bin
+    python recon.py /tmp/subjects spm=smri.hdr --bin-dir /tmp/fake-bin
+"""
+# License: BSD (3-clause)
+import argparse
+import os
+import os.path as op
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from batch import cpu_count
+
+# recon-all is started or resumed as in the BIDS conversion
+sys.path.insert(0, op.join(op.dirname(op.realpath(__file__)), '..',
+                           'bids_conversion'))
+from freesurfer import recon_all_command  # noqa: E402
+
+# The links recon-all makes in the subjects directory
+_fsaverage_links = ('fsaverage', 'lh.EC_average', 'rh.EC_average')
+
+
+class Budget(object):
+    """Cores and memory shared by the running steps.
+
+    A step asking for more than the whole budget runs alone.
+    """
+
+    def __init__(self, n_jobs, mem):
+        self.n_jobs = n_jobs
+        self.mem = mem
+        self._used = [0, 0.]
+        self._cond = threading.Condition()
+
+    def _clip(self, n_jobs, mem):
+        return min(n_jobs, self.n_jobs), min(mem, self.mem)
+
+    def acquire(self, n_jobs, mem):
+        n_jobs, mem = self._clip(n_jobs, mem)
+        with self._cond:
+            while (self._used[0] + n_jobs > self.n_jobs or
+                   self._used[1] + mem > self.mem):
+                self._cond.wait()
+            self._used[0] += n_jobs
+            self._used[1] += mem
+
+    def release(self, n_jobs, mem):
+        n_jobs, mem = self._clip(n_jobs, mem)
+        with self._cond:
+            self._used[0] -= n_jobs
+            self._used[1] -= mem
+            self._cond.notify_all()
+
+
+class SubjectRecon(object):
+    """The reconstruction chain of a subject.
+
+    Parameters
+    ----------
+    subjects_dir : str
+        The FreeSurfer subjects directory.
+    subject : str
+        The subject name.
+    image : str
+        The T1 image given to ``recon-all -i``.
+    log_fname : str
+        The file the output of the commands is appended to.
+    openmp : int
+        Number of threads of ``recon-all``.
+    forward_model : bool
+        Also run ``mne_setup_forward_model --surf --ico 4``.
+    """
+
+    def __init__(self, subjects_dir, subject, image, log_fname, openmp=1,
+                 forward_model=False):
+        self.subjects_dir = subjects_dir
+        self.subject = subject
+        self.image = image
+        self.log_fname = log_fname
+        self.openmp = openmp
+        self.forward_model = forward_model
+        self.env = dict(os.environ, SUBJECTS_DIR=subjects_dir,
+                        SUBJECT=subject)
+
+    def path(self, *parts):
+        return op.join(self.subjects_dir, self.subject, *parts)
+
+    def _log(self, msg):
+        with open(self.log_fname, 'a') as fid:
+            fid.write('[%s] %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                                     msg))
+
+    def _call(self, command, cwd=None):
+        self._log('Running %s' % ' '.join(command))
+        with open(self.log_fname, 'a') as log:
+            code = subprocess.call(command, env=self.env, cwd=cwd,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        if code:
+            raise RuntimeError('%s failed for %s with code %d, see %s'
+                               % (command[0], self.subject, code,
+                                  self.log_fname))
+
+    def steps(self):
+        """The (name, outputs, n_jobs, mem, function) of each step."""
+        bem = self.path('bem', self.subject)
+        steps = [
+            ('recon-all', [self.path('scripts', 'recon-all.done')],
+             self.openmp, 3., self.recon_all),
+            ('watershed', [bem + '-inner_skull.surf',
+                           bem + '-outer_skull.surf',
+                           bem + '-outer_skin.surf'], 1, 1., self.watershed),
+            ('mkheadsurf', [self.path('surf', 'lh.seghead')], 1, 1.,
+             self.mkheadsurf),
+            ('surf2bem', [bem + '-head.fif'], 1, 0.5, self.surf2bem),
+        ]
+        if self.forward_model:
+            steps.append(('forward_model', [bem + '-5120-bem-sol.fif'], 1, 1.,
+                          self.setup_forward_model))
+        return steps
+
+    def recon_all(self):
+        command = recon_all_command(self.subjects_dir, self.subject,
+                                    self.image)
+        if self.openmp > 1:
+            command += ['-openmp', str(self.openmp)]
+        self._call(command)
+        # remove the symlinks of the subject, the links in the subjects
+        # directory may be in use by the other reconstructions
+        for dirpath, dirnames, filenames in os.walk(self.path()):
+            for name in dirnames + filenames:
+                if op.islink(op.join(dirpath, name)):
+                    os.remove(op.join(dirpath, name))
+
+    def watershed(self):
+        # the surfaces of an interrupted run are overwritten
+        self._call(['mne_watershed_bem', '--overwrite'],
+                   cwd=self.path('bem'))
+        for surf in ('inner_skull', 'outer_skin', 'outer_skull'):
+            link = self.path('bem', '%s-%s.surf' % (self.subject, surf))
+            if op.lexists(link):
+                os.remove(link)
+            os.symlink(op.join('watershed', '%s_%s_surface'
+                               % (self.subject, surf)), link)
+
+    def mkheadsurf(self):
+        self._call(['mkheadsurf', '-s', self.subject])
+
+    def surf2bem(self):
+        self._call(['mne_surf2bem', '--surf', self.path('surf', 'lh.seghead'),
+                    '--id', '4', '--check', '--fif',
+                    self.path('bem', '%s-head.fif' % self.subject)])
+
+    def setup_forward_model(self):
+        self._call(['mne_setup_forward_model', '--surf', '--ico', '4'],
+                   cwd=self.path('bem'))
+
+    def run(self, budget):
+        """Run the steps whose outputs do not exist."""
+        for name, outputs, n_jobs, mem, func in self.steps():
+            if all(op.exists(fname) for fname in outputs):
+                self._log('Skipping %s, done before' % name)
+                continue
+            budget.acquire(n_jobs, mem)
+            try:
+                print('Starting %s of %s' % (name, self.subject))
+                start = time.time()
+                func()
+            finally:
+                budget.release(n_jobs, mem)
+            missing = [fname for fname in outputs if not op.exists(fname)]
+            if missing:
+                raise RuntimeError('%s of %s did not write %s'
+                                   % (name, self.subject, ', '.join(missing)))
+            print('Finished %s of %s in %.0f s'
+                  % (name, self.subject, time.time() - start))
+
+
+def remove_fsaverage_links(subjects_dir):
+    """Remove the links to fsaverage that recon-all makes in a directory.
+
+    Returns
+    -------
+    removed : list of str
+        The links removed. Directories that are not links are kept.
+    """
+    removed = list()
+    for name in _fsaverage_links:
+        fname = op.join(subjects_dir, name)
+        if op.islink(fname):
+            os.remove(fname)
+            removed.append(fname)
+    return removed
+
+
+def run_recons(subjects_dir, images, log_dir=None, n_jobs=None, mem=None,
+               openmp=1, forward_model=False, remove_fsaverage=False):
+    """Run the reconstruction chains of several subjects concurrently.
+
+    Parameters
+    ----------
+    subjects_dir : str
+        The FreeSurfer subjects directory.
+    images : dict
+        The T1 image of each subject.
+    log_dir : str | None
+        Directory of the log files, ``<subject>.log``. Defaults to the
+        subjects directory.
+    n_jobs : int | None
+        Number of cores. None uses all the cores available.
+    mem : float | None
+        Memory budget in GB. None does not limit the memory.
+    openmp : int
+        Number of threads of each ``recon-all``.
+    forward_model : bool
+        Also set up the BEM model with ``mne_setup_forward_model``.
+    remove_fsaverage : bool
+        Remove the links to fsaverage from the subjects directory once all
+        the subjects are done, see :func:`remove_fsaverage_links`.
+
+    Returns
+    -------
+    failed : dict
+        The error of each subject that failed.
+    """
+    log_dir = subjects_dir if log_dir is None else log_dir
+    for dirname in (subjects_dir, log_dir):
+        if not op.isdir(dirname):
+            os.makedirs(dirname)
+    budget = Budget(cpu_count() if n_jobs is None else n_jobs,
+                    float('inf') if mem is None else mem)
+    recons = [SubjectRecon(subjects_dir, subject, image,
+                           op.join(log_dir, subject + '.log'), openmp,
+                           forward_model)
+              for subject, image in sorted(images.items())]
+    failed = dict()
+    with ThreadPoolExecutor(max_workers=max(len(recons), 1)) as executor:
+        futures = dict((executor.submit(recon.run, budget), recon.subject)
+                       for recon in recons)
+        for future, subject in futures.items():
+            try:
+                future.result()
+            except Exception as exp:
+                print('Failed %s: %s' % (subject, exp))
+                failed[subject] = str(exp)
+    if remove_fsaverage:
+        remove_fsaverage_links(subjects_dir)
+    return failed
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Run FreeSurfer reconstructions concurrently.')
+    parser.add_argument('subjects_dir', help='FreeSurfer subjects directory')
+    parser.add_argument('subjects', nargs='+',
+                        help='subjects and their T1 image, as subject=image')
+    parser.add_argument('--log-dir', default=None,
+                        help='directory of the log of each subject')
+    parser.add_argument('--n-jobs', type=int, default=None,
+                        help='number of cores, defaults to all')
+    parser.add_argument('--mem', type=float, default=None,
+                        help='memory budget in GB')
+    parser.add_argument('--openmp', type=int, default=1,
+                        help='threads of each recon-all')
+    parser.add_argument('--forward-model', action='store_true',
+                        help='also run mne_setup_forward_model')
+    parser.add_argument('--remove-fsaverage', action='store_true',
+                        help='remove the links to fsaverage from the '
+                             'subjects directory at the end')
+    parser.add_argument('--bin-dir', default=None,
+                        help='directory searched first for the commands, '
+                             'e.g. with the stand-ins of fake_freesurfer.py')
+    args = parser.parse_args()
+    if args.bin_dir is not None:
+        os.environ['PATH'] = (op.abspath(args.bin_dir) + os.pathsep +
+                              os.environ.get('PATH', ''))
+    images = dict(spec.split('=', 1) for spec in args.subjects)
+    failed = run_recons(op.abspath(args.subjects_dir), images, args.log_dir,
+                        args.n_jobs, args.mem, args.openmp,
+                        args.forward_model, args.remove_fsaverage)
+    if failed:
+        raise SystemExit('%d subjects failed, run again to resume: %s'
+                         % (len(failed), ', '.join(sorted(failed))))
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
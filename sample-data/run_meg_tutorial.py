@@ -1,209 +1,516 @@
-import sys
+import argparse
+import hashlib
 import os
-from os.path import join
+import shutil
+from os.path import abspath, join
 
 import mne
-from mne.source_space import (setup_source_space, morph_source_spaces,
-                              add_source_space_distances)
-from mne.minimum_norm import (make_inverse_operator, write_inverse_operator,
-                              apply_inverse)
+from mne.source_space import setup_source_space, morph_source_spaces
+from mne.minimum_norm import read_inverse_operator
+
+from pipeline import Stage, run_stages
+from profiling import ProfileStep
+from cache import ArtifactCache
+from inverse import make_inverse_operators, InverseKernel, save_stcs
+from sensmap import sensitivity_maps
+from gain import gain_fname, write_gain, read_gain
+from distances import add_distances as add_src_distances
+from dipfit import DipoleFitter
+from morph import morph_stc
+from stream import (stream_filter_resample, stream_covariance,
+                    stream_average)
+from artifacts import find_artifacts_and_events, compute_artifact_projs
+
+reject = dict(grad=3000e-13, mag=4000e-15, eeg=100e-6)
+event_id = [1, 2, 3, 4]
+tmin, tmax = -0.2, 0.5
+default_work_dir = join(os.path.expanduser('~'), '.cache', 'mne-scripts')
+# the bad channels and the channel of the heart beats of the sample data
+default_bads = ['MEG 2443', 'EEG 053']
+default_ecg_ch = 'MEG 1531'
+
+
+def _read_raw(fname, bads, preload=True):
+    raw = mne.io.Raw(fname, preload=preload)
+    # e.g. the empty room recording has no EEG
+    raw.info['bads'] = [bad for bad in bads if bad in raw.ch_names]
+    return raw
+
+
+def _picks(info):
+    return mne.pick_types(info, meg=True, eeg=True, stim=True, eog=True)
 
 
-def run():
+###############################################################################
+# Source spaces
 
-    args = sys.argv
-    if len(args) <= 1:
-        print 'Usage: run_meg_tutorial.sh <sample data directory>'
-        return
+def _surf_files(subjects_dir, subject, names):
+    """The FreeSurfer surfaces a source space is computed from."""
+    return [join(subjects_dir, subject, 'surf', '%s.%s' % (hemi, name))
+            for name in names for hemi in ('lh', 'rh')]
 
-    sample_dir = args[1]
-    subjects_dir = join(sample_dir, 'subjects')
-    meg_dir = join(sample_dir, 'MEG', 'sample')
 
-    os.environ['SUBJECTS_DIR'] = subjects_dir
-    os.environ['MEG_DIR'] = meg_dir
+def make_source_space(subject, fname, spacing, n_jobs, add_dist=True):
+    src = setup_source_space(subject, spacing=spacing, n_jobs=n_jobs,
+                             add_dist=add_dist)
+    src.save(fname, overwrite=True)
 
-    subject = 'sample'
-
-    src = setup_source_space(subject, fname=True, spacing='oct6', n_jobs=2,
-                             overwrite=True)
-
-    # If one wanted to use other source spaces, these types of options are
-    # available
-    src_fsaverage = setup_source_space('fsaverage', fname=True, spacing='ico5',
-                                       n_jobs=2, overwrite=True,
-                                       add_dist=False)
-    morph_source_spaces(src_fsaverage, subject_to='sample')
-    setup_source_space(subject, fname=True, spacing='all', overwrite=True,
-                       n_jobs=2, add_dist=False)
-
-    # Add distances to source space (if desired, takes a long time)
-    bem_dir = join(subjects_dir, join('sample', 'bem'))
-    os.rename(join(bem_dir, 'sample-oct-6-src.fif'),
-              join(bem_dir, 'sample-oct-6-orig-src.fif'))
-    new_src = add_source_space_distances(src, dist_limit=0.007)
-    new_src.save(join(bem_dir, 'sample-oct-6-src.fif'))
-
-    # Preprocessing
-    raw = mne.io.Raw(join(meg_dir, 'sample_audvis_raw.fif'), preload=True)
-    raw.info['bads'] = ['MEG 2443', 'EEG 053']
-    reject = dict(grad=3000e-13, mag=4000e-15, eeg=100e-6)
-    ecg_proj, _ = mne.preprocessing.compute_proj_ecg(raw, l_freq=1, h_freq=100,
-                                                     ch_name='MEG 1531',
-                                                     reject=reject)
-
-    eog_proj, _ = mne.preprocessing.compute_proj_eog(raw, l_freq=1, h_freq=35,
-                                                     reject=reject,
-                                                     no_proj=True)
-
-    events = mne.find_events(raw)
-    mne.write_events(join(meg_dir, 'sample_audvis_raw-eve.fif'), events)
-    event_id = [1, 2, 3, 4]
-    tmin, tmax = -0.2, 0.5
-    picks = mne.pick_types(raw.info, meg=True, eeg=True, stim=True, eog=True)
-
-    # Average with no filter
-    epochs = mne.Epochs(raw, events, event_id, tmin, tmax, picks=picks)
-    evoked = epochs.average()
-    evoked.save(join(meg_dir, 'sample_audvis-no-filter-ave.fif'))
 
+def make_fsaverage_source_space(fname, n_jobs, subject='sample'):
+    src_fsaverage = setup_source_space('fsaverage', spacing='ico5',
+                                       n_jobs=n_jobs, add_dist=False)
+    src_fsaverage.save(fname, overwrite=True)
+    morph_source_spaces(src_fsaverage, subject_to=subject)
+
+
+def add_distances(src_fname, fname, n_jobs):
+    # the finished blocks are kept until the source space is saved, so that
+    # an interrupted stage resumes where it stopped
+    src = mne.read_source_spaces(src_fname)
+    checkpoint_dir = fname + '.blocks'
+    add_src_distances(src, dist_limit=0.007, n_jobs=n_jobs,
+                      checkpoint_dir=checkpoint_dir)
+    src.save(fname)
+    shutil.rmtree(checkpoint_dir)
+
+
+###############################################################################
+# Preprocessing
+
+def find_artifacts(raw_fname, ecg_fname, eog_fname, eve_fname, bads,
+                   ecg_ch):
+    events, ecg_events, eog_events = find_artifacts_and_events(
+        raw_fname, ecg_ch=ecg_ch)
+    mne.write_events(eve_fname, events)
+    ecg_proj, eog_proj = compute_artifact_projs(
+        raw_fname, ecg_events, eog_events, bads, reject=reject)
+    mne.write_proj(ecg_fname, ecg_proj)
+    mne.write_proj(eog_fname, eog_proj)
+
+
+def average_no_filter(raw_fname, eve_fname, fname, bads):
+    # without filtering, the epochs are read one at a time from the file
+    raw = _read_raw(raw_fname, bads, preload=False)
+    events = mne.read_events(eve_fname)
+    epochs = mne.Epochs(raw, events, event_id, tmin, tmax,
+                        picks=_picks(raw.info))
+    epochs.average().save(fname)
+
+
+def filter_and_resample(raw_fname, fname, eve_fname, bads):
+    raw = _read_raw(raw_fname, bads)
     raw.filter(l_freq=None, h_freq=40)
     raw_resampled = raw.resample(150)
-    raw_resampled.save(join(meg_dir, 'sample_audvis_filt-0-40_raw.fif'),
-                       overwrite=True)
+    raw_resampled.save(fname, overwrite=True)
+    mne.write_events(eve_fname, mne.find_events(raw_resampled))
+
 
-    raw.add_proj(ecg_proj)
-    raw.add_proj(eog_proj)
+def stream_filter_and_resample(raw_fname, fname, eve_fname, bads):
+    stream_filter_resample(raw_fname, fname, h_freq=40, sfreq=150,
+                           bads=bads)
+    # find_events only reads the stim channel of the written file
+    raw_resampled = mne.io.read_raw_fif(fname)
+    mne.write_events(eve_fname, mne.find_events(raw_resampled))
 
-    resampled_events = mne.find_events(raw_resampled)
-    mne.write_events(join(meg_dir, 'sample_audvis_filt-0-40_raw-eve.fif'),
-                     resampled_events)
+
+def average_and_covariance(raw_fname, eve_fname, ecg_fname, eog_fname,
+                           ave_fname, cov_fname, bads):
+    raw = _read_raw(raw_fname, bads)
+    raw.filter(l_freq=None, h_freq=40)
+    raw.add_proj(mne.read_proj(ecg_fname))
+    raw.add_proj(mne.read_proj(eog_fname))
+    events = mne.read_events(eve_fname)
+    picks = _picks(raw.info)
 
     # Average with filter
     epochs = mne.Epochs(raw, events, event_id, tmin, tmax, picks=picks)
-    evoked = epochs.average()
-    evoked.save(join(meg_dir, 'sample_audvis-ave.fif'))
+    epochs.average().save(ave_fname)
 
     # Compute the noise covariance matrix
-    noise_cov = mne.compute_raw_data_covariance(raw, picks=picks)
-    noise_cov.save(join(meg_dir, 'audvis.cov'))
+    noise_cov = mne.compute_raw_covariance(raw, picks=picks)
+    noise_cov.save(cov_fname)
+
+
+def stream_average_filtered(raw_fname, eve_fname, ecg_fname, eog_fname,
+                            ave_fname, bads):
+    # Average with filter, each epoch being filtered on its own
+    projs = mne.read_proj(ecg_fname) + mne.read_proj(eog_fname)
+    evoked = stream_average(raw_fname, mne.read_events(eve_fname), event_id,
+                            tmin, tmax, h_freq=40, bads=bads, projs=projs)
+    evoked.save(ave_fname)
+
+
+def stream_noise_covariance(raw_fname, fname, bads, proj_fnames=()):
+    ch_names = mne.io.read_info(raw_fname)['ch_names']
+    bads = [bad for bad in bads if bad in ch_names]
+    projs = list()
+    for proj_fname in proj_fnames:
+        projs += mne.read_proj(proj_fname)
+    stream_covariance(raw_fname, h_freq=40, bads=bads, projs=projs).save(fname)
 
-    # Compute the empty-room noise covariance matrix
-    ernoise_raw = mne.io.Raw(join(meg_dir, 'ernoise_raw.fif'), preload=True)
-    ernoise_raw.info['bads'] = ['MEG 2443']
+
+def ernoise_covariance(raw_fname, fname, bads):
+    ernoise_raw = _read_raw(raw_fname, bads)
     ernoise_raw.filter(l_freq=None, h_freq=40)
-    picks = mne.pick_types(ernoise_raw.info, meg=True, eeg=True, stim=True,
-                           eog=True)
-    ernoise_cov = mne.compute_raw_data_covariance(ernoise_raw, picks=picks)
-    ernoise_cov.save(join(meg_dir, 'ernoise.cov'))
+    picks = _picks(ernoise_raw.info)
+    ernoise_cov = mne.compute_raw_covariance(ernoise_raw, picks=picks)
+    ernoise_cov.save(fname)
+
 
 ###############################################################################
-    # Compute forward solution a.k.a. lead field
-    trans = join(meg_dir, 'sample_audvis_raw-trans.fif')
-    bem = join(subjects_dir, 'sample', 'bem', 'sample-5120-bem-sol.fif')
-    # for MEG only
-    fname = join(meg_dir, 'sample_audvis-meg-oct-6-fwd.fif')
-    fwd_meg = mne.make_forward_solution(raw.info, trans, src, bem,
-                                        fname=fname, meg=True, eeg=False,
-                                        mindist=5.0, n_jobs=2, overwrite=True)
-
-    # for EEG only
-    bem = join(subjects_dir, 'sample', 'bem',
-               'sample-5120-5120-5120-bem-sol.fif')
-    fname = join(meg_dir, 'sample_audvis-eeg-oct-6-fwd.fif')
-    fwd_eeg = mne.make_forward_solution(raw.info, trans, src, bem,
-                                        fname=fname, meg=False, eeg=True,
-                                        mindist=5.0, n_jobs=2, overwrite=True)
+# Forward solutions, sensitivity maps, inverse operators and source estimates
 
+def make_forward_meg_eeg(raw_fname, trans, src_fname, bem3, fname,
+                         fname_eeg, n_jobs, gain_dir=None):
+    info = mne.io.read_info(raw_fname)
+    src = mne.read_source_spaces(src_fname)
     # for both EEG and MEG
-    fname = join(meg_dir, 'sample_audvis-meg-eeg-oct-6-fwd.fif')
-    fwd = mne.make_forward_solution(raw.info, trans, src, bem,
-                                    fname=fname, meg=True, eeg=True,
-                                    mindist=5.0, n_jobs=2, overwrite=True)
+    with ProfileStep('forward_meg-eeg'):
+        fwd = mne.make_forward_solution(info, trans, src, bem3, meg=True,
+                                        eeg=True, mindist=5.0, n_jobs=n_jobs)
+        mne.write_forward_solution(fname, fwd, overwrite=True)
+
+    # for EEG only: the EEG lead field only depends on the 3-layer BEM, so
+    # it is the EEG part of the combined solution
+    with ProfileStep('forward_eeg'):
+        fwd_eeg = mne.pick_types_forward(fwd, meg=False, eeg=True)
+        mne.write_forward_solution(fname_eeg, fwd_eeg, overwrite=True)
+
+    # the gain matrix, memory-mapped by the sensitivity maps
+    with ProfileStep('gain_meg-eeg'):
+        write_gain(gain_fname(fname, gain_dir), fwd)
+
+
+def make_forward_meg(raw_fname, trans, src_fname, bem, fname, n_jobs):
+    info = mne.io.read_info(raw_fname)
+    src = mne.read_source_spaces(src_fname)
+    # for MEG only, the single layer BEM is used
+    with ProfileStep('forward_meg'):
+        fwd = mne.make_forward_solution(info, trans, src, bem, meg=True,
+                                        eeg=False, mindist=5.0, n_jobs=n_jobs)
+        mne.write_forward_solution(fname, fwd, overwrite=True)
+
+
+def make_sensitivity_maps(fname_gain, fname_template, requests, proj_fnames,
+                          raw_fname):
+    # only the rows of each channel type are read from the mapped gain
+    info = mne.io.read_info(raw_fname)
+    fwd = read_gain(fname_gain, info)
+    projs = list()
+    for proj_fname in proj_fnames:
+        projs += mne.read_proj(proj_fname)
+    projs += info['projs']
+    sensitivity_maps(fwd, requests, fname_template, projs=dict(ecg_eog=projs))
+
+
+def make_inverses(raw_fname, specs, n_jobs):
+    info = mne.io.read_info(raw_fname)
+    make_inverse_operators(info, specs, n_jobs=n_jobs)
+
+
+def make_stc(ave_fname, inv_fname, fname):
+    evoked = mne.read_evokeds(ave_fname, condition=0)
+    evoked.crop(0, 0.25)
+    # more evokeds or an epochs iterator would share the prepared kernel
+    kernel = InverseKernel(read_inverse_operator(inv_fname), method='MNE')
+    save_stcs(kernel.apply_evokeds([evoked]), [fname])
 
-    # Create various sensitivity maps
-    grad_map = mne.sensitivity_map(fwd, ch_type='grad', mode='free')
-    grad_map.save(join(meg_dir, 'sample_audvis-grad-oct-6-fwd-sensmap'),
-                  ftype='w')
-    mag_map = mne.sensitivity_map(fwd, ch_type='mag', mode='free')
-    mag_map.save(join(meg_dir, 'sample_audvis-mag-oct-6-fwd-sensmap'),
-                 ftype='w')
-    eeg_map = mne.sensitivity_map(fwd, ch_type='eeg', mode='free')
-    eeg_map.save(join(meg_dir, 'sample_audvis-eeg-oct-6-fwd-sensmap'),
-                 ftype='w')
-    grad_map2 = mne.sensitivity_map(fwd, ch_type='grad', mode='fixed')
-    grad_map2.save(join(meg_dir, 'sample_audvis-grad-oct-6-fwd-sensmap-2'),
-                   ftype='w')
-    mag_map2 = mne.sensitivity_map(fwd, ch_type='mag', mode='ratio')
-    mag_map2.save(join(meg_dir, 'sample_audvis-mag-oct-6-fwd-sensmap-3'),
-                  ftype='w')
 
+def morph_stcs(subject, stc_fnames, morph_fnames, cache_dir):
+    # All estimates share their vertices, so the operator is computed once
+    # and then reused from the cache on later runs
+    for stc_fname, morph_fname in zip(stc_fnames, morph_fnames):
+        stc = mne.read_source_estimate(stc_fname, subject=subject)
+        stc_to = morph_stc(stc, 'fsaverage', grade=3, smooth=12,
+                           cache_dir=cache_dir)
+        stc_to.save(morph_fname)
+
+
+def fit_dipole(ave_fname, cov_fname, bem, trans, fname, n_jobs,
+               cache_dir=None):
+    evoked = mne.read_evokeds(ave_fname, condition=0)
+    evoked = evoked.pick_types(meg=True, eeg=False)
+    evoked.crop(0.04, 0.095)
+    # the guesses are reused by later fits with the same BEM, trans and
+    # channels
+    fitter = DipoleFitter(evoked.info, cov_fname, bem, trans,
+                          cache_dir=cache_dir, n_jobs=n_jobs)
+    dip, _ = fitter.fit(evoked, n_jobs=n_jobs)
+    dip.save(fname)
+
+
+def _stc_files(stem, ftype='stc'):
+    return [stem + '-%s.%s' % (hemi, ftype) for hemi in ('lh', 'rh')]
+
+
+def make_stages(sample_dir, n_jobs=2, stream=False, subject='sample',
+                work_dir=None, bads=None, ecg_ch=None):
+    """Declare the stages generating the sample data from the raw files.
+
+    With ``stream=True``, the filtered and resampled raw file and the
+    covariances are computed chunk by chunk instead of loading the
+    recordings in memory. ``subject`` names the FreeSurfer subject, the
+    ``MEG`` sub-directory and the prefix of the files, so that datasets
+    laid out like the sample data can be processed under another name.
+    ``work_dir`` holds the files reused between runs that are not part of
+    the published data, by default ``~/.cache/mne-scripts``. ``bads`` are
+    the bad channels of the recordings and ``ecg_ch`` the channel the heart
+    beats are detected on, by default those of the sample data.
+    """
+    if work_dir is None:
+        work_dir = default_work_dir
+    bads = list(default_bads if bads is None else bads)
+    ecg_ch = default_ecg_ch if ecg_ch is None else ecg_ch
+    subjects_dir = join(sample_dir, 'subjects')
+    meg_dir = join(sample_dir, 'MEG', subject)
+    bem_dir = join(subjects_dir, subject, 'bem')
+
+    def meg(fname):
+        return join(meg_dir, fname)
+
+    raw_fname = meg(subject + '_audvis_raw.fif')
+    eve_fname = meg(subject + '_audvis_raw-eve.fif')
+    ecg_fname = meg(subject + '_audvis_ecg_proj.fif')
+    eog_fname = meg(subject + '_audvis_eog_proj.fif')
+    ave_fname = meg(subject + '_audvis-ave.fif')
+    cov_fname = meg('audvis.cov')
+    trans = meg(subject + '_audvis_raw-trans.fif')
+    bem = join(bem_dir, subject + '-5120-bem-sol.fif')
+    bem3 = join(bem_dir, subject + '-5120-5120-5120-bem-sol.fif')
+    src_fname = join(bem_dir, subject + '-oct-6-orig-src.fif')
+    fsaverage_src_fname = join(subjects_dir, 'fsaverage', 'bem',
+                               'fsaverage-ico-5-src.fif')
+
+    # the subsampled source spaces are computed on the spherical surfaces,
+    # the morph to the subject on the registered ones
+    surfs = _surf_files(subjects_dir, subject, ['white', 'sphere'])
+    fsaverage_surfs = (
+        _surf_files(subjects_dir, 'fsaverage', ['white', 'sphere',
+                                                'sphere.reg']) +
+        _surf_files(subjects_dir, subject, ['white', 'sphere.reg']))
+
+    stages = [
+        Stage('source_space', make_source_space, inputs=surfs,
+              outputs=[src_fname], subject=subject, fname=src_fname,
+              spacing='oct6', n_jobs=n_jobs),
+        # If one wanted to use other source spaces, these types of options
+        # are available
+        Stage('fsaverage_source_space', make_fsaverage_source_space,
+              inputs=fsaverage_surfs, outputs=[fsaverage_src_fname],
+              fname=fsaverage_src_fname, n_jobs=n_jobs, subject=subject),
+        Stage('all_source_space', make_source_space,
+              inputs=_surf_files(subjects_dir, subject, ['white']),
+              outputs=[join(bem_dir, subject + '-all-src.fif')],
+              subject=subject, fname=join(bem_dir, subject + '-all-src.fif'),
+              spacing='all', n_jobs=n_jobs,
+              add_dist=False),
+        # Add distances to source space (if desired, takes a long time)
+        Stage('source_space_distances', add_distances, inputs=[src_fname],
+              outputs=[join(bem_dir, subject + '-oct-6-src.fif')],
+              src_fname=src_fname,
+              fname=join(bem_dir, subject + '-oct-6-src.fif'), n_jobs=n_jobs),
+
+        # Preprocessing
+        Stage('artifacts_events', find_artifacts, inputs=[raw_fname],
+              outputs=[ecg_fname, eog_fname, eve_fname], raw_fname=raw_fname,
+              ecg_fname=ecg_fname, eog_fname=eog_fname, eve_fname=eve_fname,
+              bads=bads, ecg_ch=ecg_ch),
+        Stage('average_no_filter', average_no_filter,
+              inputs=[raw_fname, eve_fname],
+              outputs=[meg(subject + '_audvis-no-filter-ave.fif')],
+              raw_fname=raw_fname, eve_fname=eve_fname,
+              fname=meg(subject + '_audvis-no-filter-ave.fif'), bads=bads),
+    ]
+
+    filt_fname = meg(subject + '_audvis_filt-0-40_raw.fif')
+    filt_eve_fname = meg(subject + '_audvis_filt-0-40_raw-eve.fif')
+    ernoise_fname = meg('ernoise_raw.fif')
+    if stream:
+        stages += [
+            Stage('filter_resample', stream_filter_and_resample,
+                  inputs=[raw_fname],
+                  outputs=[filt_fname, filt_eve_fname], raw_fname=raw_fname,
+                  fname=filt_fname, eve_fname=filt_eve_fname, bads=bads),
+            Stage('average', stream_average_filtered,
+                  inputs=[raw_fname, eve_fname, ecg_fname, eog_fname],
+                  outputs=[ave_fname], raw_fname=raw_fname,
+                  eve_fname=eve_fname, ecg_fname=ecg_fname,
+                  eog_fname=eog_fname, ave_fname=ave_fname, bads=bads),
+            Stage('covariance', stream_noise_covariance,
+                  inputs=[raw_fname, ecg_fname, eog_fname],
+                  outputs=[cov_fname], raw_fname=raw_fname, fname=cov_fname,
+                  bads=bads, proj_fnames=[ecg_fname, eog_fname]),
+            Stage('ernoise_covariance', stream_noise_covariance,
+                  inputs=[ernoise_fname], outputs=[meg('ernoise.cov')],
+                  raw_fname=ernoise_fname, fname=meg('ernoise.cov'),
+                  bads=bads),
+        ]
+    else:
+        stages += [
+            Stage('filter_resample', filter_and_resample,
+                  inputs=[raw_fname],
+                  outputs=[filt_fname, filt_eve_fname], raw_fname=raw_fname,
+                  fname=filt_fname, eve_fname=filt_eve_fname, bads=bads),
+            Stage('average_covariance', average_and_covariance,
+                  inputs=[raw_fname, eve_fname, ecg_fname, eog_fname],
+                  outputs=[ave_fname, cov_fname], raw_fname=raw_fname,
+                  eve_fname=eve_fname, ecg_fname=ecg_fname,
+                  eog_fname=eog_fname, ave_fname=ave_fname,
+                  cov_fname=cov_fname, bads=bads),
+            Stage('ernoise_covariance', ernoise_covariance,
+                  inputs=[ernoise_fname], outputs=[meg('ernoise.cov')],
+                  raw_fname=ernoise_fname, fname=meg('ernoise.cov'),
+                  bads=bads),
+        ]
+
+    # Compute forward solution a.k.a. lead field
+    fwds = dict((kind, meg(subject + '_audvis-%s-oct-6-fwd.fif' % kind))
+                for kind in ('meg', 'eeg', 'meg-eeg'))
+    # the gain sidecar of the sensitivity maps is not published, so it goes
+    # to the work directory
+    gain_dir = join(work_dir, 'gains',
+                    hashlib.sha1(abspath(meg_dir).encode('utf-8'))
+                    .hexdigest())
+    gain = gain_fname(fwds['meg-eeg'], gain_dir)
+    # The MEG forward with the single layer BEM does not depend on the
+    # MEG/EEG one, so that both are computed at the same time
+    stages += [
+        Stage('forward_meg-eeg', make_forward_meg_eeg,
+              inputs=[raw_fname, trans, src_fname, bem3],
+              outputs=[fwds['meg-eeg'], fwds['eeg'], gain],
+              raw_fname=raw_fname, trans=trans, src_fname=src_fname,
+              bem3=bem3, fname=fwds['meg-eeg'], fname_eeg=fwds['eeg'],
+              n_jobs=n_jobs, gain_dir=gain_dir),
+        Stage('forward_meg', make_forward_meg,
+              inputs=[raw_fname, trans, src_fname, bem],
+              outputs=[fwds['meg']], raw_fname=raw_fname, trans=trans,
+              src_fname=src_fname, bem=bem, fname=fwds['meg'],
+              n_jobs=n_jobs),
+    ]
+
+    # Create various sensitivity maps
+    requests = [dict(ch_type='grad', mode='free', tag='', ftype='w'),
+                dict(ch_type='mag', mode='free', tag='', ftype='w'),
+                dict(ch_type='eeg', mode='free', tag='', ftype='w'),
+                dict(ch_type='grad', mode='fixed', tag='-2', ftype='w'),
+                dict(ch_type='mag', mode='ratio', tag='-3', ftype='w')]
     # Compute some with the EOG + ECG projectors
-    projs = ecg_proj + eog_proj + raw.info['projs']
     for map_type in ['radiality', 'angle', 'remaining', 'dampening']:
-        eeg_map = mne.sensitivity_map(fwd, projs=projs, ch_type='eeg',
-                                      mode=map_type)
-        eeg_map.save(join(meg_dir,
-                          'sample_audvis-eeg-oct-6-fwd-sensmap-' + map_type))
+        requests.append(dict(ch_type='eeg', mode=map_type,
+                             tag='-' + map_type, projs='ecg_eog'))
+    fname_template = meg(subject +
+                         '_audvis-{ch_type}-oct-6-fwd-sensmap{tag}')
+    outputs = list()
+    for request in requests:
+        outputs += _stc_files(fname_template.format(**request),
+                              request.get('ftype', 'stc'))
+    stages.append(Stage(
+        'sensitivity_maps', make_sensitivity_maps,
+        inputs=[gain, ecg_fname, eog_fname, raw_fname],
+        outputs=outputs, fname_gain=gain,
+        fname_template=fname_template, requests=requests,
+        proj_fnames=[ecg_fname, eog_fname], raw_fname=raw_fname))
 
-###############################################################################
     # Compute MNE inverse operators
     #
     # Note: The MEG/EEG forward solution could be used for all
     #
-    inv_meg = make_inverse_operator(raw.info, fwd_meg, noise_cov, loose=0.2)
-    fname = join(meg_dir, 'sample_audvis-meg-oct-6-meg-inv.fif')
-    write_inverse_operator(fname, inv_meg)
-
-    inv_eeg = make_inverse_operator(raw.info, fwd_eeg, noise_cov, loose=0.2)
-    fname = join(meg_dir, 'sample_audvis-eeg-oct-6-eeg-inv.fif')
-    write_inverse_operator(fname, inv_eeg)
-
-    inv = make_inverse_operator(raw.info, fwd, noise_cov, loose=0.2)
-    fname = join(meg_dir, 'sample_audvis-meg-eeg-oct-6-meg-eeg-inv.fif')
-    write_inverse_operator(fname, inv)
-
-    # inverse operator with fixed orientation (for testing). Not implemented
-    #inv_fixed = make_inverse_operator(raw.info, fwd_meg, noise_cov,
-    #                                  depth=None, fixed=True)
-    #fname = join(meg_dir, 'sample_audvis-meg-oct-6-meg-nodepth-fixed-inv.fif')
-    #write_inverse_operator(fname, inv_fixed)
-
-    # produce two with diagonal noise (for testing)
-    diag = noise_cov.as_diag()
-    inv_meg_diag = make_inverse_operator(raw.info, fwd_meg, diag, loose=0.2)
-    fname = join(meg_dir, 'sample_audvis-meg-oct-6-meg-diagnoise-inv.fif')
-    write_inverse_operator(fname, inv_meg_diag)
-
-    inv_eeg_diag = make_inverse_operator(raw.info, fwd, diag, loose=0.2)
-    fname = join(meg_dir,
-                 'sample_audvis-meg-eeg-oct-6-meg-eeg-diagnoise-inv.fif')
-    write_inverse_operator(fname, inv_eeg_diag)
-
-    # Produce stc files
-    evoked.crop(0, 0.25)
-    stc_meg = apply_inverse(evoked, inv_meg, method='MNE')
-    stc_meg.save(join(meg_dir, 'sample_audvis-meg'))
-    stc_eeg = apply_inverse(evoked, inv_eeg, method='MNE')
-    stc_eeg.save(join(meg_dir, 'sample_audvis-eeg'))
-    stc = apply_inverse(evoked, inv, method='MNE')
-    stc.save(join(meg_dir, 'sample_audvis-meg-eeg'))
-
-    # let's also morph to fsaverage
-    stc_to = stc_meg.morph('fsaverage', grade=3, smooth=12)
-    stc_to.save(join(meg_dir, 'fsaverage_audvis-meg'))
-    stc_to = stc_eeg.morph('fsaverage', grade=3, smooth=12)
-    stc_to.save(join(meg_dir, 'fsaverage_audvis-eeg'))
-    stc_to = stc.morph('fsaverage', grade=3, smooth=12)
-    stc_to.save(join(meg_dir, 'fsaverage_audvis-meg-eeg'))
+    # The inverse operator with fixed orientation (for testing) is not
+    # implemented
+    invs, specs = dict(), list()
+    for name, kind, diag in [('meg-oct-6-meg', 'meg', False),
+                             ('eeg-oct-6-eeg', 'eeg', False),
+                             ('meg-eeg-oct-6-meg-eeg', 'meg-eeg', False),
+                             # produce two with diagonal noise (for testing)
+                             ('meg-oct-6-meg-diagnoise', 'meg', True),
+                             ('meg-eeg-oct-6-meg-eeg-diagnoise', 'meg-eeg',
+                              True)]:
+        invs[name] = meg(subject + '_audvis-%s-inv.fif' % name)
+        specs.append((fwds[kind], cov_fname, invs[name],
+                      dict(loose=0.2, diag=diag)))
+    stages.append(Stage(
+        'inverse', make_inverses,
+        inputs=[raw_fname, cov_fname] + list(fwds.values()),
+        outputs=list(invs.values()), raw_fname=raw_fname, specs=specs,
+        n_jobs=n_jobs))
+
+    # Produce stc files, and morph them to fsaverage
+    stems, morph_stems = list(), list()
+    for kind, name in [('meg', 'meg-oct-6-meg'), ('eeg', 'eeg-oct-6-eeg'),
+                       ('meg-eeg', 'meg-eeg-oct-6-meg-eeg')]:
+        stems.append(meg(subject + '_audvis-%s' % kind))
+        morph_stems.append(meg('fsaverage_audvis-%s' % kind))
+        stages.append(Stage(
+            'stc_%s' % kind, make_stc, inputs=[ave_fname, invs[name]],
+            outputs=_stc_files(stems[-1]), ave_fname=ave_fname,
+            inv_fname=invs[name], fname=stems[-1]))
+    stages.append(Stage(
+        'morph', morph_stcs,
+        inputs=sum([_stc_files(stem) for stem in stems], []),
+        outputs=sum([_stc_files(stem) for stem in morph_stems], []),
+        subject=subject, stc_fnames=stems, morph_fnames=morph_stems,
+        cache_dir=join(work_dir, 'morph')))
 
-###############################################################################
     # Do one dipole fitting
-    evoked = evoked.pick_types(meg=True, eeg=False)
-    evoked.crop(0.04, 0.095)
-    bem = join(subjects_dir, 'sample', 'bem', 'sample-5120-bem-sol.fif')
-    dip, _ = mne.fit_dipole(evoked, noise_cov, bem, trans)
-    dip.save(join(meg_dir, 'sample_audvis_set1.dip'))
+    stages.append(Stage(
+        'dipole', fit_dipole, inputs=[ave_fname, cov_fname, bem, trans],
+        outputs=[meg(subject + '_audvis_set1.dip')], ave_fname=ave_fname,
+        cov_fname=cov_fname, bem=bem, trans=trans,
+        fname=meg(subject + '_audvis_set1.dip'), n_jobs=n_jobs,
+        cache_dir=join(work_dir, 'dipole-guesses')))
+    return stages
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Generate the MNE sample data derivatives.')
+    parser.add_argument('sample_dir', help='sample data directory')
+    parser.add_argument('--subject', default='sample',
+                        help='name of the subject in the data directory')
+    parser.add_argument('--n-jobs', type=int, default=os.cpu_count(),
+                        help='number of CPUs shared by concurrent stages')
+    parser.add_argument('--stage-jobs', type=int, default=2,
+                        help='number of CPUs used within each stage')
+    parser.add_argument('--stream', action='store_true',
+                        help='filter, resample and compute covariances '
+                             'chunk by chunk in bounded memory')
+    parser.add_argument('--report', default=None,
+                        help='JSON file where the time and resources used '
+                             'by each stage are written')
+    parser.add_argument('--cache-dir', default=None,
+                        help='reuse the outputs of unchanged stages from '
+                             'this directory')
+    parser.add_argument('--cache-size', type=float, default=50.,
+                        help='maximum size of the cache in GB')
+    parser.add_argument('--work-dir', default=default_work_dir,
+                        help='directory, outside of the data, of the '
+                             'files reused between runs')
+    parser.add_argument('--bads', nargs='*', default=default_bads,
+                        help='bad channels of the recordings, the empty '
+                             'room one only uses those it has')
+    parser.add_argument('--ecg-ch', default=default_ecg_ch,
+                        help='channel the heart beats are detected on')
+    parser.add_argument('--checkpoint', default=None,
+                        help='JSON file recording the finished stages, '
+                             'which are skipped when restarting')
+    args = parser.parse_args()
+
+    sample_dir = args.sample_dir
+    subjects_dir = join(sample_dir, 'subjects')
+    meg_dir = join(sample_dir, 'MEG', args.subject)
+
+    os.environ['SUBJECTS_DIR'] = subjects_dir
+    os.environ['MEG_DIR'] = meg_dir
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = ArtifactCache(args.cache_dir, args.cache_size)
+    run_stages(make_stages(sample_dir, n_jobs=args.stage_jobs,
+                           stream=args.stream, subject=args.subject,
+                           work_dir=args.work_dir, bads=args.bads,
+                           ecg_ch=args.ecg_ch),
+               n_jobs=args.n_jobs, cache=cache, report=args.report,
+               checkpoint=args.checkpoint)
 
 is_main = (__name__ == '__main__')
 if is_main:
@@ -1,60 +1,118 @@
+import argparse
 import os
 from os.path import join
-import sys
 
 import mne
-from mne.source_space import setup_volume_source_space
 from mne.forward._make_forward import make_forward_solution
 from mne.minimum_norm import make_inverse_operator, write_inverse_operator
 
+from pipeline import Stage, run_stages
+from cache import ArtifactCache
+from sensmap import sensitivity_maps
+from volume import make_volume_source_spaces
 
-def run():
 
-    args = sys.argv
-    if len(args) <= 1:
-        print 'Usage: run_anatomy_tutorial.sh <sample data directory>'
-        return
+def make_volume_source_space(subject, fname, mri, bem, subjects_dir, n_jobs):
+    src, = make_volume_source_spaces(subject, [7.], mri=mri, bem=bem,
+                                     subjects_dir=subjects_dir, n_jobs=n_jobs)
+    src.save(fname, overwrite=True)
 
-    sample_dir = args[1]
-    subjects_dir = join(sample_dir, 'subjects')
-    meg_dir = join(sample_dir, 'MEG', 'sample')
 
-    os.environ['SUBJECTS_DIR'] = subjects_dir
-    os.environ['MEG_DIR'] = meg_dir
+def make_forward(raw_fname, trans, src_fname, bem, fname):
+    info = mne.io.read_info(raw_fname)
+    src = mne.read_source_spaces(src_fname)
+    # for MEG only
+    fwd = make_forward_solution(info, trans=trans, src=src, bem=bem,
+                                meg=True, eeg=False)
+    mne.write_forward_solution(fname, fwd, overwrite=True)
+
+
+def make_sensitivity_map(fwd_fname, fname):
+    fwd = mne.convert_forward_solution(mne.read_forward_solution(fwd_fname),
+                                       surf_ori=True)
+    sensitivity_maps(fwd, [dict(ch_type='grad', mode='free', ftype='w')],
+                     fname)
+
 
+def make_inverse(raw_fname, fwd_fname, cov_fname, fname):
+    info = mne.io.read_info(raw_fname)
+    fwd = mne.read_forward_solution(fwd_fname)
+    noise_cov = mne.read_cov(cov_fname)
+    inv = make_inverse_operator(info, fwd, noise_cov)
+    write_inverse_operator(fname, inv)
+
+
+def make_stages(sample_dir, n_jobs=2):
+    """Declare the stages generating the volume source space derivatives."""
+    subjects_dir = join(sample_dir, 'subjects')
+    meg_dir = join(sample_dir, 'MEG', 'sample')
     subject = 'sample'
 
     bem = join(subjects_dir, subject, 'bem', 'sample-5120-bem-sol.fif')
     mri = join(subjects_dir, subject, 'mri', 'T1.mgz')
-    fname = join(subjects_dir, subject, 'bem', 'volume-7mm-src.fif')
-    src = setup_volume_source_space(subject, fname=fname, pos=7, mri=mri,
-                                    bem=bem, overwrite=True,
-                                    subjects_dir=subjects_dir)
+    src_fname = join(subjects_dir, subject, 'bem', 'volume-7mm-src.fif')
+    raw_fname = join(meg_dir, 'sample_audvis_raw.fif')
+    trans = join(meg_dir, 'sample_audvis_raw-trans.fif')
+    fwd_fname = join(meg_dir, 'sample_audvis-meg-vol-7-fwd.fif')
+    cov_fname = join(meg_dir, 'sample_audvis-cov.fif')
+    smap_stem = join(meg_dir, 'sample_audvis-grad-vol-7-fwd-sensmap')
+    inv_fname = join(meg_dir, 'sample_audvis-meg-vol-7-meg-inv.fif')
 
-###############################################################################
-    # Compute forward solution a.k.a. lead field
+    return [
+        Stage('volume_source_space', make_volume_source_space,
+              inputs=[mri, bem], outputs=[src_fname], subject=subject,
+              fname=src_fname, mri=mri, bem=bem, subjects_dir=subjects_dir,
+              n_jobs=n_jobs),
 
-    raw = mne.io.Raw(join(meg_dir, 'sample_audvis_raw.fif'))
-    fwd_fname = join(meg_dir, 'sample_audvis-meg-vol-7-fwd.fif')
-    trans = join(meg_dir, 'sample_audvis_raw-trans.fif')
-    # for MEG only
-    fwd = make_forward_solution(raw.info, trans=trans, src=src, bem=bem,
-                                fname=fwd_fname, meg=True, eeg=False,
-                                overwrite=True)
-
-    # Make a sensitivity map
-    smap = mne.sensitivity_map(fwd, ch_type='grad', mode='free')
-    smap.save(join(meg_dir, 'sample_audvis-grad-vol-7-fwd-sensmap'), ftype='w')
-
-###############################################################################
-    # Compute MNE inverse operators
-    #
-    # Note: The MEG/EEG forward solution could be used for all
-    #
-    noise_cov = mne.read_cov(join(meg_dir, 'sample_audvis-cov.fif'))
-    inv = make_inverse_operator(raw.info, fwd, noise_cov)
-    fname = join(meg_dir, 'sample_audvis-meg-vol-7-meg-inv.fif')
-    write_inverse_operator(fname, inv)
+        # Compute forward solution a.k.a. lead field
+        Stage('forward', make_forward,
+              inputs=[raw_fname, trans, src_fname, bem], outputs=[fwd_fname],
+              raw_fname=raw_fname, trans=trans, src_fname=src_fname, bem=bem,
+              fname=fwd_fname),
+
+        # Make a sensitivity map
+        Stage('sensmap', make_sensitivity_map, inputs=[fwd_fname],
+              outputs=[smap_stem + '-vl.w'], fwd_fname=fwd_fname,
+              fname=smap_stem),
+
+        # Compute MNE inverse operators
+        #
+        # Note: The MEG/EEG forward solution could be used for all
+        #
+        Stage('inverse', make_inverse,
+              inputs=[raw_fname, fwd_fname, cov_fname], outputs=[inv_fname],
+              raw_fname=raw_fname, fwd_fname=fwd_fname, cov_fname=cov_fname,
+              fname=inv_fname),
+    ]
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Generate the MNE sample data volume derivatives.')
+    parser.add_argument('sample_dir', help='sample data directory')
+    parser.add_argument('--n-jobs', type=int, default=os.cpu_count(),
+                        help='number of CPUs shared by concurrent stages')
+    parser.add_argument('--stage-jobs', type=int, default=2,
+                        help='number of CPUs used within each stage')
+    parser.add_argument('--report', default=None,
+                        help='JSON file where the time and resources used '
+                             'by each stage are written')
+    parser.add_argument('--cache-dir', default=None,
+                        help='reuse the outputs of unchanged stages from '
+                             'this directory')
+    parser.add_argument('--cache-size', type=float, default=50.,
+                        help='maximum size of the cache in GB')
+    args = parser.parse_args()
+
+    sample_dir = args.sample_dir
+    os.environ['SUBJECTS_DIR'] = join(sample_dir, 'subjects')
+    os.environ['MEG_DIR'] = join(sample_dir, 'MEG', 'sample')
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = ArtifactCache(args.cache_dir, args.cache_size)
+    run_stages(make_stages(sample_dir, n_jobs=args.stage_jobs),
+               n_jobs=args.n_jobs, cache=cache, report=args.report)
 
 is_main = (__name__ == '__main__')
 if is_main:
@@ -0,0 +1,291 @@
+"""Filter, resample, average and compute covariances in bounded memory.
+
+The raw file is read in chunks of ``chunk_duration`` seconds without
+preloading it. Each chunk is read with enough overlap on both sides for
+the FIR low-pass filter (and the polyphase resampling filter) to produce
+exactly the samples that filtering the whole recording would, and the
+recording edges are extended by odd reflection. Resampled data are written
+to a disk-backed memory map, so the peak memory is a small multiple of the
+chunk size whatever the length of the recording. Averages are accumulated
+epoch by epoch, each epoch being read and filtered on its own the same way.
+"""
+# License: BSD (3-clause)
+import os
+from fractions import Fraction
+
+import numpy as np
+from scipy.signal import firwin, fftconvolve, resample_poly
+
+import mne
+from mne.io.pick import _pick_data_channels
+
+
+def _fir(sfreq, l_freq, h_freq):
+    """Make a linear phase Hamming-windowed low-pass or band-pass filter."""
+    nyq = sfreq / 2.
+    h_trans = min(max(0.25 * h_freq, 2.), nyq - h_freq)
+    cutoffs, trans = [(h_freq + h_trans / 2.) / nyq], h_trans
+    if l_freq is not None:
+        l_trans = min(max(0.25 * l_freq, 2.), l_freq)
+        cutoffs.insert(0, (l_freq - l_trans / 2.) / nyq)
+        trans = min(trans, l_trans)
+    n_taps = int(np.ceil(3.3 * sfreq / trans)) // 2 * 2 + 1
+    return firwin(n_taps, cutoffs, window='hamming',
+                  pass_zero=l_freq is None)
+
+
+def _split_picks(info):
+    """Split channels into those that are filtered and the stim channels."""
+    stim = mne.pick_types(info, meg=False, stim=True, exclude=[])
+    data = np.setdiff1d(np.arange(len(info['ch_names'])), stim)
+    return data, stim
+
+
+def _read_padded(raw, start, stop, pad):
+    """Read samples [start - pad, stop + pad), reflecting at the edges."""
+    n_times = raw.last_samp - raw.first_samp + 1
+    first, last = max(start - pad, 0), min(stop + pad, n_times)
+    data, _ = raw[:, first:last]
+    left, right = pad - (start - first), pad - (last - stop)
+    if left or right:
+        data = np.pad(data, ((0, 0), (left, right)), mode='reflect',
+                      reflect_type='odd')
+    return data
+
+
+def _iter_filtered(raw, h_freq, chunk_duration, extra_pad=0, align=1):
+    """Yield (start, stop, data) chunks of low-passed data.
+
+    ``data`` covers samples ``[start - extra_pad, stop + extra_pad)`` of
+    the recording. Chunk starts are multiples of ``align``. Stim channels
+    are not filtered.
+    """
+    sfreq = raw.info['sfreq']
+    n_times = raw.last_samp - raw.first_samp + 1
+    filt = _fir(sfreq, None, h_freq) if h_freq is not None else None
+    half = len(filt) // 2 if filt is not None else 0
+    data_picks, _ = _split_picks(raw.info)
+    chunk = max(int(round(chunk_duration * sfreq)) // align, 1) * align
+    for start in range(0, n_times, chunk):
+        stop = min(start + chunk, n_times)
+        data = _read_padded(raw, start, stop, extra_pad + half)
+        if filt is not None:
+            out = data[:, half:data.shape[1] - half].copy()
+            out[data_picks] = fftconvolve(data[data_picks],
+                                          filt[np.newaxis], mode='valid')
+            data = out
+        yield start, stop, data
+
+
+def stream_filter_resample(raw_fname, fname, h_freq=40., sfreq=150.,
+                           chunk_duration=60., max_denominator=64,
+                           bads=()):
+    """Low-pass filter and resample a raw file chunk by chunk.
+
+    Parameters
+    ----------
+    raw_fname : str
+        The raw FIF file to read.
+    fname : str
+        The raw FIF file to write.
+    h_freq : float
+        Cutoff frequency of the low-pass filter.
+    sfreq : float
+        Target sampling frequency. The resampling ratio is approximated by
+        a fraction whose denominator is at most ``max_denominator``, and the
+        written file has the exact corresponding sampling frequency.
+    chunk_duration : float
+        Duration of the chunks in seconds.
+    max_denominator : int
+        Maximum denominator of the resampling ratio.
+    bads : list of str
+        Bad channels of the written file.
+
+    Returns
+    -------
+    sfreq : float
+        The sampling frequency of the written file.
+    """
+    raw = mne.io.Raw(raw_fname, preload=False)
+    ratio = Fraction(sfreq / raw.info['sfreq']).limit_denominator(
+        max_denominator)
+    up, down = ratio.numerator, ratio.denominator
+    # Half length of the default resample_poly filter, in input samples
+    pad = int(np.ceil(10. * max(up, down) / up)) + 1
+    pad = int(np.ceil(pad / float(down))) * down
+    n_times = raw.last_samp - raw.first_samp + 1
+    n_out = int(np.ceil(n_times * up / float(down)))
+    data_picks, stim_picks = _split_picks(raw.info)
+
+    buf_fname = fname + '.buf'
+    buf = np.memmap(buf_fname, dtype=np.float64, mode='w+',
+                    shape=(len(raw.ch_names), n_out))
+    try:
+        for start, stop, data in _iter_filtered(raw, h_freq, chunk_duration,
+                                                extra_pad=pad, align=down):
+            out_start = start * up // down
+            out_stop = min(int(np.ceil(stop * up / float(down))), n_out)
+            skip = pad * up // down
+            resampled = resample_poly(data[data_picks], up, down, axis=1)
+            buf[data_picks, out_start:out_stop] = \
+                resampled[:, skip:skip + out_stop - out_start]
+            # Stim channels keep the largest value of each output sample, so
+            # that events shorter than a sample are not lost
+            stim = data[stim_picks, pad:pad + stop - start]
+            edges = np.ceil(np.arange(out_start, out_stop) * down /
+                            float(up)).astype(int) - start
+            edges = np.minimum(edges, stop - start - 1)
+            if len(stim_picks):
+                buf[stim_picks, out_start:out_stop] = \
+                    np.maximum.reduceat(stim, edges, axis=1)
+        buf.flush()
+
+        info = raw.info.copy()
+        info['sfreq'] = raw.info['sfreq'] * up / float(down)
+        info['lowpass'] = min(info['lowpass'], h_freq)
+        info['bads'] = list(bads)
+        first_samp = int(round(raw.first_samp * up / float(down)))
+        raw_out = mne.io.RawArray(buf, info, first_samp=first_samp)
+        raw_out.save(fname, overwrite=True)
+        del raw_out
+    finally:
+        del buf
+        # RawArray may already have removed the file backing its data
+        if os.path.isfile(buf_fname):
+            os.remove(buf_fname)
+    return info['sfreq']
+
+
+def stream_average(raw_fname, events, event_id, tmin, tmax, h_freq=40.,
+                   picks=None, bads=(), projs=(), baseline=(None, 0)):
+    """Average low-passed epochs, reading and filtering one epoch at a time.
+
+    This is the equivalent of filtering the data and averaging
+    :class:`mne.Epochs` of it, with only one epoch in memory at a time.
+
+    Parameters
+    ----------
+    raw_fname : str
+        The raw FIF file to read.
+    events : array, shape (n_events, 3)
+        The events.
+    event_id : list of int
+        The ids of the events averaged together.
+    tmin, tmax : float
+        Start and end of the epochs in seconds.
+    h_freq : float | None
+        Cutoff frequency of the low-pass filter. None does not filter.
+    picks : array of int | None
+        Channels to include. None includes MEG, EEG, stim and EOG channels.
+    bads : list of str
+        Bad channels of the average.
+    projs : list of Projection
+        Projectors applied to the average, in addition to those of the raw
+        file.
+    baseline : tuple | None
+        The baseline interval, as in :class:`mne.Epochs`.
+
+    Returns
+    -------
+    evoked : instance of Evoked
+        The average of the data channels, with the projectors applied.
+    """
+    raw = mne.io.Raw(raw_fname, preload=False)
+    raw.info['bads'] = list(bads)
+    if picks is None:
+        picks = mne.pick_types(raw.info, meg=True, eeg=True, stim=True,
+                               eog=True)
+    sfreq = raw.info['sfreq']
+    n_times = raw.last_samp - raw.first_samp + 1
+    filt = _fir(sfreq, None, h_freq) if h_freq is not None else None
+    half = len(filt) // 2 if filt is not None else 0
+    data_picks, _ = _split_picks(raw.info)
+    first, last = int(round(tmin * sfreq)), int(round(tmax * sfreq)) + 1
+
+    # Like Epochs, the epochs extending past the recording are dropped
+    events = events[np.in1d(events[:, 2], event_id)]
+    starts = events[:, 0] - raw.first_samp + first
+    events = events[(starts >= 0) & (starts + last - first <= n_times)]
+    if len(events) == 0:
+        raise RuntimeError('No epochs within the recording')
+    data = np.zeros((len(raw.ch_names), last - first))
+    for start in events[:, 0] - raw.first_samp + first:
+        epoch = _read_padded(raw, start, start + last - first, half)
+        if filt is not None:
+            out = epoch[:, half:epoch.shape[1] - half].copy()
+            out[data_picks] = fftconvolve(epoch[data_picks],
+                                          filt[np.newaxis], mode='valid')
+            epoch = out
+        data += epoch
+    data /= len(events)
+
+    info = mne.pick_info(raw.info, picks)
+    if h_freq is not None:
+        info['lowpass'] = min(info['lowpass'], h_freq)
+    # the comment Epochs.average gives
+    counts = [(events[:, 2] == value).sum() for value in event_id]
+    comment = ' + '.join('%.2f * %s' % (float(count) / len(events), value)
+                         for count, value in zip(counts, event_id))
+    if len(event_id) == 1:
+        comment = str(event_id[0])
+    evoked = mne.EvokedArray(data[picks], info, tmin=first / sfreq,
+                             comment=comment, nave=len(events))
+    # like Epochs.average, only the data channels are kept
+    evoked.pick_channels([evoked.ch_names[pick] for pick in
+                          _pick_data_channels(evoked.info, exclude=())])
+    # baseline correction and projection commute with averaging
+    if baseline is not None:
+        evoked.apply_baseline(baseline)
+    evoked.add_proj(list(projs))
+    return evoked.apply_proj()
+
+
+def stream_covariance(raw_fname, h_freq=40., picks=None, bads=(), projs=(),
+                      chunk_duration=60.):
+    """Compute the covariance of low-passed raw data chunk by chunk.
+
+    This is the equivalent of filtering the data and calling
+    ``compute_raw_data_covariance`` on it, with the data accumulated in
+    chunks instead of being held in memory.
+
+    Parameters
+    ----------
+    raw_fname : str
+        The raw FIF file to read.
+    h_freq : float | None
+        Cutoff frequency of the low-pass filter. None does not filter.
+    picks : array of int | None
+        Channels to include. None includes MEG, EEG, stim and EOG channels.
+    bads : list of str
+        Bad channels of the covariance.
+    projs : list of Projection
+        Projectors stored in the covariance, in addition to those of the
+        raw file.
+    chunk_duration : float
+        Duration of the chunks in seconds.
+
+    Returns
+    -------
+    cov : instance of Covariance
+        The noise covariance.
+    """
+    raw = mne.io.Raw(raw_fname, preload=False)
+    raw.info['bads'] = list(bads)
+    if picks is None:
+        picks = mne.pick_types(raw.info, meg=True, eeg=True, stim=True,
+                               eog=True)
+    data = np.zeros((len(picks), len(picks)))
+    mu = np.zeros(len(picks))
+    n_samples = 0
+    for _, _, chunk in _iter_filtered(raw, h_freq, chunk_duration):
+        chunk = chunk[picks]
+        data += np.dot(chunk, chunk.T)
+        mu += chunk.sum(axis=1)
+        n_samples += chunk.shape[1]
+    mu /= n_samples
+    data -= n_samples * mu[:, np.newaxis] * mu[np.newaxis, :]
+    data /= (n_samples - 1.)
+    names = [raw.ch_names[k] for k in picks]
+    return mne.Covariance(data=data, names=names, bads=raw.info['bads'],
+                          projs=raw.info['projs'] + list(projs),
+                          nfree=n_samples - 1)
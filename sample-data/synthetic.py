@@ -0,0 +1,296 @@
+"""Generate a synthetic dataset laid out like the MNE sample data.
+
+The head is made of three concentric spheres (tessellated icosahedra)
+from which a 3-layer and a single layer BEM are computed, each cortical
+hemisphere is a small sphere, and the sensors are radial magnetometers
+around the head (as in whole-head OPM systems) and electrodes on the
+scalp. The raw recording is simulated as coloured noise with evoked
+responses after events 1 to 4 and blinks on an EOG channel.
+
+All the sizes can be chosen, so that the tutorial stages can be exercised
+and benchmarked without FreeSurfer or any download::
+
+    python synthetic.py ~/synthetic --spacing oct5 --n-meg 300 --n-eeg 128
+"""
+# License: BSD (3-clause)
+import argparse
+import os
+import os.path as op
+
+import numpy as np
+from scipy.signal import lfilter
+
+import mne
+from mne.surface import _get_ico_surface
+
+# Head center and radii of the BEM surfaces and sensors, in mm
+_center = np.array([0., 0., 40.])
+_bem_radii = dict(inner_skull=80., outer_skull=85., outer_skin=90.)
+_meg_radius, _eeg_radius = 110., 90.
+
+
+def _fibonacci_cap(n, radius, min_z=-0.2):
+    """Points evenly spread on the part of a sphere above ``min_z``."""
+    ii = np.arange(n) + 0.5
+    z = 1. - ii / n * (1. - min_z)
+    phi = ii * np.pi * (3. - np.sqrt(5.))
+    r = np.sqrt(1. - z ** 2)
+    return radius * np.c_[r * np.cos(phi), r * np.sin(phi), z]
+
+
+def _orthonormal(normal):
+    """Two unit vectors orthogonal to a unit vector, and the vector."""
+    ref = np.array([1., 0., 0.]) if abs(normal[0]) < 0.9 else \
+        np.array([0., 1., 0.])
+    ex = np.cross(ref, normal)
+    ex /= np.linalg.norm(ex)
+    return np.r_[ex, np.cross(normal, ex), normal]
+
+
+def make_anatomy(subjects_dir, subject='sample', cortex_grade=6, bem_grade=4,
+                 bem_sigma=(0.3, 0.006, 0.3)):
+    """Write the surfaces, BEM solutions and a head-MRI transform.
+
+    Parameters
+    ----------
+    subjects_dir : str
+        The subjects directory.
+    subject : str
+        The subject name.
+    cortex_grade : int
+        Subdivision of the icosahedron used for each hemisphere, it must
+        be finer than the source spaces built from it.
+    bem_grade : int
+        Subdivision of the icosahedron used for the BEM surfaces.
+    bem_sigma : tuple of float
+        Conductivities of the brain, skull and scalp.
+
+    Returns
+    -------
+    bem_fnames : dict
+        The file names of the 1-layer and 3-layer BEM solutions.
+    """
+    surf_dir = op.join(subjects_dir, subject, 'surf')
+    bem_dir = op.join(subjects_dir, subject, 'bem')
+    for dirname in (surf_dir, bem_dir):
+        if not op.isdir(dirname):
+            os.makedirs(dirname)
+
+    # Cortex: one sphere per hemisphere, and the registration spheres
+    ico = _get_ico_surface(cortex_grade)
+    for hemi, x in (('lh', -30.), ('rh', 30.)):
+        mne.write_surface(op.join(surf_dir, hemi + '.white'),
+                          np.array([x, 0., 50.]) + 25. * ico['rr'],
+                          ico['tris'])
+        for name in ('sphere', 'sphere.reg'):
+            mne.write_surface(op.join(surf_dir, '%s.%s' % (hemi, name)),
+                              100. * ico['rr'], ico['tris'])
+
+    ico = _get_ico_surface(bem_grade)
+    for name, radius in _bem_radii.items():
+        mne.write_surface(op.join(bem_dir, name + '.surf'),
+                          _center + radius * ico['rr'], ico['tris'])
+    n_tris = len(ico['tris'])
+
+    bem_fnames = dict()
+    for conductivity in (bem_sigma[:1], bem_sigma):
+        model = mne.make_bem_model(subject, ico=None,
+                                   conductivity=conductivity,
+                                   subjects_dir=subjects_dir)
+        tag = '-'.join([str(n_tris)] * len(conductivity))
+        bem_fnames[len(conductivity)] = op.join(
+            bem_dir, '%s-%s-bem-sol.fif' % (subject, tag))
+        mne.write_bem_surfaces(bem_fnames[len(conductivity)].replace(
+            '-sol', ''), model)
+        mne.write_bem_solution(bem_fnames[len(conductivity)],
+                               mne.make_bem_solution(model))
+    return bem_fnames
+
+
+def make_info(n_meg, n_eeg, sfreq):
+    """Make the measurement info of radial magnetometers and electrodes.
+
+    The sample tutorial marks 'MEG 2443' and 'EEG 053' as bad and uses
+    'MEG 1531' to detect heart beats, these names are given to the first
+    magnetometers and to the 53rd electrode so that its stages run on the
+    synthetic data.
+    """
+    meg_names = ['MEG 1531', 'MEG 2443'][:n_meg]
+    # the other names are numbered, skipping those two
+    ii = 0
+    while len(meg_names) < n_meg:
+        ii += 1
+        if 'MEG %04d' % ii not in meg_names:
+            meg_names.append('MEG %04d' % ii)
+    eeg_names = ['EEG %03d' % ii for ii in range(1, n_eeg + 1)]
+    ch_names = meg_names + eeg_names + ['EOG 061', 'STI 014']
+    ch_types = ['mag'] * n_meg + ['eeg'] * n_eeg + ['eog', 'stim']
+    info = mne.create_info(ch_names, sfreq, ch_types)
+    info['dev_head_t'] = mne.Transform('meg', 'head', np.eye(4))
+
+    center = _center / 1000.
+    for ch, pos in zip(info['chs'][:n_meg],
+                       _fibonacci_cap(n_meg, _meg_radius / 1000.)):
+        ch['loc'][:] = np.r_[center + pos, _orthonormal(pos / np.linalg.norm(
+            pos))]
+    for ch, pos in zip(info['chs'][n_meg:n_meg + n_eeg],
+                       _fibonacci_cap(n_eeg, _eeg_radius / 1000.)):
+        ch['loc'][:] = 0.
+        ch['loc'][:3] = center + pos
+    return info
+
+
+def simulate_raw(fname, info, duration, seed=0, chunk_duration=60.):
+    """Simulate and write a raw recording with events and blinks.
+
+    The data are generated chunk by chunk into a disk-backed buffer so
+    that long recordings do not need to fit in memory.
+
+    Returns
+    -------
+    events : array, shape (n_events, 3)
+        The simulated events.
+    """
+    rng = np.random.RandomState(seed)
+    sfreq = info['sfreq']
+    n_times = int(round(duration * sfreq))
+    meg = mne.pick_types(info, meg=True, exclude=[])
+    eeg = mne.pick_types(info, meg=False, eeg=True, exclude=[])
+    eog = mne.pick_types(info, meg=False, eog=True, exclude=[])
+    stim = mne.pick_types(info, meg=False, stim=True, exclude=[])
+    scale = np.zeros(len(info['ch_names']))
+    scale[meg], scale[eeg], scale[eog] = 2e-13, 5e-6, 2e-5
+
+    # Events every 0.8 to 1.2 s, with an evoked response of a random
+    # topography per event id, peaking at 100 ms
+    onsets = np.cumsum(rng.uniform(0.8, 1.2, int(duration) + 1) * sfreq)
+    onsets = onsets[onsets < n_times - sfreq].astype(int)
+    events = np.c_[onsets, np.zeros(len(onsets), int),
+                   np.arange(len(onsets)) % 4 + 1]
+    topos = rng.randn(5, len(scale)) * scale * 3.
+    topos[:, eog] = 0.
+    t = np.arange(int(0.3 * sfreq)) / sfreq
+    evoked = np.exp(-((t - 0.1) / 0.03) ** 2)
+    blinks = (rng.uniform(0, duration, int(duration / 5.)) *
+              sfreq).astype(int)
+    blink = np.hanning(int(0.3 * sfreq))
+
+    buf_fname = fname + '.buf'
+    data = np.memmap(buf_fname, dtype=np.float64, mode='w+',
+                     shape=(len(scale), n_times))
+    chunk = int(chunk_duration * sfreq)
+    zi = np.zeros(len(scale))
+    try:
+        for start in range(0, n_times, chunk):
+            stop = min(start + chunk, n_times)
+            noise = rng.randn(len(scale), stop - start)
+            # Coloured noise, continuous across chunks
+            noise, zi = lfilter([1.], [1., -0.9], noise, axis=1,
+                                zi=zi[:, np.newaxis])
+            zi = zi[:, 0]
+            data[:, start:stop] = noise * scale[:, np.newaxis] * \
+                np.sqrt(1 - 0.9 ** 2)
+        for onset, _, event_id in events:
+            stop = min(onset + len(evoked), n_times)
+            data[:, onset:stop] += np.outer(topos[event_id],
+                                            evoked[:stop - onset])
+            data[stim, onset:onset + int(0.05 * sfreq)] = event_id
+        for onset in blinks:
+            stop = min(onset + len(blink), n_times)
+            data[eog, onset:stop] += np.outer(10 * scale[eog],
+                                              blink[:stop - onset])
+        data.flush()
+        raw = mne.io.RawArray(data, info)
+        if len(eeg):
+            raw.add_proj(mne.io.proj.make_eeg_average_ref_proj(info))
+        raw.save(fname, overwrite=True)
+        del raw
+    finally:
+        del data
+        # Raw removes the file of its memory-mapped data when deleted
+        if op.isfile(buf_fname):
+            os.remove(buf_fname)
+    return events
+
+
+def make_synthetic_dataset(root, spacing='oct5', n_meg=306, n_eeg=60,
+                           duration=60., sfreq=600., subject='sample',
+                           cortex_grade=6, bem_grade=4, seed=0):
+    """Write a synthetic dataset laid out like MNE-sample-data.
+
+    Parameters
+    ----------
+    root : str
+        The directory of the dataset, with ``subjects`` and ``MEG`` in it.
+    spacing : str
+        Spacing of the source space, as in :func:`mne.setup_source_space`.
+    n_meg : int
+        Number of magnetometers.
+    n_eeg : int
+        Number of EEG electrodes.
+    duration : float
+        Duration of the raw recording in seconds. The empty room recording
+        is half as long.
+    sfreq : float
+        Sampling frequency.
+    subject : str
+        The subject name.
+    cortex_grade : int
+        Subdivision of the icosahedron used for each hemisphere.
+    bem_grade : int
+        Subdivision of the icosahedron used for the BEM surfaces.
+    seed : int
+        Seed of the random number generator.
+
+    Returns
+    -------
+    fnames : dict
+        The files that were written.
+    """
+    subjects_dir = op.join(root, 'subjects')
+    meg_dir = op.join(root, 'MEG', subject)
+    if not op.isdir(meg_dir):
+        os.makedirs(meg_dir)
+    fnames = dict(subjects_dir=subjects_dir, meg_dir=meg_dir)
+    fnames['bem'] = make_anatomy(subjects_dir, subject, cortex_grade,
+                                 bem_grade)
+    fnames['src'] = op.join(subjects_dir, subject, 'bem',
+                            '%s-%s-src.fif' % (subject, spacing))
+    src = mne.setup_source_space(subject, spacing=spacing, add_dist=False,
+                                 subjects_dir=subjects_dir)
+    mne.write_source_spaces(fnames['src'], src)
+
+    fnames['trans'] = op.join(meg_dir, '%s_audvis_raw-trans.fif' % subject)
+    mne.write_trans(fnames['trans'], mne.Transform('head', 'mri', np.eye(4)))
+
+    info = make_info(n_meg, n_eeg, sfreq)
+    fnames['raw'] = op.join(meg_dir, '%s_audvis_raw.fif' % subject)
+    events = simulate_raw(fnames['raw'], info, duration, seed)
+    fnames['events'] = op.join(meg_dir, '%s_audvis_raw-eve.fif' % subject)
+    mne.write_events(fnames['events'], events)
+    fnames['ernoise'] = op.join(meg_dir, 'ernoise_raw.fif')
+    simulate_raw(fnames['ernoise'], mne.pick_info(
+        info, mne.pick_types(info, meg=True, stim=True, exclude=[])),
+        duration / 2., seed + 1)
+    return fnames
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic dataset laid out like the sample '
+                    'data.')
+    parser.add_argument('root', help='directory of the dataset')
+    parser.add_argument('--spacing', default='oct5')
+    parser.add_argument('--n-meg', type=int, default=306)
+    parser.add_argument('--n-eeg', type=int, default=60)
+    parser.add_argument('--duration', type=float, default=60.)
+    parser.add_argument('--sfreq', type=float, default=600.)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    make_synthetic_dataset(args.root, spacing=args.spacing, n_meg=args.n_meg,
+                           n_eeg=args.n_eeg, duration=args.duration,
+                           sfreq=args.sfreq, seed=args.seed)
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
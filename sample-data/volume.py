@@ -0,0 +1,413 @@
+"""Build volume source spaces of several grid spacings from a cached index.
+
+This gives the same source spaces as :func:`mne.setup_volume_source_space`
+for grids bounded by a BEM surface, but:
+
+- the inner skull is voxelized once into an index telling, for each cell,
+  whether it is inside, outside or crossed by the surface. Only the grid
+  points in crossed cells are tested against the triangles, and the index
+  is saved in a cache directory, keyed on the surface, to be reused by the
+  later builds.
+- several spacings are built in one call, from the finest to the coarsest,
+  and a grid whose spacing is a multiple of an already built one takes the
+  points in use from it instead of testing them again.
+- the interpolators to the MRI volume are computed by slabs of slices in a
+  pool of processes, the MRI header being read once for all the grids.
+
+Example::
+
+    python volume.py sample --bem sample-5120-bem-sol.fif --pos 3 5 7 \\
+        --out '{subject}-volume-{pos}mm-src.fif' --cache-dir volume-index
+"""
+# License: BSD (3-clause)
+import argparse
+import hashlib
+import os
+import os.path as op
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import ndimage, sparse
+from scipy.spatial import cKDTree
+
+import mne
+from mne.io.constants import FIFF
+from mne.source_space import (SourceSpaces, _add_interpolator,
+                              _make_voxel_ras_trans, _points_outside_surface,
+                              _vol_vertex)
+from mne.transforms import apply_trans, combine_transforms, invert_transform
+
+_OUTSIDE, _INSIDE, _CROSSED = 0, 1, 2
+
+
+class SurfaceIndex(object):
+    """Classify points as inside or outside a closed surface by voxels.
+
+    The cells crossed by the bounding box of a triangle are marked as
+    crossed, and the remaining cells are split in connected components,
+    each one lying entirely inside or outside the surface. The components
+    touching the border of the index are outside, the others are classified
+    by testing one of their cells against the surface.
+
+    Parameters
+    ----------
+    surf : dict
+        The surface, with ``rr`` and ``tris``, in meters.
+    cell : float
+        The size of the cells, in meters.
+    cache_dir : str | None
+        Directory where the index is saved and read from. None disables
+        caching.
+    """
+
+    def __init__(self, surf, cell=0.002, cache_dir=None):
+        self.surf = surf
+        self.cell = cell
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(surf['rr'], np.float64).tobytes())
+        h.update(np.ascontiguousarray(surf['tris'], np.int64).tobytes())
+        h.update(repr(cell).encode())
+        fname = None if cache_dir is None else op.join(
+            cache_dir, 'surface-index-%s.npz' % h.hexdigest())
+        if fname is not None and op.isfile(fname):
+            with np.load(fname) as npz:
+                self.origin, self.state = npz['origin'], npz['state']
+            return
+        self.origin, self.state = self._compute()
+        if fname is not None:
+            if not op.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(fname + '.tmp', 'wb') as fid:
+                np.savez(fid, origin=self.origin, state=self.state)
+            os.rename(fname + '.tmp', fname)
+
+    def _compute(self):
+        rr, cell = self.surf['rr'], self.cell
+        # one free cell at least around the surface
+        origin = rr.min(axis=0) - 2 * cell
+        shape = np.floor((rr.max(axis=0) - origin) / cell).astype(int) + 3
+        crossed = np.zeros(shape, bool)
+        tri_rr = rr[self.surf['tris']]
+        los = np.floor((tri_rr.min(axis=1) - origin) / cell).astype(int)
+        his = np.floor((tri_rr.max(axis=1) - origin) / cell).astype(int) + 1
+        for lo, hi in zip(los, his):
+            crossed[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] = True
+        labels, n_labels = ndimage.label(~crossed)
+        border = np.unique(np.concatenate([
+            labels[[0, -1]].ravel(), labels[:, [0, -1]].ravel(),
+            labels[:, :, [0, -1]].ravel()]))
+        inside = np.zeros(n_labels + 1, bool)
+        for label in np.setdiff1d(np.arange(1, n_labels + 1), border):
+            idx = np.array(np.unravel_index(
+                np.argmax(labels.ravel() == label), shape))
+            center = origin + (idx + 0.5) * cell
+            inside[label] = not _points_outside_surface(
+                center[np.newaxis], self.surf, verbose=False)[0]
+        state = np.where(inside[labels], _INSIDE, _OUTSIDE).astype(np.int8)
+        state[crossed] = _CROSSED
+        return origin, state
+
+    def outside(self, rr, n_jobs=1):
+        """Whether points are outside the surface.
+
+        Parameters
+        ----------
+        rr : array, shape (n_points, 3)
+            The points, in meters.
+        n_jobs : int
+            Number of jobs testing the points of crossed cells.
+
+        Returns
+        -------
+        outside : array of bool, shape (n_points,)
+            True for the points outside the surface.
+        """
+        idx = np.floor((rr - self.origin) / self.cell).astype(int)
+        valid = np.all((idx >= 0) & (idx < self.state.shape), axis=1)
+        state = np.full(len(rr), _OUTSIDE, np.int8)
+        state[valid] = self.state[tuple(idx[valid].T)]
+        outside = state == _OUTSIDE
+        crossed = np.where(state == _CROSSED)[0]
+        if len(crossed):
+            outside[crossed] = _points_outside_surface(
+                rr[crossed], self.surf, n_jobs, verbose=False)
+        return outside
+
+
+def _grid_extent(surf, grid):
+    """The grid index bounds covering a surface, as in mne-python."""
+    def bound(m):
+        return (np.floor(np.abs(m) / grid) + 1) * (1 if m > 0 else -1)
+    return (np.array([bound(m) for m in surf['rr'].min(axis=0)], int),
+            np.array([bound(m) for m in surf['rr'].max(axis=0)], int))
+
+
+def _grid_points(minn, maxn, grid):
+    """The grid indices and positions, x varying fastest, then y and z."""
+    ijk = np.meshgrid(np.arange(minn[2], maxn[2] + 1),
+                      np.arange(minn[1], maxn[1] + 1),
+                      np.arange(minn[0], maxn[0] + 1), indexing='ij')
+    ijk = np.array([ijk[2].ravel(), ijk[1].ravel(), ijk[0].ravel()]).T
+    return ijk, ijk * grid
+
+
+def _grid_inuse(index, ijk, rr, exclude, mindist, n_jobs):
+    """The grid points inside the surface and away from it."""
+    surf = index.surf
+    cm = np.mean(surf['rr'], axis=0)
+    maxdist = np.linalg.norm(surf['rr'] - cm, axis=1).max()
+    dists = np.linalg.norm(rr - cm, axis=1)
+    inuse = (dists >= exclude) & (dists <= maxdist)
+    vertno = np.where(inuse)[0]
+    inuse[vertno[index.outside(rr[vertno], n_jobs)]] = False
+    if mindist > 0:
+        vertno = np.where(inuse)[0]
+        dists = cKDTree(surf['rr']).query(rr[vertno],
+                                          distance_upper_bound=mindist)[0]
+        inuse[vertno[dists < mindist]] = False
+    return inuse
+
+
+def _derived_inuse(ijk, ratio, finer):
+    """The points in use of a grid, taken from a finer grid."""
+    f_minn, f_maxn, f_inuse = finer
+    f_ijk = ijk * ratio
+    valid = np.all((f_ijk >= f_minn) & (f_ijk <= f_maxn), axis=1)
+    f_shape = f_maxn - f_minn + 1
+    f_ijk = f_ijk[valid] - f_minn
+    inuse = np.zeros(len(ijk), bool)
+    inuse[valid] = f_inuse[f_ijk[:, 0] + f_shape[0] * (
+        f_ijk[:, 1] + f_shape[1] * f_ijk[:, 2])]
+    return inuse
+
+
+def _neighbors(ijk, minn, maxn, inuse):
+    """The neighborhoods of the grid points, as mne-python 0.18 makes them.
+
+    mne-python fills the 26-neighborhood of each point, but then removes
+    the neighbors by their position in the neighborhood array instead of
+    by their value. Only the first neighbor, one plane below, remains for
+    the points in use, whether that neighbor is in use or not, and the
+    other 25 are -1. This is reproduced so that the source spaces written
+    are identical.
+    """
+    ns = maxn - minn + 1
+    neigh = np.full((len(ijk), 26), -1, int)
+    below = inuse & (ijk[:, 2] > minn[2])
+    neigh[below, 0] = np.where(below)[0] - ns[0] * ns[1]
+    return neigh
+
+
+def _make_grid(index, grid, exclude, mindist, finer, n_jobs):
+    """A volume source space and its (minn, maxn, inuse) for the next."""
+    minn, maxn = _grid_extent(index.surf, grid)
+    ijk, rr = _grid_points(minn, maxn, grid)
+    inuse = None
+    for f_grid, f_res in finer.items():
+        ratio = grid / f_grid
+        if abs(ratio - round(ratio)) < 1e-6:
+            inuse = _derived_inuse(ijk, int(round(ratio)), f_res)
+            break
+    if inuse is None:
+        inuse = _grid_inuse(index, ijk, rr, exclude, mindist, n_jobs)
+    npts = len(rr)
+    nn = np.zeros((npts, 3))
+    nn[:, 2] = 1.
+    sp = dict(np=npts, nn=nn, rr=rr, inuse=inuse.astype(int), type='vol',
+              nuse=int(inuse.sum()), coord_frame=FIFF.FIFFV_COORD_MRI, id=-1,
+              shape=maxn - minn + 1, vertno=np.where(inuse)[0],
+              neighbor_vert=_neighbors(ijk, minn, maxn, inuse),
+              src_mri_t=_make_voxel_ras_trans(minn * grid, np.eye(3),
+                                              grid * np.ones(3)),
+              vol_dims=maxn - minn + 1)
+    return sp, (minn, maxn, inuse)
+
+
+# The interpolation context in the worker processes
+_context = dict()
+
+
+def _init_worker(context):
+    _context.update(context)
+
+
+def _interpolate_slices(start, stop):
+    """The interpolator rows of the MRI voxels of slices start to stop."""
+    ctx = _context
+    (jlo, jhi), (klo, khi) = ctx['jrange'], ctx['krange']
+    width, height = ctx['mri_width'], ctx['mri_height']
+    vol_dims, inuse = ctx['vol_dims'], ctx['inuse']
+    js = np.tile(np.arange(jlo, jhi, dtype=np.float32), khi - klo)
+    ks = np.repeat(np.arange(klo, khi, dtype=np.float32), jhi - jlo)
+    flat = ks.astype(int) * width + js.astype(int)
+    rows, indices, data = list(), list(), list()
+    for p in range(start, stop):
+        r0 = apply_trans(ctx['trans'], np.c_[js, ks, np.full_like(js, p)])
+        rn = np.floor(r0).astype(int)
+        good = np.where(np.all((rn >= 0) & (rn < vol_dims - 1), axis=1))[0]
+        rn, r0 = rn[good], r0[good]
+        jj, kk, pp = rn.T
+        vss = np.array([
+            _vol_vertex(vol_dims[0], vol_dims[1], jj + dj, kk + dk, pp + dp)
+            for dj, dk, dp in [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0),
+                               (0, 0, 1), (1, 0, 1), (1, 1, 1),
+                               (0, 1, 1)]], np.int32).reshape(8, -1).T
+        uses = np.any(inuse[vss], axis=1)
+        rows.append(flat[good[uses]] + p * height * width)
+        indices.append(vss[uses].ravel())
+        xf, yf, zf = (r0[uses] - rn[uses].astype(np.float32)).T
+        omxf, omyf, omzf = 1. - xf, 1. - yf, 1. - zf
+        data.append(np.array([omxf * omyf * omzf, xf * omyf * omzf,
+                              xf * yf * omzf, omxf * yf * omzf,
+                              omxf * omyf * zf, xf * omyf * zf,
+                              xf * yf * zf, omxf * yf * zf],
+                             order='F').T.ravel())
+    return (np.concatenate(rows), np.concatenate(indices),
+            np.concatenate(data))
+
+
+def _voxel_box(sp, dims):
+    """The MRI voxels that can be interpolated from the points in use."""
+    ijk = np.array(np.unravel_index(sp['vertno'], sp['vol_dims'][::-1]))
+    lo, hi = ijk[::-1].min(axis=1) - 1, ijk[::-1].max(axis=1) + 1
+    corners = np.array([[(lo, hi)[c // 4][0], (lo, hi)[c // 2 % 2][1],
+                         (lo, hi)[c % 2][2]] for c in range(8)], float)
+    trans = combine_transforms(sp['src_mri_t'],
+                               invert_transform(sp['vox_mri_t']),
+                               'mri_voxel', 'mri_voxel')['trans']
+    corners = apply_trans(trans, corners)
+    return [(max(int(np.floor(c_lo)) - 1, 0), min(int(np.ceil(c_hi)) + 2, d))
+            for c_lo, c_hi, d in zip(corners.min(axis=0),
+                                     corners.max(axis=0), dims)]
+
+
+def _add_interpolators(sps, mri, n_jobs):
+    """Add the interpolators to the MRI volume, slabs computed in parallel."""
+    for sp in sps:
+        # the MRI transforms, and an empty interpolator
+        _add_interpolator(sp, mri, False)
+    dims = (sps[0]['mri_width'], sps[0]['mri_height'], sps[0]['mri_depth'])
+    nvox = int(np.prod(dims))
+    for sp in sps:
+        indptr = np.zeros(nvox + 1, np.int32)
+        if sp['nuse'] == 0:
+            sp['interpolator'] = sparse.csr_matrix((nvox, sp['np']))
+            continue
+        trans = combine_transforms(sp['vox_mri_t'],
+                                   invert_transform(sp['src_mri_t']),
+                                   'mri_voxel', 'mri_voxel')['trans']
+        jrange, krange, prange = _voxel_box(sp, dims)
+        context = dict(trans=trans.astype(np.float32), mri_width=dims[0],
+                       mri_height=dims[1], jrange=jrange, krange=krange,
+                       vol_dims=sp['vol_dims'],
+                       inuse=sp['inuse'].astype(bool))
+        n_slabs = min(max(int(n_jobs), 1) * 4, prange[1] - prange[0])
+        bounds = np.linspace(prange[0], prange[1], n_slabs + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=max(int(n_jobs), 1),
+                                 initializer=_init_worker,
+                                 initargs=(context,)) as executor:
+            res = list(executor.map(_interpolate_slices, bounds[:-1],
+                                    bounds[1:]))
+        rows = np.concatenate([r[0] for r in res])
+        indptr[rows + 1] = 8
+        indptr = np.cumsum(indptr, out=indptr)
+        sp['interpolator'] = sparse.csr_matrix(
+            (np.concatenate([r[2] for r in res]),
+             np.concatenate([r[1] for r in res]), indptr),
+            shape=(nvox, sp['np']))
+
+
+def make_volume_source_spaces(subject, pos=(7.,), mri=None, bem=None,
+                              mindist=5., exclude=0., subjects_dir=None,
+                              cell=2., cache_dir=None, n_jobs=1):
+    """Make volume source spaces of several grid spacings.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    pos : list of float
+        The grid spacings, in millimeters.
+    mri : str | None
+        The MRI volume used for the interpolators, None for none.
+    bem : str
+        The BEM file, whose inner skull bounds the grids.
+    mindist : float
+        Minimum distance to the inner skull, in millimeters.
+    exclude : float
+        Radius of the excluded sphere at the center of the inner skull, in
+        millimeters.
+    subjects_dir : str | None
+        The subjects directory, used to find ``mri`` when it is not a path.
+    cell : float
+        The size of the cells of the surface index, in millimeters.
+    cache_dir : str | None
+        Directory where the surface index is saved and read from. None
+        disables caching.
+    n_jobs : int
+        Number of jobs testing points and computing interpolators.
+
+    Returns
+    -------
+    srcs : list of SourceSpaces
+        The source spaces, in the order of ``pos``.
+    """
+    subjects_dir = mne.utils.get_subjects_dir(subjects_dir)
+    if mri is not None and not op.isfile(mri):
+        mri = op.join(subjects_dir, subject, 'mri', mri)
+    surf = mne.read_bem_surfaces(bem, s_id=FIFF.FIFFV_BEM_SURF_ID_BRAIN,
+                                 verbose=False)
+    index = SurfaceIndex(surf, cell / 1000., cache_dir)
+    sps, finer = dict(), dict()
+    for grid in sorted(set(float(p) / 1000. for p in pos)):
+        sps[grid], finer[grid] = _make_grid(index, grid, exclude / 1000.,
+                                            mindist / 1000., finer, n_jobs)
+    if mri is not None:
+        _add_interpolators(list(sps.values()), mri, n_jobs)
+    srcs = list()
+    for p in pos:
+        sp = dict(sps[float(p) / 1000.])
+        if mri is None:
+            sp['type'] = 'discrete'
+        del sp['vol_dims']
+        sp.update(dict(nearest=None, dist=None, use_tris=None,
+                       patch_inds=None, dist_limit=None, pinfo=None, ntri=0,
+                       nearest_dist=None, nuse_tri=0, tris=None,
+                       subject_his_id=subject))
+        srcs.append(SourceSpaces([sp], dict(working_dir=os.getcwd(),
+                                            command_line='None')))
+    return srcs
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description='Make volume source spaces of several grid spacings.')
+    parser.add_argument('subject')
+    parser.add_argument('--bem', required=True,
+                        help='BEM file bounding the grids')
+    parser.add_argument('--pos', type=float, nargs='+', default=[7.],
+                        help='grid spacings in mm')
+    parser.add_argument('--out', required=True,
+                        help='output file name, formatted with subject and '
+                             'pos')
+    parser.add_argument('--mri', default='T1.mgz',
+                        help='MRI volume of the interpolators, "none" for '
+                             'none')
+    parser.add_argument('--mindist', type=float, default=5.)
+    parser.add_argument('--exclude', type=float, default=0.)
+    parser.add_argument('--subjects-dir', default=None)
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of the surface indexes')
+    parser.add_argument('--n-jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    srcs = make_volume_source_spaces(
+        args.subject, args.pos, None if args.mri == 'none' else args.mri,
+        args.bem, args.mindist, args.exclude, args.subjects_dir,
+        cache_dir=args.cache_dir, n_jobs=args.n_jobs)
+    for pos, src in zip(args.pos, srcs):
+        src.save(args.out.format(subject=args.subject, pos='%g' % pos),
+                 overwrite=True)
+
+is_main = (__name__ == '__main__')
+if is_main:
+    run()
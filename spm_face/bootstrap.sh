@@ -8,73 +8,41 @@ if [ $# -ne 1 ] ; then
 fi
 
 SPM_sample=$1/MNE-spm-face
-mkdir ${SPM_sample}
+mkdir -p ${SPM_sample}
 export SUBJECT=spm
 CUR_DIR=$(pwd)
+SCRIPTS_DIR=$(cd $(dirname $0) && pwd)
+# options of recon.py, e.g. RECON_ARGS="--openmp 4"
+RECON_ARGS=${RECON_ARGS:-}
+# options of fetch.py, e.g. FETCH_ARGS="--n-jobs 2"
+FETCH_ARGS=${FETCH_ARGS:-}
+# options of package.py pack, e.g. PACK_ARGS="--n-jobs 8"
+PACK_ARGS=${PACK_ARGS:-}
 
 TMPDIR=$1/TMP
-mkdir ${TMPDIR}
+mkdir -p ${TMPDIR}
 cd ${TMPDIR}
 
-# Download the data
-for FNAME in multimodal_smri.zip multimodal_meg.zip
-do
-    if [ ! -f ${FNAME} ];
-    then
-        wget http://www.fil.ion.ucl.ac.uk/spm/download/data/mmfaces/${FNAME}
-    fi
-    unzip ${FNAME}
-done
-
-# Run freesurfer reconstruction
+# Download and extract the data, converting the CTF recordings to FIF as
+# soon as they are extracted. Set SPM_SOURCE to a directory holding the zip
+# files to use it instead of the network
+SPM_SOURCE=${SPM_SOURCE:-"http://www.fil.ion.ucl.ac.uk/spm/download/data/mmfaces/{name}"}
+python ${SCRIPTS_DIR}/../sample-data/fetch.py ${TMPDIR} \
+    multimodal_smri.zip multimodal_meg.zip --source "${SPM_SOURCE}" \
+    --fif-dir ${SPM_sample}/MEG/spm ${FETCH_ARGS} || exit 1
+
+# Run the freesurfer reconstruction, the watershed BEM, the head surface and
+# the BEM model, running the script again resumes an unfinished subject.
+# The fsaverage link recon-all makes in the subjects directory is removed,
+# as the whole directory is archived
 export SUBJECTS_DIR=${SPM_sample}/subjects
-if [ ! -d ${SUBJECTS_DIR}/spm ];
-then
-    mkdir -p ${SUBJECTS_DIR}/spm
-    cd ${SUBJECTS_DIR}/spm
-    recon-all -all -i ${TMPDIR}/sMRI/smri.hdr -s spm
-fi
-
-# remove fsaverage symlinks
-find ${SUBJECTS_DIR} -type l -exec rm -rf {} \;
-
-# use watershed algorithm to make BEM surfaces
-if [ ! -f ${SUBJECTS_DIR}/${SUBJECT}/bem/${SUBJECT}-inner-skull.surf ];
-then
-    cd ${SUBJECTS_DIR}/${SUBJECT}/bem
-    mne_watershed_bem
-    ln -s watershed/${SUBJECT}_inner_skull_surface ${SUBJECT}-inner_skull.surf
-    ln -s watershed/${SUBJECT}_outer_skin_surface ${SUBJECT}-outer_skin.surf
-    ln -s watershed/${SUBJECT}_outer_skull_surface ${SUBJECT}-outer_skull.surf
-fi
-
-# Make high resolution head surface
-HEAD_FNAME=${SUBJECTS_DIR}/${SUBJECT}/bem/${SUBJECT}-head.fif
-if [ ! -f ${HEAD_FNAME} ];
-then
-    mkheadsurf -s ${SUBJECT}
-    mne_surf2bem --surf ${SUBJECTS_DIR}/${SUBJECT}/surf/lh.seghead --id 4 --check --fif ${HEAD_FNAME}
-fi
-
-# Setup BEM
-mne_setup_forward_model --surf --ico 4
-
-# Convert CTF to FIF
-cd ${SPM_sample}
-mkdir -p MEG/spm
-cd MEG/spm
-for FNAME in SPM_CTF_MEG_example_faces1_3D SPM_CTF_MEG_example_faces2_3D
-do
-    FIF_FNAME=${FNAME}_raw.fif
-    if [ ! -f $FIF_FNAME ];
-    then
-        mne_ctf2fiff --ds ${TMPDIR}/MEG/${FNAME}.ds --fif ${FIF_FNAME}
-    fi
-done
+python ${SCRIPTS_DIR}/../sample-data/recon.py ${SUBJECTS_DIR} \
+    ${SUBJECT}=${TMPDIR}/sMRI/smri.hdr --forward-model --remove-fsaverage \
+    --log-dir ${TMPDIR}/logs ${RECON_ARGS} || exit 1
 
 # Copy trans file
 cp ${CUR_DIR}/SPM_CTF_MEG_example_faces1_3D_raw-trans.fif ${SPM_sample}/MEG/spm/
 
-# Create archive
-cd $1
-tar -cjvf MNE-spm-face.tar.bz2 MNE-spm-face
+# Create archive, compressing with several threads
+python ${SCRIPTS_DIR}/../sample-data/package.py pack $1 \
+    --bundle MNE-spm-face MNE-spm-face=${SPM_sample} ${PACK_ARGS} || exit 1
@@ -41,6 +41,19 @@ for subj in ('sample', 'fsaverage'):
                                   hemi + '.sphere.reg'), rr, tris)
 "
 
+# Set MNE_SCRIPTS_CACHE to a directory to skip the expensive steps whose
+# inputs and tool versions did not change since the last run
+CACHE_PY=$(cd $(dirname $0)/../sample-data && pwd)/cache.py
+cached () {
+    if [ -z "${MNE_SCRIPTS_CACHE}" ]; then
+        while [ "$1" != "--" ]; do shift; done
+        shift
+        "$@"
+    else
+        python ${CACHE_PY} --cache-dir ${MNE_SCRIPTS_CACHE} "$@"
+    fi
+}
+
 ROOT_DIR=$1
 SUBJECTS_DIR=$ROOT_DIR/subjects
 MEG_DIR=$ROOT_DIR/MEG/sample
@@ -53,12 +66,20 @@ mne_setup_forward_model --subject sample --surf --ico 3
 
 # Source space
 cd $SUBJECTS_DIR/sample/bem
+SURFS="../surf/lh.white ../surf/rh.white ../surf/lh.sphere ../surf/rh.sphere"
 mne_setup_source_space --oct 2 --overwrite
-mne_setup_source_space --oct 4 --overwrite
-mne_setup_source_space --oct 6 --overwrite
-mne_add_patch_info --src sample-oct-4-src.fif --srcp sample-oct-4-src.fif
-mne_add_patch_info --src sample-oct-6-src.fif --srcp sample-oct-6-src.fif
-mne_volume_source_space --bem $SUBJECTS_DIR/$SUBJECT/bem/sample-1280-bem.fif \
+for OCT in 4 6; do
+    cached --tools mne_setup_source_space mne_add_patch_info \
+        --inputs ${SURFS} --outputs sample-oct-${OCT}-src.fif -- \
+        bash -c "mne_setup_source_space --oct ${OCT} --overwrite && \
+            mne_add_patch_info --src sample-oct-${OCT}-src.fif \
+            --srcp sample-oct-${OCT}-src.fif"
+done
+cached --tools mne_volume_source_space \
+    --inputs $SUBJECTS_DIR/$SUBJECT/bem/sample-1280-bem.fif \
+    $SUBJECTS_DIR/sample/mri/T1.mgz \
+    --outputs $SUBJECTS_DIR/sample/bem/sample-volume-7mm-src.fif -- \
+    mne_volume_source_space --bem $SUBJECTS_DIR/$SUBJECT/bem/sample-1280-bem.fif \
     --grid 7 --mri $SUBJECTS_DIR/sample/mri/T1.mgz \
     --src $SUBJECTS_DIR/sample/bem/sample-volume-7mm-src.fif
 
@@ -67,9 +88,18 @@ cd $MEG_DIR
 FWD=${NAME}-meg-eeg-oct-6-fwd.fif
 FWD_SMALL=${NAME}-meg-eeg-oct-4-fwd.fif
 FWD_TINY_GRAD=${NAME}-meg-eeg-oct-2-grad-fwd.fif
-mne_do_forward_solution --mindist 5 --spacing oct-6 --meas ${NAME}_raw.fif \
+BEM3=$SUBJECTS_DIR/sample/bem/sample-1280-1280-1280-bem-sol.fif
+# the transform mne_do_forward_solution uses when --mri is not given
+TRANS=${NAME}_raw-trans.fif
+cached --tools mne_forward_solution --inputs ${NAME}_raw.fif ${BEM3} \
+    ${TRANS} $SUBJECTS_DIR/sample/bem/sample-oct-6-src.fif \
+    --outputs ${FWD} -- \
+    mne_do_forward_solution --mindist 5 --spacing oct-6 --meas ${NAME}_raw.fif \
     --bem sample-1280-1280-1280 --overwrite --fwd ${FWD}
-mne_do_forward_solution --mindist 5 --spacing oct-4 --meas ${NAME}_raw.fif \
+cached --tools mne_forward_solution --inputs ${NAME}_raw.fif ${BEM3} \
+    ${TRANS} $SUBJECTS_DIR/sample/bem/sample-oct-4-src.fif \
+    --outputs ${FWD_SMALL} -- \
+    mne_do_forward_solution --mindist 5 --spacing oct-4 --meas ${NAME}_raw.fif \
     --bem sample-1280-1280-1280 --overwrite --fwd ${FWD_SMALL}
 mne_do_forward_solution --mindist 5 --spacing oct-2 --meas ${NAME}_raw.fif \
     --bem sample-1280-1280-1280 --overwrite --grad --fwd ${FWD_TINY_GRAD}